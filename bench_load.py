@@ -0,0 +1,351 @@
+"""Нагрузочный тест обработчиков бота
+
+Поднимает в отдельном процессе заглушку Bot API (getMe, sendMessage,
+editMessageText, answerCallbackQuery) и гоняет через настоящий Application
+из main.py синтетических игроков: /start, выбор класса, /battle, выбор
+монстра, атаки до конца боя, /rating, /daily и /revive после смерти.
+Игроки работают параллельно (--concurrency), действия одного игрока идут
+по очереди, как в Telegram.
+
+Отчет: p50/p95/p99 времени обработки по каждому шагу, обновлений в секунду
+и рост памяти процесса. Лимиты исходящих сообщений по умолчанию сняты,
+чтобы мерить сами обработчики, а не SendScheduler (--rate-limit вернет их).
+
+Запуск:
+    python bench_load.py
+    python bench_load.py --users 5000 --concurrency 256 --rounds 5 --api-latency 20
+    python bench_load.py --save baseline.json
+    python bench_load.py --baseline baseline.json --tolerance 0.2
+
+С --baseline скрипт завершается с кодом 1, если p95 или обновлений/с
+стали хуже базового замера больше чем на tolerance.
+"""
+import os
+import gc
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+import itertools
+import subprocess
+import statistics
+from collections import Counter, defaultdict
+
+import psutil
+from aiohttp import web, ClientSession
+from telegram import Update
+
+BENCH_TOKEN = '123456:BENCH'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Rucoy Bench', 'username': 'rucoy_bench_bot'}
+
+# Монстр, на которого идут все игроки (доступен с первого уровня)
+MONSTER_ID = 1
+# Страховка от бесконечного боя
+MAX_TURNS = 100
+FIRST_USER_ID = 500_000_000
+
+# ============== ЗАГЛУШКА BOT API ==============
+
+def create_api_app(latency):
+    """Отвечает на методы Bot API так, как ответил бы Telegram"""
+    calls = Counter()
+    message_ids = itertools.count(1)
+
+    async def bot_method(request):
+        method = request.match_info['method']
+        calls[method] += 1
+        if latency:
+            await asyncio.sleep(latency)
+
+        params = await request.post()
+        if method == 'getMe':
+            result = BOT_USER
+        elif method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0))
+            result = {
+                'message_id': int(params.get('message_id', 0)) or next(message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def stats(request):
+        return web.json_response(calls)
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', bot_method)
+    app.router.add_get('/calls', stats)
+    return app
+
+def serve_api(port, latency):
+    """Точка входа процесса-заглушки"""
+    async def run():
+        runner = web.AppRunner(create_api_app(latency), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        print('ready', flush=True)
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_api_server(port, latency):
+    process = subprocess.Popen(
+        [sys.executable, __file__, '--serve-api', str(port), '--api-latency', str(latency * 1000)],
+        stdout=subprocess.PIPE, text=True,
+    )
+    if process.stdout.readline().strip() != 'ready':
+        process.kill()
+        raise RuntimeError("Заглушка Bot API не запустилась")
+    return process
+
+# ============== СИНТЕТИЧЕСКИЕ ОБНОВЛЕНИЯ ==============
+
+update_ids = itertools.count(1)
+
+def make_user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'Игрок {user_id}', 'username': f'player{user_id}'}
+
+def command_update(user_id, command):
+    text = '/' + command
+    return {
+        'update_id': next(update_ids),
+        'message': {
+            'message_id': next(update_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': make_user(user_id),
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+        },
+    }
+
+def callback_update(user_id, data):
+    return {
+        'update_id': next(update_ids),
+        'callback_query': {
+            'id': str(next(update_ids)),
+            'from': make_user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': '...',
+            },
+        },
+    }
+
+# ============== ПРОГОН ==============
+
+class Bench:
+    """Прогоняет сценарии игроков через Application и копит задержки"""
+
+    def __init__(self, bot, application):
+        self.bot = bot
+        self.application = application
+        self.latencies = defaultdict(list)
+        self.errors = 0
+        application.add_error_handler(self.on_error)
+
+    async def on_error(self, update, context):
+        self.errors += 1
+        if self.errors <= 3:
+            logging.getLogger(__name__).error("Ошибка в обработчике", exc_info=context.error)
+
+    async def send(self, step, data):
+        update = Update.de_json(data, self.application.bot)
+        started = time.perf_counter()
+        await self.application.process_update(update)
+        self.latencies[step].append(time.perf_counter() - started)
+
+    async def play(self, user_id, class_name, rounds):
+        """Сценарий одного игрока"""
+        await self.send('start', command_update(user_id, 'start'))
+        await self.send('button_callback:class', callback_update(user_id, f'class_{class_name}'))
+        await self.send('daily', command_update(user_id, 'daily'))
+
+        for _ in range(rounds):
+            player = await self.bot.players.get(user_id)
+            if player.hp <= 0:
+                await self.send('revive', command_update(user_id, 'revive'))
+
+            await self.send('battle', command_update(user_id, 'battle'))
+            await self.send('button_callback:monster', callback_update(user_id, f'monster_{MONSTER_ID}'))
+            for _ in range(MAX_TURNS):
+                if self.bot.battles.get(user_id) is None:
+                    break
+                await self.send('button_callback:attack', callback_update(user_id, 'battle_attack'))
+
+            await self.send('rating', command_update(user_id, 'rating'))
+
+    async def run(self, users, concurrency, rounds):
+        classes = list(self.bot.CLASSES)
+        queue = asyncio.Queue()
+        for index in range(users):
+            queue.put_nowait((FIRST_USER_ID + index, classes[index % len(classes)]))
+
+        async def worker():
+            while not queue.empty():
+                user_id, class_name = queue.get_nowait()
+                await self.play(user_id, class_name, rounds)
+
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, users))))
+
+def percentiles(values):
+    """(p50, p95, p99, max) в миллисекундах"""
+    if len(values) == 1:
+        return (values[0] * 1000,) * 4
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return cuts[49] * 1000, cuts[94] * 1000, cuts[98] * 1000, max(values) * 1000
+
+async def run_bench(args):
+    port = free_port()
+    api = start_api_server(port, args.api_latency / 1000)
+    database_dir = tempfile.TemporaryDirectory()
+
+    # main.py читает настройки при импорте
+    os.environ['BOT_TOKEN'] = BENCH_TOKEN
+    os.environ['TG_API_URL'] = f'http://127.0.0.1:{port}/bot'
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite+aiosqlite:///{database_dir.name}/bench.db"
+    os.environ['CONCURRENT_UPDATES'] = str(args.concurrency)
+    if args.seed is not None:
+        os.environ['RNG_SEED'] = str(args.seed)
+    if not args.rate_limit:
+        for name in ('TG_GLOBAL_RATE', 'TG_CHAT_RATE', 'TG_GROUP_RATE', 'TG_CHAT_BURST'):
+            os.environ[name] = '1000000'
+
+    import main as bot
+
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        await bot.init_storage()
+        application = bot.build_application(updater=False)
+        await application.initialize()
+        await application.start()
+        bench = Bench(bot, application)
+
+        process = psutil.Process()
+        gc.collect()
+        rss_before = process.memory_info().rss
+        started = time.perf_counter()
+        await bench.run(args.users, args.concurrency, args.rounds)
+        elapsed = time.perf_counter() - started
+        gc.collect()
+        rss_after = process.memory_info().rss
+
+        async with ClientSession() as session:
+            async with session.get(f'http://127.0.0.1:{port}/calls') as response:
+                api_calls = await response.json()
+
+        await application.stop()
+        await application.shutdown()
+        await bot.players.close()
+    finally:
+        api.kill()
+        api.wait()
+        database_dir.cleanup()
+
+    all_latencies = [value for values in bench.latencies.values() for value in values]
+    p50, p95, p99, worst = percentiles(all_latencies)
+    return {
+        'users': args.users,
+        'concurrency': args.concurrency,
+        'rounds': args.rounds,
+        'updates': len(all_latencies),
+        'seconds': elapsed,
+        'updates_per_second': len(all_latencies) / elapsed,
+        'p50_ms': p50,
+        'p95_ms': p95,
+        'p99_ms': p99,
+        'max_ms': worst,
+        'errors': bench.errors,
+        'steps': {
+            step: dict(zip(('p50_ms', 'p95_ms', 'p99_ms', 'max_ms'), percentiles(values)), count=len(values))
+            for step, values in bench.latencies.items()
+        },
+        'api_calls': api_calls,
+        'rss_before': rss_before,
+        'rss_after': rss_after,
+        'rss_growth_per_user': (rss_after - rss_before) / args.users,
+    }
+
+def print_report(result):
+    header = f"{'шаг':<24} | {'кол-во':>8} | {'p50 мс':>8} | {'p95 мс':>8} | {'p99 мс':>8} | {'max мс':>8}"
+    print(header)
+    print('-' * len(header))
+    rows = list(result['steps'].items()) + [('ВСЕГО', {
+        'count': result['updates'], 'p50_ms': result['p50_ms'], 'p95_ms': result['p95_ms'],
+        'p99_ms': result['p99_ms'], 'max_ms': result['max_ms'],
+    })]
+    for step, row in rows:
+        print(f"{step:<24} | {row['count']:>8,} | {row['p50_ms']:>8.2f} | {row['p95_ms']:>8.2f} | "
+              f"{row['p99_ms']:>8.2f} | {row['max_ms']:>8.2f}")
+
+    print()
+    print(f"⚡ {result['updates']:,} обновлений за {result['seconds']:.1f} с "
+          f"({result['updates_per_second']:,.0f} обновлений/с), ошибок: {result['errors']}")
+    print(f"📡 Запросов к Bot API: {sum(result['api_calls'].values()):,} "
+          f"({', '.join(f'{k} {v:,}' for k, v in sorted(result['api_calls'].items()))})")
+    print(f"💾 RSS: {result['rss_before'] / 2**20:.1f} → {result['rss_after'] / 2**20:.1f} МБ "
+          f"({result['rss_growth_per_user']:,.0f} байт на игрока)")
+
+def compare(result, baseline, tolerance):
+    """Возвращает список регрессий относительно базового замера"""
+    problems = []
+    if result['p95_ms'] > baseline['p95_ms'] * (1 + tolerance):
+        problems.append(f"p95 {baseline['p95_ms']:.2f} → {result['p95_ms']:.2f} мс")
+    if result['updates_per_second'] < baseline['updates_per_second'] * (1 - tolerance):
+        problems.append(f"обновлений/с {baseline['updates_per_second']:,.0f} → {result['updates_per_second']:,.0f}")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков бота")
+    parser.add_argument('--users', type=int, default=1000, help="синтетических игроков")
+    parser.add_argument('--concurrency', type=int, default=64, help="игроков одновременно")
+    parser.add_argument('--rounds', type=int, default=3, help="боев на игрока")
+    parser.add_argument('--api-latency', type=float, default=0, help="задержка ответа Bot API, мс")
+    parser.add_argument('--rate-limit', action='store_true', help="оставить лимиты SendScheduler")
+    parser.add_argument('--database-url', default=None, help="по умолчанию временная SQLite")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', default=None, help="сохранить результат в JSON")
+    parser.add_argument('--baseline', default=None, help="сравнить с сохраненным результатом")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="допустимое ухудшение (доля)")
+    parser.add_argument('--serve-api', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_api is not None:
+        serve_api(args.serve_api, args.api_latency / 1000)
+        return
+
+    result = asyncio.run(run_bench(args))
+    print_report(result)
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(result, file, indent=2, ensure_ascii=False)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            problems = compare(result, json.load(file), args.tolerance)
+        if problems:
+            print("\n❌ Регрессия: " + '; '.join(problems))
+            sys.exit(1)
+        print("\n✅ Без регрессий относительно базового замера")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Замер памяти на одного игрока
+
+Создает N синтетических игроков и считает, сколько байт приходится на
+одного: по tracemalloc (только Python-аллокации) и по росту RSS процесса.
+Каждый замер идет в отдельном процессе, чтобы освобожденная память
+предыдущего замера не искажала RSS. Для сравнения меряет и старую модель
+игрока (обычный класс с __dict__, datetime и пустым инвентарем у каждого).
+
+Запуск:
+    python bench_memory.py
+    python bench_memory.py 10000 100000 1000000
+"""
+import gc
+import sys
+import subprocess
+import datetime
+import tracemalloc
+
+import psutil
+
+from main import TempUser
+
+class LegacyUser:
+    """Модель игрока до перехода на слоты (для сравнения)"""
+
+    def __init__(self, user_id, username, first_name):
+        self.user_id = user_id
+        self.username = username
+        self.first_name = first_name
+        self.level = 1
+        self.exp = 0
+        self.class_name = 'воин'
+        self.hp = 100
+        self.max_hp = 100
+        self.attack = 10
+        self.defense = 5
+        self.balance = 100
+        self.kills = 0
+        self.deaths = 0
+        self.rating = 0
+        self.in_battle = False
+        self.battle_with = None
+        self.battle_hp = None
+        self.inventory = {}
+        self.last_daily = None
+        self.daily_streak = 0
+        self.created_at = datetime.datetime.now()
+        self.last_active = datetime.datetime.now()
+
+def make_players(model, count):
+    players = {}
+    for i in range(count):
+        user_id = 100_000_000 + i
+        user = model(user_id, f'player{i}', f'Игрок {i}')
+        user.exp = i % 5000
+        user.balance = 100 + i % 10_000
+        players[user_id] = user
+    return players
+
+MODELS = {'TempUser': TempUser, 'legacy': LegacyUser}
+
+def measure(model, count):
+    """Возвращает (байт на игрока по tracemalloc, байт на игрока по RSS)"""
+    gc.collect()
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+    players = make_players(model, count)
+    rss = (process.memory_info().rss - rss_before) / count
+    del players
+    gc.collect()
+
+    tracemalloc.start()
+    # Ссылка держит игроков живыми, пока читается текущий объем памяти
+    players = make_players(model, count)
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del players
+    return traced / count, rss
+
+def main():
+    if sys.argv[1:2] == ['--one']:
+        traced, rss = measure(MODELS[sys.argv[2]], int(sys.argv[3]))
+        print(f"{traced:.0f} {rss:.0f}")
+        return
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+
+    print(f"{'игроков':>10} | {'модель':<10} | {'байт/игрок':>10} | {'RSS байт/игрок':>14}")
+    print('-' * 54)
+    for count in sizes:
+        for name in MODELS:
+            output = subprocess.run(
+                [sys.executable, __file__, '--one', name, str(count)],
+                capture_output=True, text=True, check=True,
+            ).stdout.split()
+            traced, rss = float(output[-2]), float(output[-1])
+            print(f"{count:>10,} | {name:<10} | {traced:>10.0f} | {rss:>14.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,55 @@
 import logging
 import os
+import io
+import sys
+import hmac
+import threading
 import json
+import shutil
+import mmap
+import zlib
+import struct
 import random
+import asyncio
+import contextlib
+import bisect
+import textwrap
+import functools
+import heapq
+import itertools
+from array import array
+import time
+import signal
+import traceback
+import hashlib
 import datetime
+import multiprocessing
+import csv
+import gzip
 import platform
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import psutil
-from flask import Flask
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from aiohttp import web
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
-    CallbackQueryHandler, ConversationHandler, 
-    filters, ContextTypes
+    CallbackQueryHandler, 
+    filters, ContextTypes, BaseRateLimiter
+)
+from sqlalchemy import (
+    MetaData, Table, Column, BigInteger, Integer, String,
+    Boolean, DateTime, Date, JSON, select, func, bindparam, inspect, text
+)
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from telegram.error import TelegramError, RetryAfter, Forbidden
+from prometheus_client import (
+    REGISTRY, CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess
 )
 from dotenv import load_dotenv
 
@@ -28,9 +67,58 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_IDS = [int(id) for id in os.getenv('ADMIN_IDS', '').split(',') if id]
 OWNER_ID = int(os.getenv('OWNER_ID', 0))
+# Токен для админских HTTP маршрутов (/admin/...), без него они выключены
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+# Настройки хранилища: локально SQLite, на Koyeb - PostgreSQL
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite+aiosqlite:///rucoy.db')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+PLAYER_CACHE_SIZE = int(os.getenv('PLAYER_CACHE_SIZE', 10_000))
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', 500))
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL', 2.0))
+# По сколько записей строится рейтинг при старте между передачами управления
+LEADERBOARD_LOAD_CHUNK = int(os.getenv('LEADERBOARD_LOAD_CHUNK', 10_000))
+# memory - пул в памяти процесса, sql - атомарный UPDATE в БД (для нескольких воркеров)
+POOL_BACKEND = os.getenv('POOL_BACKEND', 'memory')
+# sql - Storage через SQLAlchemy, snapshot - снимок и журнал на диске (один процесс, без БД)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sql')
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', 'data')
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', 300))
+JOURNAL_FSYNC_INTERVAL = float(os.getenv('JOURNAL_FSYNC_INTERVAL', 1.0))
+JOURNAL_MAX_BYTES = int(os.getenv('JOURNAL_MAX_BYTES', 64 * 2**20))
+
+# Вебхук и масштабирование на несколько процессов
+# polling - long polling (по умолчанию), webhook - прием обновлений на WEBHOOK_PATH
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+WORKERS = int(os.getenv('WORKERS', 1))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256((BOT_TOKEN or '').encode()).hexdigest()[:32]
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+# Сколько обновлений обрабатывать параллельно (действия одного игрока все равно идут по очереди)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', 64))
+
+# Зерно общего генератора случайностей (пусто - случайное при каждом запуске)
+RNG_SEED = int(os.getenv('RNG_SEED')) if os.getenv('RNG_SEED') else None
+
+# Брошенный бой закрывается через BATTLE_TTL секунд после последнего хода
+BATTLE_TTL = int(os.getenv('BATTLE_TTL', 600))
+BATTLE_SWEEP_INTERVAL = int(os.getenv('BATTLE_SWEEP_INTERVAL', 30))
+
+# Адрес Bot API: можно указать свой сервер telegram-bot-api или заглушку из bench_load.py
+TG_API_URL = os.getenv('TG_API_URL', 'https://api.telegram.org/bot')
+
+# Лимиты исходящих запросов к Bot API (чуть ниже официальных 30/сек и 1/сек на чат)
+TG_GLOBAL_RATE = float(os.getenv('TG_GLOBAL_RATE', 28))
+TG_CHAT_RATE = float(os.getenv('TG_CHAT_RATE', 1.0))
+TG_CHAT_BURST = int(os.getenv('TG_CHAT_BURST', 3))
+TG_GROUP_RATE = float(os.getenv('TG_GROUP_RATE', 20 / 60))
+TG_MAX_RETRIES = int(os.getenv('TG_MAX_RETRIES', 3))
 
-# Состояния для ConversationHandler
-CHOOSING_CLASS, IN_BATTLE, WITHDRAW_AMOUNT = range(3)
+# Приоритеты исходящих сообщений (меньше - раньше), передаются через rate_limit_args
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BROADCAST = 10
 
 # Настройки игры
 START_BALANCE = 100
@@ -39,90 +127,183 @@ START_ATTACK = 10
 START_DEFENSE = 5
 START_LEVEL = 1
 START_EXP = 0
+# Прирост характеристик за уровень и цена воскрешения (их же берет simulate.py)
+HP_PER_LEVEL = 20
+ATTACK_PER_LEVEL = 3
+DEFENSE_PER_LEVEL = 2
+REVIVE_COST = 50
 
 # Настройки пула наград
 DEFAULT_TOTAL_POOL = 1_000_000
 DEFAULT_DAILY_POOL = 10_000
+# Время (ЧЧ:ММ, местное) ежедневного сброса дневного лимита
+POOL_RESET_TIME = datetime.time.fromisoformat(os.getenv('POOL_RESET_TIME', '00:00'))
+# Начальный потолок раздачи монет в секунду на все воркеры (0 - без потолка), потом хранится в пуле и меняется /pool rate
+POOL_MAX_RATE = int(os.getenv('POOL_MAX_RATE', 0))
+# Сколько последних секунд хранит ряд расхода пула
+POOL_RATE_WINDOW = int(os.getenv('POOL_RATE_WINDOW', 300))
+# Отложенные действия с пулом (/pool schedule), переживают рестарт
+POOL_SCHEDULE_PATH = os.getenv('POOL_SCHEDULE_PATH', 'pool_schedule.json')
 
-# Монстры с диапазонами наград
-MONSTERS = {
-    1: {
-        'name': '🐗 Кабан', 
-        'level': 1, 
-        'hp': 50, 
-        'attack': 8, 
-        'defense': 2, 
-        'exp': 20, 
-        'coins_range': (10, 25),
-        'drop': 'Шкура кабана',
-        'drop_chance': 0.3
-    },
-    2: {
-        'name': '🐺 Волк', 
-        'level': 3, 
-        'hp': 80, 
-        'attack': 12, 
-        'defense': 3, 
-        'exp': 35, 
-        'coins_range': (20, 45),
-        'drop': 'Клык волка',
-        'drop_chance': 0.35
-    },
-    3: {
-        'name': '🐻 Медведь', 
-        'level': 5, 
-        'hp': 150, 
-        'attack': 18, 
-        'defense': 5, 
-        'exp': 60, 
-        'coins_range': (40, 80),
-        'drop': 'Медвежья шкура',
-        'drop_chance': 0.4
-    },
-    4: {
-        'name': '👹 Огр', 
-        'level': 8, 
-        'hp': 250, 
-        'attack': 25, 
-        'defense': 8, 
-        'exp': 100, 
-        'coins_range': (80, 150),
-        'drop': 'Дубина огра',
-        'drop_chance': 0.45
-    },
-    5: {
-        'name': '🐉 Дракон', 
-        'level': 12, 
-        'hp': 500, 
-        'attack': 40, 
-        'defense': 15, 
-        'exp': 300, 
-        'coins_range': (200, 500),
-        'drop': 'Чешуя дракона',
-        'drop_chance': 0.5
-    },
-}
+# ============== КОНТЕНТ ==============
+# Монстры, классы и дропы описаны в CONTENT_PATH (JSON с полем version).
+# Файл проверяется целиком и только потом подменяет текущий контент, поэтому
+# баланс можно править на ходу: бот перечитывает файл при изменении
+# (раз в CONTENT_WATCH_INTERVAL) или по команде владельца /reload.
 
-# Классы персонажей
-CLASSES = {
-    'воин': {'hp_bonus': 20, 'attack_bonus': 5, 'defense_bonus': 10},
-    'лучник': {'hp_bonus': 10, 'attack_bonus': 10, 'defense_bonus': 5},
-    'маг': {'hp_bonus': 5, 'attack_bonus': 15, 'defense_bonus': 5}
-}
+CONTENT_PATH = os.getenv('CONTENT_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'content.json'))
+CONTENT_WATCH_INTERVAL = float(os.getenv('CONTENT_WATCH_INTERVAL', 5))
+
+# Telegram ограничивает callback_data 64 байтами
+CALLBACK_DATA_LIMIT = 64
+
+class ContentError(ValueError):
+    """Файл контента не прошел проверку"""
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _check(condition, message):
+    if not condition:
+        raise ContentError(message)
+
+def _parse_monster(raw, where, monsters):
+    _check(isinstance(raw, dict), f"{where}: ожидается объект")
+    monster_id = raw.get('id')
+    _check(_is_int(monster_id) and monster_id > 0, f"{where}.id: нужно целое число > 0")
+    _check(monster_id not in monsters, f"{where}.id: монстр {monster_id} уже есть")
+    _check(isinstance(raw.get('name'), str) and raw['name'], f"{where}.name: нужна строка")
+    for field, minimum in (('level', 1), ('hp', 1), ('attack', 0), ('defense', 0), ('exp', 0)):
+        _check(_is_int(raw.get(field)) and raw[field] >= minimum, f"{where}.{field}: нужно целое число >= {minimum}")
+    
+    coins = raw.get('coins_range')
+    _check(
+        isinstance(coins, list) and len(coins) == 2 and all(_is_int(c) and c >= 0 for c in coins)
+        and coins[0] <= coins[1],
+        f"{where}.coins_range: нужно [минимум, максимум]",
+    )
+    drop = raw.get('drop')
+    _check(drop is None or isinstance(drop, str) and drop, f"{where}.drop: строка или null")
+    chance = raw.get('drop_chance', 0)
+    _check(
+        isinstance(chance, (int, float)) and not isinstance(chance, bool) and 0 <= chance <= 1,
+        f"{where}.drop_chance: число от 0 до 1",
+    )
+    return monster_id, {
+        'name': raw['name'],
+        'level': raw['level'],
+        'hp': raw['hp'],
+        'attack': raw['attack'],
+        'defense': raw['defense'],
+        'exp': raw['exp'],
+        'coins_range': (coins[0], coins[1]),
+        'drop': drop,
+        'drop_chance': float(chance) if drop else 0.0,
+    }
+
+def _parse_class(raw, where, classes):
+    _check(isinstance(raw, dict), f"{where}: ожидается объект")
+    class_name = raw.get('id')
+    _check(isinstance(class_name, str) and class_name, f"{where}.id: нужна строка")
+    _check(class_name not in classes, f"{where}.id: класс {class_name} уже есть")
+    _check(
+        len(f"class_{class_name}".encode()) <= CALLBACK_DATA_LIMIT,
+        f"{where}.id: слишком длинное для кнопки",
+    )
+    _check(isinstance(raw.get('title'), str) and raw['title'], f"{where}.title: нужна строка")
+    for field in ('hp_bonus', 'attack_bonus', 'defense_bonus'):
+        _check(_is_int(raw.get(field)), f"{where}.{field}: нужно целое число")
+    return class_name, {
+        'title': raw['title'],
+        'hp_bonus': raw['hp_bonus'],
+        'attack_bonus': raw['attack_bonus'],
+        'defense_bonus': raw['defense_bonus'],
+    }
+
+def parse_content(data):
+    """Проверяет контент, возвращает (version, MONSTERS, CLASSES)"""
+    _check(isinstance(data, dict), "ожидается объект JSON")
+    version = data.get('version')
+    _check(_is_int(version) and version > 0, "version: нужно целое число > 0")
+    
+    monsters = {}
+    for i, raw in enumerate(data.get('monsters') or []):
+        monster_id, monster = _parse_monster(raw, f"monsters[{i}]", monsters)
+        monsters[monster_id] = monster
+    _check(
+        any(monster['level'] - 2 <= START_LEVEL for monster in monsters.values()),
+        "monsters: нужен хотя бы один монстр для первого уровня",
+    )
+    
+    classes = {}
+    for i, raw in enumerate(data.get('classes') or []):
+        class_name, player_class = _parse_class(raw, f"classes[{i}]", classes)
+        classes[class_name] = player_class
+    _check(classes, "classes: нужен хотя бы один класс")
+    
+    return version, monsters, classes
+
+def load_content(path=CONTENT_PATH):
+    with open(path, encoding='utf-8') as file:
+        try:
+            data = json.load(file)
+        except ValueError as exc:
+            raise ContentError(f"не JSON: {exc}") from None
+    return parse_content(data)
+
+CONTENT_VERSION, MONSTERS, CLASSES = load_content()
+
+# ============== СОСТОЯНИЕ ПУЛА ==============
+
+def pool_day(now=None):
+    """День пула: сменяется в POOL_RESET_TIME, а не в полночь"""
+    now = now or datetime.datetime.now()
+    if now.time() < POOL_RESET_TIME:
+        return now.date() - datetime.timedelta(days=1)
+    return now.date()
+
+def next_pool_reset(now=None):
+    now = now or datetime.datetime.now()
+    reset = datetime.datetime.combine(now.date(), POOL_RESET_TIME)
+    if reset <= now:
+        reset += datetime.timedelta(days=1)
+    return reset
 
-# ============== ВРЕМЕННАЯ БАЗА ДАННЫХ В ПАМЯТИ (для теста) ==============
-# ВНИМАНИЕ: Это временное решение! На Koyeb нужно будет подключить PostgreSQL
-users_db = {}
+# Рабочая копия пула в памяти, при старте загружается из хранилища
 reward_pool = {
     'total_pool': DEFAULT_TOTAL_POOL,
     'distributed_today': 0,
     'max_daily_pool': DEFAULT_DAILY_POOL,
-    'last_reset': datetime.datetime.now().date(),
-    'enabled': True
+    # День пула, а не календарный: иначе при POOL_RESET_TIME позже текущего
+    # времени первый сброс на новой установке пропускается
+    'last_reset': pool_day(),
+    'enabled': True,
+    'max_rate': POOL_MAX_RATE,
 }
 
+def _to_timestamp(value):
+    return int(value.timestamp()) if value is not None else None
+
+def _from_timestamp(value):
+    return datetime.datetime.fromtimestamp(value) if value is not None else None
+
 class TempUser:
+    """Игрок
+
+    Слоты вместо __dict__, время хранится целыми секундами, а словарь
+    инвентаря создается только при первом дропе: при сотнях тысяч
+    игроков это заметно экономит память.
+    """
+
+    __slots__ = (
+        'user_id', 'username', 'first_name', 'level', 'exp', 'class_name',
+        'hp', 'max_hp', 'attack', 'defense', 'balance', 'kills', 'deaths',
+        'rating', 'daily_streak', '_inventory', '_last_daily', '_created_at',
+        '_last_active',
+    )
+
     def __init__(self, user_id, username, first_name):
+        now = int(time.time())
         self.user_id = user_id
         self.username = username
         self.first_name = first_name
@@ -137,78 +318,1593 @@ class TempUser:
         self.kills = 0
         self.deaths = 0
         self.rating = 0
-        self.in_battle = False
-        self.battle_with = None
-        self.battle_hp = None
-        self.inventory = {}
-        self.last_daily = None
+        self._inventory = None
+        self._last_daily = None
         self.daily_streak = 0
-        self.created_at = datetime.datetime.now()
-        self.last_active = datetime.datetime.now()
+        self._created_at = now
+        self._last_active = now
+
+    @property
+    def inventory(self):
+        """Предметы игрока {название: количество}"""
+        return self._inventory if self._inventory is not None else {}
+
+    @inventory.setter
+    def inventory(self, value):
+        self._inventory = dict(value) if value else None
+
+    def add_item(self, item, count=1):
+        if self._inventory is None:
+            self._inventory = {}
+        self._inventory[item] = self._inventory.get(item, 0) + count
+
+    @property
+    def last_daily(self):
+        return _from_timestamp(self._last_daily)
+
+    @last_daily.setter
+    def last_daily(self, value):
+        self._last_daily = _to_timestamp(value)
+
+    @property
+    def created_at(self):
+        return _from_timestamp(self._created_at)
+
+    @created_at.setter
+    def created_at(self, value):
+        self._created_at = _to_timestamp(value)
+
+    @property
+    def last_active(self):
+        return _from_timestamp(self._last_active)
+
+    @last_active.setter
+    def last_active(self, value):
+        self._last_active = _to_timestamp(value)
+
+    def touch(self):
+        self._last_active = int(time.time())
+
+# ============== ХРАНИЛИЩЕ ==============
+
+metadata = MetaData()
+
+players_table = Table(
+    'players', metadata,
+    Column('user_id', BigInteger, primary_key=True, autoincrement=False),
+    Column('username', String(64)),
+    Column('first_name', String(128)),
+    Column('level', Integer, nullable=False, default=START_LEVEL),
+    Column('exp', BigInteger, nullable=False, default=START_EXP),
+    Column('class_name', String(32), nullable=False),
+    Column('hp', Integer, nullable=False),
+    Column('max_hp', Integer, nullable=False),
+    Column('attack', Integer, nullable=False),
+    Column('defense', Integer, nullable=False),
+    Column('balance', BigInteger, nullable=False, default=START_BALANCE),
+    Column('kills', Integer, nullable=False, default=0),
+    Column('deaths', Integer, nullable=False, default=0),
+    Column('rating', Integer, nullable=False, default=0, index=True),
+    Column('inventory', JSON, nullable=False, default=dict),
+    Column('last_daily', DateTime),
+    Column('daily_streak', Integer, nullable=False, default=0),
+    Column('created_at', DateTime, nullable=False),
+    Column('last_active', DateTime, nullable=False),
+)
+
+reward_pool_table = Table(
+    'reward_pool', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('total_pool', BigInteger, nullable=False),
+    Column('distributed_today', BigInteger, nullable=False),
+    Column('max_daily_pool', BigInteger, nullable=False),
+    Column('last_reset', Date, nullable=False),
+    Column('enabled', Boolean, nullable=False),
+    Column('max_rate', BigInteger, nullable=False, default=0),
+)
+
+# Поля TempUser, которые сохраняются в таблицу players
+PLAYER_FIELDS = tuple(column.name for column in players_table.columns)
+POOL_FIELDS = ('total_pool', 'distributed_today', 'max_daily_pool', 'last_reset', 'enabled', 'max_rate')
+
+def normalize_database_url(url):
+    """Приводит DATABASE_URL к асинхронному драйверу SQLAlchemy"""
+    for prefix in ('postgres://', 'postgresql://', 'postgresql+psycopg2://'):
+        if url.startswith(prefix):
+            return 'postgresql+asyncpg://' + url[len(prefix):]
+    if url.startswith('sqlite://'):
+        return 'sqlite+aiosqlite://' + url[len('sqlite://'):]
+    return url
+
+def user_to_row(user):
+    return {field: getattr(user, field) for field in PLAYER_FIELDS}
+
+def user_from_row(row):
+    user = TempUser(row.user_id, row.username, row.first_name)
+    for field in PLAYER_FIELDS:
+        setattr(user, field, getattr(row, field))
+    return user
+
+class Storage:
+    """Асинхронное хранилище игроков и пула (SQLite локально, PostgreSQL в проде)"""
+
+    def __init__(self, url=DATABASE_URL):
+        self.url = normalize_database_url(url)
+        options = {}
+        if self.url.startswith('sqlite'):
+            # Несколько соединений к одному файлу ждут блокировку, а не падают сразу
+            options.update(connect_args={'timeout': 30})
+        else:
+            options.update(
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_MAX_OVERFLOW,
+                pool_pre_ping=True,
+                pool_recycle=1800,
+            )
+        self.engine = create_async_engine(self.url, **options)
+        self.dialect = self.engine.dialect.name
+
+    async def init(self):
+        async with self.engine.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+            # create_all не добавляет индексы в уже существующие таблицы
+            for index in players_table.indexes:
+                await conn.run_sync(index.create, checkfirst=True)
+            # ... и новые колонки тоже
+            columns = await conn.run_sync(
+                lambda sync_conn: {column['name'] for column in inspect(sync_conn).get_columns('reward_pool')}
+            )
+            if 'max_rate' not in columns:
+                await conn.execute(text(
+                    f"ALTER TABLE reward_pool ADD COLUMN max_rate BIGINT NOT NULL DEFAULT {POOL_MAX_RATE}"
+                ))
+
+    async def close(self):
+        await self.engine.dispose()
+
+    def _insert(self, table):
+        if self.dialect == 'postgresql':
+            return pg_insert(table)
+        return sqlite_insert(table)
+
+    async def load_player(self, user_id):
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                select(players_table).where(players_table.c.user_id == user_id)
+            )
+            row = result.first()
+        return user_from_row(row) if row is not None else None
+
+    async def insert_player(self, user):
+        """Создает игрока, возвращает False если он уже есть"""
+        stmt = self._insert(players_table).values(user_to_row(user))
+        stmt = stmt.on_conflict_do_nothing(index_elements=['user_id'])
+        async with self.engine.begin() as conn:
+            result = await conn.execute(stmt)
+        return result.rowcount == 1
+
+    async def save_players(self, users):
+        """Пакетное обновление игроков одним executemany"""
+        if not users:
+            return
+        rows = []
+        for user in users:
+            row = user_to_row(user)
+            row['b_user_id'] = row.pop('user_id')
+            rows.append(row)
+        stmt = players_table.update().where(players_table.c.user_id == bindparam('b_user_id'))
+        async with self.engine.begin() as conn:
+            await conn.execute(stmt, rows)
+
+    async def upsert_players(self, users):
+        """Пакетная загрузка: новые игроки добавляются, существующие перезаписываются"""
+        if not users:
+            return
+        stmt = self._insert(players_table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id'],
+            set_={field: stmt.excluded[field] for field in PLAYER_FIELDS if field != 'user_id'},
+        )
+        async with self.engine.begin() as conn:
+            await conn.execute(stmt, [user_to_row(user) for user in users])
+
+    async def load_players(self):
+        """Потоково читает всех игроков по порядку user_id"""
+        query = select(players_table).order_by(players_table.c.user_id)
+        async with self.engine.connect() as conn:
+            result = await conn.stream(query)
+            async for rows in result.partitions(10_000):
+                for row in rows:
+                    yield user_from_row(row)
+
+    async def load_ratings(self):
+        """Потоково читает (user_id, rating) по индексу рейтинга"""
+        query = select(players_table.c.user_id, players_table.c.rating).order_by(players_table.c.rating)
+        async with self.engine.connect() as conn:
+            result = await conn.stream(query)
+            async for rows in result.partitions(10_000):
+                for user_id, rating in rows:
+                    yield user_id, rating
+
+    async def top_by_rating(self, n):
+        """(user_id, first_name, level, rating, balance) лучших n игроков"""
+        columns = players_table.c
+        query = (
+            select(columns.user_id, columns.first_name, columns.level, columns.rating, columns.balance)
+            .order_by(players_table.c.rating.desc(), players_table.c.user_id)
+            .limit(n)
+        )
+        async with self.engine.connect() as conn:
+            result = await conn.execute(query)
+            return [tuple(row) for row in result]
+
+    async def count_rated_above(self, rating):
+        query = select(func.count()).select_from(players_table).where(players_table.c.rating > rating)
+        async with self.engine.connect() as conn:
+            result = await conn.execute(query)
+            return result.scalar_one()
+
+    async def count_players(self):
+        async with self.engine.connect() as conn:
+            result = await conn.execute(select(func.count()).select_from(players_table))
+            return result.scalar_one()
+
+    async def player_columns(self):
+        """Источник для задач в пуле процессов: таблицу читает уже процесс пула"""
+        return ('database', self.url)
+
+    async def user_ids_after(self, after, limit):
+        """Следующие limit id игроков после after (по первичному ключу)"""
+        query = (
+            select(players_table.c.user_id)
+            .where(players_table.c.user_id > after)
+            .order_by(players_table.c.user_id)
+            .limit(limit)
+        )
+        async with self.engine.connect() as conn:
+            result = await conn.execute(query)
+            return [row[0] for row in result]
+
+    async def load_pool(self):
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                select(reward_pool_table).where(reward_pool_table.c.id == 1)
+            )
+            row = result.first()
+        if row is None:
+            return None
+        return {field: getattr(row, field) for field in POOL_FIELDS}
+
+    async def _update_pool(self, conditions, values):
+        """Условный UPDATE пула, возвращает новое состояние или None"""
+        pool = reward_pool_table.c
+        stmt = (
+            reward_pool_table.update()
+            .where(pool.id == 1, *conditions)
+            .values(**values)
+            .returning(*(pool[field] for field in POOL_FIELDS))
+        )
+        async with self.engine.begin() as conn:
+            row = (await conn.execute(stmt)).first()
+        return dict(zip(POOL_FIELDS, row)) if row is not None else None
+
+    async def reserve_pool(self, amount):
+        """Условное списание из пула, возвращает (успех, состояние пула)"""
+        pool = reward_pool_table.c
+        updated = await self._update_pool(
+            (
+                pool.enabled.is_(True),
+                pool.total_pool >= amount,
+                pool.distributed_today + amount <= pool.max_daily_pool,
+            ),
+            {
+                'total_pool': pool.total_pool - amount,
+                'distributed_today': pool.distributed_today + amount,
+            },
+        )
+        if updated is not None:
+            return True, updated
+        return False, await self.load_pool()
+
+    async def reset_pool_day(self, today):
+        """Обнуляет дневной расход, если сегодня сброса еще не было"""
+        pool = reward_pool_table.c
+        return await self._update_pool(
+            (pool.last_reset < today,), {'distributed_today': 0, 'last_reset': today}
+        )
+
+    async def refill_pool(self, amount):
+        return await self._update_pool((), {'total_pool': reward_pool_table.c.total_pool + amount})
+
+    async def configure_pool(self, values):
+        return await self._update_pool((), values)
+
+    async def save_pool(self, pool):
+        values = {field: pool[field] for field in POOL_FIELDS}
+        stmt = self._insert(reward_pool_table).values(id=1, **values)
+        stmt = stmt.on_conflict_do_update(index_elements=['id'], set_=values)
+        async with self.engine.begin() as conn:
+            await conn.execute(stmt)
+
+# ============== СНИМОК И ЖУРНАЛ ==============
+# Хранилище без БД: двоичный снимок всех игроков плюс журнал изменений.
+# Снимок открывается через mmap и целиком не разбирается - игрок ищется
+# двоичным поиском по индексу, поэтому старт почти не зависит от числа
+# игроков. Каждое сохранение дописывается в журнал, журнал сбрасывается на
+# диск раз в JOURNAL_FSYNC_INTERVAL и при старте проигрывается поверх снимка.
+# В журнал пишется состояние игрока после события (убийство, награда,
+# ежедневный бонус, воскрешение), поэтому повторное проигрывание безопасно.
+
+# user_id, level, exp, hp, max_hp, attack, defense, balance, kills, deaths,
+# rating, daily_streak, last_daily, created_at, last_active
+PLAYER_RECORD = struct.Struct('<qiqiiiiqiiiiqqq')
+RATING_OFFSET = struct.calcsize('<qiqiiiiqii')
+RATING_FIELD = struct.Struct('<i')
+# total_pool, distributed_today, max_daily_pool, last_reset (номер дня), enabled, max_rate
+POOL_RECORD = struct.Struct('<qqqi?q')
+# Запись пула в снимках версии 1 и старых журналах - без max_rate
+POOL_RECORD_V1 = struct.Struct('<qqqi?')
+# сигнатура, версия, число игроков, смещение индекса
+SNAPSHOT_HEADER = struct.Struct('<4sIQQ')
+# user_id, rating, смещение записи игрока
+SNAPSHOT_INDEX = struct.Struct('<qiQ')
+# тип записи, длина, crc32
+JOURNAL_HEADER = struct.Struct('<BII')
+TEXT_LENGTH = struct.Struct('<H')
+
+SNAPSHOT_MAGIC = b'RCYS'
+SNAPSHOT_VERSION = 2
+JOURNAL_PLAYER = 1
+JOURNAL_POOL = 2
+NO_TEXT = 0xFFFF
+NO_TIME = -1
+
+def _pack_text(value):
+    if value is None:
+        return TEXT_LENGTH.pack(NO_TEXT)
+    data = value.encode()
+    return TEXT_LENGTH.pack(len(data)) + data
+
+def _unpack_text(buffer, offset):
+    (length,) = TEXT_LENGTH.unpack_from(buffer, offset)
+    offset += TEXT_LENGTH.size
+    if length == NO_TEXT:
+        return None, offset
+    return bytes(buffer[offset:offset + length]).decode(), offset + length
+
+def encode_player(user):
+    inventory = json.dumps(user._inventory, ensure_ascii=False) if user._inventory else None
+    return b''.join((
+        PLAYER_RECORD.pack(
+            user.user_id, user.level, user.exp, user.hp, user.max_hp, user.attack,
+            user.defense, user.balance, user.kills, user.deaths, user.rating, user.daily_streak,
+            NO_TIME if user._last_daily is None else user._last_daily,
+            user._created_at, user._last_active,
+        ),
+        _pack_text(user.username),
+        _pack_text(user.first_name),
+        _pack_text(user.class_name),
+        _pack_text(inventory),
+    ))
+
+def decode_player(buffer, offset=0):
+    (user_id, level, exp, hp, max_hp, attack, defense, balance, kills, deaths,
+     rating, daily_streak, last_daily, created_at, last_active) = PLAYER_RECORD.unpack_from(buffer, offset)
+    offset += PLAYER_RECORD.size
+    username, offset = _unpack_text(buffer, offset)
+    first_name, offset = _unpack_text(buffer, offset)
+    class_name, offset = _unpack_text(buffer, offset)
+    inventory, offset = _unpack_text(buffer, offset)
+    
+    user = TempUser(user_id, username, first_name)
+    user.level = level
+    user.exp = exp
+    user.class_name = class_name
+    user.hp = hp
+    user.max_hp = max_hp
+    user.attack = attack
+    user.defense = defense
+    user.balance = balance
+    user.kills = kills
+    user.deaths = deaths
+    user.rating = rating
+    user.daily_streak = daily_streak
+    user._inventory = json.loads(inventory) if inventory else None
+    user._last_daily = None if last_daily == NO_TIME else last_daily
+    user._created_at = created_at
+    user._last_active = last_active
+    return user
+
+def encode_pool(pool):
+    return POOL_RECORD.pack(
+        pool['total_pool'], pool['distributed_today'], pool['max_daily_pool'],
+        pool['last_reset'].toordinal(), pool['enabled'], pool['max_rate'],
+    )
+
+def decode_pool(buffer, offset=0):
+    if len(buffer) - offset == POOL_RECORD_V1.size:
+        total_pool, distributed_today, max_daily_pool, last_reset, enabled = POOL_RECORD_V1.unpack_from(buffer, offset)
+        max_rate = POOL_MAX_RATE
+    else:
+        total_pool, distributed_today, max_daily_pool, last_reset, enabled, max_rate = POOL_RECORD.unpack_from(buffer, offset)
+    return {
+        'total_pool': total_pool,
+        'distributed_today': distributed_today,
+        'max_daily_pool': max_daily_pool,
+        'last_reset': datetime.date.fromordinal(last_reset),
+        'enabled': enabled,
+        'max_rate': max_rate,
+    }
+
+def open_snapshot(path):
+    """Отображает файл снимка в память: (mmap, число игроков, смещение индекса, пул)"""
+    with open(path, 'rb') as file:
+        snapshot = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, count, index_offset = SNAPSHOT_HEADER.unpack_from(snapshot)
+    if magic != SNAPSHOT_MAGIC or version not in (1, SNAPSHOT_VERSION):
+        snapshot.close()
+        raise RuntimeError(f"{path}: неизвестный формат снимка")
+    pool_size = POOL_RECORD_V1.size if version == 1 else POOL_RECORD.size
+    pool = snapshot[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + pool_size]
+    return snapshot, count, index_offset, pool
+
+def snapshot_entries(snapshot, count, index_offset):
+    """(user_id, rating, начало, конец записи) из снимка по порядку user_id"""
+    if snapshot is None or not count:
+        return
+    with memoryview(snapshot) as view, view[index_offset:index_offset + count * SNAPSHOT_INDEX.size] as index:
+        previous = None
+        for entry in SNAPSHOT_INDEX.iter_unpack(index):
+            if previous is not None:
+                yield previous + (entry[2],)
+            previous = entry
+        yield previous + (index_offset,)
+
+def write_snapshot(directory, snapshot_path, changed, pool):
+    """Сливает старый снимок с измененными игроками в новый файл
+
+    Выполняется в пуле процессов: старый снимок открывается здесь заново,
+    из главного процесса приходят только измененные записи и пул.
+    """
+    path = snapshot_path + '.tmp'
+    index = bytearray()
+    changed_ids = sorted(changed)
+    if os.path.exists(snapshot_path):
+        snapshot, count, index_offset, _ = open_snapshot(snapshot_path)
+    else:
+        snapshot, count, index_offset = None, 0, 0
+    
+    with open(path, 'wb') as file:
+        file.write(bytes(SNAPSHOT_HEADER.size))
+        file.write(pool)
+        position = SNAPSHOT_HEADER.size + len(pool)
+        
+        def write(user_id, rating, record):
+            nonlocal position
+            index.extend(SNAPSHOT_INDEX.pack(user_id, rating, position))
+            file.write(record)
+            position += len(record)
+        
+        def write_changed(user_id):
+            record = changed[user_id]
+            write(user_id, RATING_FIELD.unpack_from(record, RATING_OFFSET)[0], record)
+        
+        i = 0
+        with memoryview(snapshot) if snapshot is not None else contextlib.nullcontext() as view:
+            for user_id, rating, start, end in snapshot_entries(snapshot, count, index_offset):
+                while i < len(changed_ids) and changed_ids[i] < user_id:
+                    write_changed(changed_ids[i])
+                    i += 1
+                if i < len(changed_ids) and changed_ids[i] == user_id:
+                    write_changed(user_id)
+                    i += 1
+                else:
+                    write(user_id, rating, view[start:end])
+        if snapshot is not None:
+            snapshot.close()
+        for user_id in changed_ids[i:]:
+            write_changed(user_id)
+        
+        file.write(index)
+        file.seek(0)
+        file.write(SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(index) // SNAPSHOT_INDEX.size, position
+        ))
+        file.flush()
+        os.fsync(file.fileno())
+    
+    os.replace(path, snapshot_path)
+    directory = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+class SnapshotStorage:
+    """Хранилище на снимке и журнале (только для одного процесса)
+
+    Поверх снимка лежит словарь измененных игроков user_id -> закодированная
+    запись: туда попадают сохранения и проигранный при старте журнал. Раз в
+    SNAPSHOT_INTERVAL или когда журнал дорастает до JOURNAL_MAX_BYTES, снимок
+    пересобирается в пуле процессов, а журнал начинается заново. При потере
+    питания теряется не больше JOURNAL_FSYNC_INTERVAL последних изменений.
+    """
+
+    def __init__(self, directory=SNAPSHOT_DIR, fsync_interval=JOURNAL_FSYNC_INTERVAL,
+                 snapshot_interval=SNAPSHOT_INTERVAL, journal_max_bytes=JOURNAL_MAX_BYTES):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, 'players.snap')
+        self.journal_path = os.path.join(directory, 'journal.log')
+        # Журнал, который сейчас переносится в новый снимок
+        self.rotated_path = self.journal_path + '.1'
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.journal_max_bytes = journal_max_bytes
+        
+        self._map = None
+        self._count = 0
+        self._index_offset = 0
+        self._changed = {}
+        self._pool = None
+        self._total = 0
+        self._journal = None
+        self._journal_bytes = 0
+        self._last_snapshot = time.monotonic()
+        self._compact_lock = asyncio.Lock()
+        self._maintenance = None
+        self.replayed = 0
+
+    async def init(self):
+        os.makedirs(self.directory, exist_ok=True)
+        started = time.perf_counter()
+        
+        self._pool = self._open_snapshot()
+        self._total = self._count
+        crashed_compaction = os.path.exists(self.rotated_path)
+        for path in (self.rotated_path, self.journal_path):
+            self._replay(path)
+        
+        self._journal = open(self.journal_path, 'ab')
+        self._journal_bytes = self._journal.tell()
+        if crashed_compaction:
+            # Прошлая пересборка снимка не закончилась - доделываем ее
+            await self.compact()
+        
+        logger.info(
+            "Снимок: %s игроков, из журнала %s записей, загрузка %.1f мс",
+            self._total, self.replayed, (time.perf_counter() - started) * 1000,
+        )
+        self._maintenance = asyncio.create_task(self._maintain_forever())
+
+    async def close(self):
+        if self._maintenance is not None:
+            self._maintenance.cancel()
+            self._maintenance = None
+        # Свежий снимок - следующий старт без проигрывания журнала
+        if self._journal_bytes:
+            await self.compact()
+        self._journal.close()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _open_snapshot(self):
+        """Отображает снимок в память, возвращает сохраненный в нем пул"""
+        if not os.path.exists(self.snapshot_path):
+            self._map, self._count, self._index_offset = None, 0, 0
+            return None
+        
+        snapshot, count, index_offset, pool = open_snapshot(self.snapshot_path)
+        self._map, self._count, self._index_offset = snapshot, count, index_offset
+        # Пул из снимка версии 1 сразу переводим в текущий формат записи
+        return encode_pool(decode_pool(pool))
+
+    def _find(self, user_id):
+        """Смещение записи игрока в снимке (двоичный поиск по индексу)"""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            found, _, offset = SNAPSHOT_INDEX.unpack_from(
+                self._map, self._index_offset + middle * SNAPSHOT_INDEX.size
+            )
+            if found == user_id:
+                return offset
+            if found < user_id:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def _exists(self, user_id):
+        return user_id in self._changed or self._find(user_id) is not None
+
+    def _apply(self, kind, payload):
+        if kind == JOURNAL_PLAYER:
+            (user_id,) = struct.unpack_from('<q', payload)
+            if not self._exists(user_id):
+                self._total += 1
+            self._changed[user_id] = payload
+        elif kind == JOURNAL_POOL:
+            self._pool = encode_pool(decode_pool(payload))
+
+    def _replay(self, path):
+        """Проигрывает журнал, недописанный при сбое хвост отрезает"""
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as file:
+            data = file.read()
+        
+        offset = 0
+        while offset + JOURNAL_HEADER.size <= len(data):
+            kind, length, checksum = JOURNAL_HEADER.unpack_from(data, offset)
+            start = offset + JOURNAL_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break
+            self._apply(kind, payload)
+            self.replayed += 1
+            offset = start + length
+        
+        if offset < len(data):
+            logger.warning("Журнал %s обрезан до %s байт: последняя запись недописана", path, offset)
+            with open(path, 'r+b') as file:
+                file.truncate(offset)
+
+    def _append(self, kind, payload):
+        record = JOURNAL_HEADER.pack(kind, len(payload), zlib.crc32(payload)) + payload
+        self._journal.write(record)
+        self._journal_bytes += len(record)
+
+    async def sync(self):
+        """Сбрасывает журнал на диск"""
+        self._journal.flush()
+        await asyncio.get_running_loop().run_in_executor(None, os.fsync, self._journal.fileno())
+
+    async def _maintain_forever(self):
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            try:
+                await self.sync()
+                # Остановка бота не должна прервать запись снимка на середине
+                await asyncio.shield(self.maybe_compact())
+            except Exception:
+                logger.exception("Ошибка записи журнала")
+
+    async def maybe_compact(self):
+        """Пересобирает снимок, если журнал дорос до предела или подошел срок"""
+        due = time.monotonic() - self._last_snapshot >= self.snapshot_interval
+        if self._journal_bytes and (due or self._journal_bytes >= self.journal_max_bytes):
+            await self.compact()
+
+    def _rotate_journal(self):
+        """Новые изменения идут в новый журнал, пока старый переносится в снимок"""
+        self._journal.close()
+        if os.path.exists(self.rotated_path):
+            # Прошлая пересборка прервалась - ее журнал нужен до конца этой
+            with open(self.journal_path, 'rb') as source, open(self.rotated_path, 'ab') as target:
+                shutil.copyfileobj(source, target)
+                target.flush()
+                os.fsync(target.fileno())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self.rotated_path)
+        self._journal = open(self.journal_path, 'ab')
+        self._journal_bytes = 0
+
+    async def compact(self):
+        """Пересобирает снимок, журнал начинается заново"""
+        async with self._compact_lock:
+            await self.sync()
+            changed = dict(self._changed)
+            pool = self._pool or encode_pool(reward_pool)
+            
+            self._rotate_journal()
+            
+            started = time.perf_counter()
+            old_map = self._map
+            await jobs.run(write_snapshot, self.directory, self.snapshot_path, changed, pool)
+            self._open_snapshot()
+            if old_map is not None:
+                old_map.close()
+            os.remove(self.rotated_path)
+            
+            for user_id, record in changed.items():
+                if self._changed.get(user_id) is record:
+                    del self._changed[user_id]
+            self._last_snapshot = time.monotonic()
+            logger.info("Снимок пересобран: %s игроков за %.2f с", self._count, time.perf_counter() - started)
+
+    async def load_player(self, user_id):
+        record = self._changed.get(user_id)
+        if record is not None:
+            return decode_player(record)
+        offset = self._find(user_id)
+        return decode_player(self._map, offset) if offset is not None else None
+
+    async def insert_player(self, user):
+        """Создает игрока, возвращает False если он уже есть"""
+        if self._exists(user.user_id):
+            return False
+        self._total += 1
+        await self.save_players([user])
+        return True
+
+    async def save_players(self, users):
+        for user in users:
+            record = encode_player(user)
+            self._changed[user.user_id] = record
+            self._append(JOURNAL_PLAYER, record)
+
+    async def upsert_players(self, users):
+        for user in users:
+            if not self._exists(user.user_id):
+                self._total += 1
+        await self.save_players(users)
+        # save_players не отдает управление, и при массовой загрузке фоновая
+        # пересборка не успевает - без этого все записи копились бы в _changed
+        await self.maybe_compact()
+
+    async def load_players(self):
+        """Все игроки: из снимка, кроме измененных, затем измененные"""
+        for user_id, _, start, _ in snapshot_entries(self._map, self._count, self._index_offset):
+            if user_id not in self._changed:
+                yield decode_player(self._map, start)
+        for record in list(self._changed.values()):
+            yield decode_player(record)
+
+    async def load_ratings(self):
+        """(user_id, rating) всех игроков: из индекса снимка и измененных"""
+        # Читающий может отдавать управление, а пересборка закрыла бы снимок под ним
+        async with self._compact_lock:
+            for user_id, rating, _, _ in snapshot_entries(self._map, self._count, self._index_offset):
+                if user_id not in self._changed:
+                    yield user_id, rating
+            for user_id, record in list(self._changed.items()):
+                yield user_id, RATING_FIELD.unpack_from(record, RATING_OFFSET)[0]
+
+    async def count_players(self):
+        return self._total
+
+    async def player_columns(self):
+        """Источник для задач в пуле процессов: файл снимка читается уже там"""
+        return ('snapshot', self.snapshot_path, dict(self._changed))
+
+    async def user_ids_after(self, after, limit):
+        """Следующие limit id игроков после after: индекс снимка + новые игроки"""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            found, _, _ = SNAPSHOT_INDEX.unpack_from(
+                self._map, self._index_offset + middle * SNAPSHOT_INDEX.size
+            )
+            if found <= after:
+                low = middle + 1
+            else:
+                high = middle
+        
+        end = min(low + limit, self._count)
+        from_snapshot = [
+            SNAPSHOT_INDEX.unpack_from(self._map, self._index_offset + i * SNAPSHOT_INDEX.size)[0]
+            for i in range(low, end)
+        ]
+        changed = sorted(user_id for user_id in self._changed if user_id > after)
+        result = []
+        for user_id in heapq.merge(from_snapshot, changed):
+            if result and result[-1] == user_id:
+                continue
+            if len(result) == limit:
+                break
+            result.append(user_id)
+        return result
+
+    async def load_pool(self):
+        return decode_pool(self._pool) if self._pool is not None else None
+
+    async def save_pool(self, pool):
+        self._pool = encode_pool(pool)
+        self._append(JOURNAL_POOL, self._pool)
+
+# ============== ПУЛ ПРОЦЕССОВ ==============
+# Тяжелые по CPU задачи (пересборка снимка, экономический отчет, выгрузка
+# рейтинга) уходят в отдельные процессы и не задерживают ходы игроков.
+# Туда передаются не сами игроки, а источник: адрес БД или путь к файлу
+# снимка. Процесс-исполнитель читает его сам, цикл событий бота строки не видит.
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', max(1, (os.cpu_count() or 2) - 1)))
+JOB_STREAM_CHUNK = int(os.getenv('JOB_STREAM_CHUNK', 10_000))
+
+# Колонки игроков для отчетов и их поля в PLAYER_RECORD
+PLAYER_COLUMNS = ('user_id', 'level', 'balance', 'rating')
+PLAYER_COLUMN_FIELDS = (0, 1, 7, 10)
+
+class JobPool:
+    """ProcessPoolExecutor с async API
+
+    Процессы запускаются при первой задаче (spawn, как и воркеры), упавший
+    пул пересоздается при следующей.
+    """
+
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        self._executor = None
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    async def run(self, function, *args):
+        """Выполняет function(*args) в другом процессе и возвращает результат"""
+        executor = self._get_executor()
+        self.running += 1
+        started = time.perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+        except BrokenProcessPool:
+            self.failed += 1
+            if self._executor is executor:
+                self._executor = None
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.running -= 1
+            JOB_DURATION.labels(function.__name__).observe(time.perf_counter() - started)
+        self.completed += 1
+        return result
+
+    async def close(self):
+        if self._executor is None:
+            return
+        executor, self._executor = self._executor, None
+        await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(executor.shutdown, wait=True, cancel_futures=True)
+        )
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'started': self._executor is not None,
+            'running': self.running,
+            'completed': self.completed,
+            'failed': self.failed,
+        }
+
+jobs = JobPool()
+
+async def read_player_columns(url):
+    """Потоково читает колонки PLAYER_COLUMNS своим соединением с БД"""
+    columns = [array('q') for _ in PLAYER_COLUMNS]
+    # Одноразовый движок: процесс пула не держит соединения между задачами
+    engine = create_async_engine(url, poolclass=NullPool)
+    query = select(*(players_table.c[name] for name in PLAYER_COLUMNS))
+    try:
+        async with engine.connect() as conn:
+            result = await conn.stream(query.execution_options(yield_per=JOB_STREAM_CHUNK))
+            async for partition in result.partitions():
+                for column, values in zip(columns, zip(*partition)):
+                    column.extend(values)
+    finally:
+        await engine.dispose()
+    return columns
+
+def load_player_columns(source):
+    """Колонки PLAYER_COLUMNS массивами array('q') из источника player_columns()"""
+    kind, *payload = source
+    if kind == 'database':
+        # Выполняется в процессе пула, где своего цикла событий нет
+        return asyncio.run(read_player_columns(payload[0]))
+    
+    columns = [array('q') for _ in PLAYER_COLUMNS]
+    path, changed = payload
+    
+    def add(record, offset=0):
+        values = PLAYER_RECORD.unpack_from(record, offset)
+        for column, field in zip(columns, PLAYER_COLUMN_FIELDS):
+            column.append(values[field])
+    
+    if os.path.exists(path):
+        snapshot, count, index_offset, _ = open_snapshot(path)
+        for user_id, _, start, _ in snapshot_entries(snapshot, count, index_offset):
+            if user_id not in changed:
+                add(snapshot, start)
+        snapshot.close()
+    for record in changed.values():
+        add(record)
+    return columns
+
+def economy_report(source):
+    """Распределение монет и уровней среди всех игроков"""
+    _, levels, balances, _ = load_player_columns(source)
+    players_count = len(balances)
+    ordered = sorted(balances)
+    coins = sum(ordered)
+    
+    def percentile(share):
+        return ordered[min(players_count - 1, int(share * players_count))] if players_count else 0
+    
+    # Коэффициент Джини по отсортированным балансам: 0 - поровну, 1 - все у одного
+    weighted = sum(place * balance for place, balance in enumerate(ordered, 1))
+    gini = 2 * weighted / (players_count * coins) - (players_count + 1) / players_count if coins > 0 else 0.0
+    richest = ordered[-max(1, players_count // 100):]
+    
+    level_counts = {}
+    for level in levels:
+        level_counts[level] = level_counts.get(level, 0) + 1
+    
+    return {
+        'players': players_count,
+        'coins': coins,
+        'mean': coins / players_count if players_count else 0.0,
+        'median': percentile(0.5),
+        'p90': percentile(0.9),
+        'p99': percentile(0.99),
+        'max': ordered[-1] if ordered else 0,
+        'gini': gini,
+        'top_share': sum(richest) / coins if coins > 0 else 0.0,
+        'levels': dict(sorted(level_counts.items())),
+    }
+
+def export_ranking(source):
+    """Полный рейтинг всех игроков в CSV (gzip)
+
+    При равном рейтинге выше меньший user_id, поэтому внутри таких групп
+    места могут не совпадать с /rating, где выше тот, кто набрал рейтинг раньше.
+    """
+    user_ids, levels, balances, ratings = load_player_columns(source)
+    order = sorted(range(len(user_ids)), key=lambda i: (-ratings[i], user_ids[i]))
+    
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as compressed:
+        with io.TextIOWrapper(compressed, encoding='utf-8', newline='') as text:
+            writer = csv.writer(text)
+            writer.writerow(('place', 'user_id', 'level', 'rating', 'balance'))
+            for place, i in enumerate(order, 1):
+                writer.writerow((place, user_ids[i], levels[i], ratings[i], balances[i]))
+    return buffer.getvalue()
+
+class Leaderboard:
+    """Инкрементальный рейтинг игроков
+
+    Дерево Фенвика по значениям rating хранит число игроков с каждым рейтингом,
+    поэтому место игрока и топ-N считаются за O(log R) без сортировки всех игроков.
+    Игроки с одинаковым рейтингом делят одно место (как count_rated_above при
+    общей БД), а в топе среди них первым идет тот, кто набрал рейтинг раньше.
+    """
+
+    def __init__(self, size=1024):
+        self._size = size
+        self._tree = [0] * (size + 1)
+        self._ratings = {}
+        self._buckets = {}
+
+    def __len__(self):
+        return len(self._ratings)
+
+    def _add(self, rating, delta):
+        i = rating + 1
+        while i <= self._size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _count_upto(self, rating):
+        """Сколько игроков с рейтингом <= rating"""
+        i = min(rating + 1, self._size)
+        count = 0
+        while i > 0:
+            count += self._tree[i]
+            i -= i & -i
+        return count
+
+    def _find(self, k):
+        """Наименьший рейтинг, до которого (включительно) набирается k игроков"""
+        pos = 0
+        step = 1 << self._size.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= self._size and self._tree[nxt] < k:
+                pos = nxt
+                k -= self._tree[nxt]
+            step >>= 1
+        return pos
+
+    def _grow(self, rating):
+        size = self._size
+        while rating + 1 > size:
+            size *= 2
+        self._rebuild(size)
+
+    def _rebuild(self, size):
+        # Перестраиваем дерево за O(size) из счетчиков корзин
+        tree = [0] * (size + 1)
+        for value, bucket in self._buckets.items():
+            tree[value + 1] = len(bucket)
+        for i in range(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+
+        self._tree = tree
+        self._size = size
+
+    def update(self, user_id, rating):
+        rating = max(0, rating)
+        old = self._ratings.get(user_id)
+        if old == rating:
+            return
+        if old is not None:
+            self.remove(user_id)
+        if rating + 1 > self._size:
+            self._grow(rating)
+
+        self._ratings[user_id] = rating
+        self._buckets.setdefault(rating, {})[user_id] = None
+        self._add(rating, 1)
+
+    def extend(self, entries, rebuild=True):
+        """Массовая загрузка (user_id, rating): дерево строится один раз в конце
+
+        При загрузке порциями rebuild=False откладывает дерево до последней.
+        """
+        ratings = self._ratings
+        buckets = self._buckets
+        for user_id, rating in entries:
+            rating = max(0, rating)
+            old = ratings.get(user_id)
+            if old is not None:
+                del buckets[old][user_id]
+            ratings[user_id] = rating
+            bucket = buckets.get(rating)
+            if bucket is None:
+                bucket = buckets[rating] = {}
+            bucket[user_id] = None
+        if not rebuild:
+            return
+        
+        for rating in [rating for rating, bucket in buckets.items() if not bucket]:
+            del buckets[rating]
+        size = self._size
+        while buckets and max(buckets) + 1 > size:
+            size *= 2
+        self._rebuild(size)
+
+    def remove(self, user_id):
+        rating = self._ratings.pop(user_id, None)
+        if rating is None:
+            return
+        bucket = self._buckets[rating]
+        del bucket[user_id]
+        if not bucket:
+            del self._buckets[rating]
+        self._add(rating, -1)
+
+    def rank(self, user_id):
+        """Место игрока (1 - лучший, равные делят место), None если игрок не в рейтинге"""
+        rating = self._ratings.get(user_id)
+        if rating is None:
+            return None
+        return len(self._ratings) - self._count_upto(rating) + 1
+
+    def top(self, n):
+        """Список (user_id, rating) лучших n игроков"""
+        result = []
+        remaining = len(self._ratings)
+        while remaining > 0 and len(result) < n:
+            rating = self._find(remaining)
+            for user_id in self._buckets[rating]:
+                result.append((user_id, rating))
+                if len(result) == n:
+                    break
+            remaining = self._count_upto(rating - 1) if rating > 0 else 0
+        return result
+
+class PlayerRepository:
+    """Доступ к игрокам для обработчиков: LRU-кэш горячих игроков поверх Storage
+
+    Изменения не пишутся в БД сразу: save() только помечает игрока грязным,
+    а flush() сбрасывает всех грязных одним пакетом - по размеру пакета,
+    по таймеру и обязательно при остановке бота.
+    """
+
+    def __init__(self, storage, cache_size=PLAYER_CACHE_SIZE,
+                 batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL, shared=False):
+        self.storage = storage
+        self.shared = shared
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.total = 0
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._pool_dirty = False
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        # Рейтинг строится в фоне после старта: чтение всех рейтингов заняло бы
+        # больше секунды на миллионе игроков. Запросы рейтинга ждут окончания
+        self.leaderboard = Leaderboard()
+        self._leaderboard_ready = False
+        self._leaderboard_task = None
+        self._rated_while_loading = None
+
+    async def init(self):
+        await self.storage.init()
+        self.total = await self.storage.count_players()
+
+        saved_pool = await self.storage.load_pool()
+        if saved_pool is None:
+            await self.storage.save_pool(reward_pool)
+        else:
+            reward_pool.update(saved_pool)
+
+        self._flush_task = asyncio.create_task(self._flush_periodically())
+        if not self.shared:
+            self._leaderboard_task = asyncio.create_task(self._load_leaderboard())
+
+    async def close(self):
+        if self._leaderboard_task is not None:
+            self._leaderboard_task.cancel()
+            self._leaderboard_task = None
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        await self.storage.close()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Ошибка фонового сохранения игроков")
+
+    async def flush(self):
+        """Записывает всех грязных игроков и пул одним пакетом"""
+        async with self._flush_lock:
+            if not self._dirty and not self._pool_dirty:
+                return
+
+            batch = self._dirty
+            self._dirty = {}
+            pool_dirty = self._pool_dirty
+            self._pool_dirty = False
+
+            try:
+                users = list(batch.values())
+                for offset in range(0, len(users), self.batch_size):
+                    await self.storage.save_players(users[offset:offset + self.batch_size])
+                if pool_dirty:
+                    await self.storage.save_pool(reward_pool)
+            except Exception:
+                # Возвращаем несохраненное в буфер, новые изменения не затираем
+                for user_id, user in batch.items():
+                    self._dirty.setdefault(user_id, user)
+                self._pool_dirty = self._pool_dirty or pool_dirty
+                raise
+
+    def _remember(self, user):
+        # Пока мы ждали БД, другой обработчик мог уже положить игрока в кэш
+        cached = self._cache.get(user.user_id)
+        if cached is not None:
+            self._cache.move_to_end(user.user_id)
+            return cached
+
+        self._cache_put(user)
+        return user
+
+    def _cache_put(self, user):
+        self._cache[user.user_id] = user
+        self._cache.move_to_end(user.user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def get(self, user_id):
+        # Несохраненный игрок новее и строки в БД, и копии, загруженной после вытеснения
+        user = self._dirty.get(user_id)
+        if user is not None:
+            self._cache_put(user)
+            return user
+
+        user = self._cache.get(user_id)
+        if user is not None:
+            self._cache.move_to_end(user_id)
+            return user
+
+        user = await self.storage.load_player(user_id)
+        if user is None:
+            return None
+        return self._remember(user)
+
+    async def create(self, user_id, username, first_name):
+        user = TempUser(user_id, username, first_name)
+        if await self.storage.insert_player(user):
+            self.total += 1
+            self._rate(user)
+            return self._remember(user)
+        return await self.get(user_id)
+
+    async def save(self, user):
+        """Помечает игрока грязным, при полном пакете сразу сбрасывает буфер"""
+        user.touch()
+        self._rate(user)
+        # Кэш и буфер должны держать один и тот же объект игрока
+        self._cache_put(user)
+        self._dirty[user.user_id] = user
+        if len(self._dirty) >= self.batch_size:
+            await self.flush()
+
+    def mark_pool_dirty(self):
+        self._pool_dirty = True
+
+    def _rate(self, user):
+        # В общем режиме рейтинг меняют другие процессы, считаем его в БД
+        if self.shared:
+            return
+        if self._leaderboard_ready:
+            self.leaderboard.update(user.user_id, user.rating)
+        elif self._rated_while_loading is not None:
+            self._rated_while_loading[user.user_id] = user.rating
+
+    async def _load_leaderboard(self):
+        """Строит рейтинг из хранилища порциями, отдавая управление между ними"""
+        started = time.perf_counter()
+        # Несохраненные и измененные во время чтения игроки новее хранилища
+        self._rated_while_loading = {user_id: user.rating for user_id, user in self._dirty.items()}
+        entries = []
+        # aclosing: при отмене генератор сразу освобождает хранилище
+        async with contextlib.aclosing(self.storage.load_ratings()) as ratings:
+            async for entry in ratings:
+                entries.append(entry)
+                if len(entries) >= LEADERBOARD_LOAD_CHUNK:
+                    self.leaderboard.extend(entries, rebuild=False)
+                    entries = []
+                    await asyncio.sleep(0)
+        entries.extend(self._rated_while_loading.items())
+        self.leaderboard.extend(entries)
+        self._rated_while_loading = None
+        self._leaderboard_ready = True
+        logger.info("Рейтинг построен: %s игроков за %.2f с", len(self.leaderboard), time.perf_counter() - started)
+
+    async def _wait_leaderboard(self):
+        if not self._leaderboard_ready:
+            await asyncio.shield(self._leaderboard_task)
+
+    async def top_ratings(self, n):
+        """Список (user_id, first_name, level, rating, balance) лучших n игроков
+
+        При общей БД данные берутся прямо из строк: игроки других шардов не
+        попадают в кэш, где устарели бы, а свежесть ограничена интервалом
+        сброса буферов воркеров.
+        """
+        if self.shared:
+            return await self.storage.top_by_rating(n)
+        
+        await self._wait_leaderboard()
+        result = []
+        for user_id, rating in self.leaderboard.top(n):
+            user = await self.get(user_id)
+            if user is not None:
+                result.append((user_id, user.first_name, user.level, rating, user.balance))
+        return result
+
+    async def rank(self, user_id):
+        """Место игрока в рейтинге (1 - лучший)"""
+        if not self.shared:
+            await self._wait_leaderboard()
+            return self.leaderboard.rank(user_id)
+        user = await self.get(user_id)
+        if user is None:
+            return None
+        # Без сброса буфера: свой рейтинг свежий, чужие - на момент последнего сброса
+        return await self.storage.count_rated_above(user.rating) + 1
+
+    async def count(self):
+        if self.shared:
+            self.total = await self.storage.count_players()
+        return self.total
+
+    async def player_columns(self):
+        # Сначала сбрасываем буфер, иначе отчет не увидит последние изменения
+        await self.flush()
+        return await self.storage.player_columns()
+
+    @property
+    def pending(self):
+        return len(self._dirty)
+
+    def __len__(self):
+        return self.total
+
+# Инициализируется в run_bot()
+players = None
+application = None
+bot_stop = None
 
 # ============== КЛАВИАТУРЫ ==============
+# Объекты клавиатур неизменяемы, поэтому собираем их один раз и отдаем готовыми
 
-def get_main_keyboard():
-    """Основная клавиатура"""
-    keyboard = [
+def build_keyboards(monsters, classes):
+    """Собирает все клавиатуры, меню монстров и классов - из контента"""
+    keyboards = {}
+    keyboards['main'] = ReplyKeyboardMarkup([
         [KeyboardButton("👤 Профиль"), KeyboardButton("⚔️ Битва")],
         [KeyboardButton("💰 Баланс"), KeyboardButton("🏆 Рейтинг")],
         [KeyboardButton("🎒 Инвентарь"), KeyboardButton("📅 Ежедневно")],
         [KeyboardButton("❓ Помощь")]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-
-def get_battle_keyboard():
-    """Клавиатура для битвы"""
-    keyboard = [
+    ], resize_keyboard=True)
+    
+    keyboards['battle'] = InlineKeyboardMarkup([
         [InlineKeyboardButton("⚔️ Атаковать", callback_data="battle_attack")],
         [InlineKeyboardButton("🛡 Защищаться", callback_data="battle_defend")],
         [InlineKeyboardButton("🏃 Сбежать", callback_data="battle_flee")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    ])
+    
+    keyboards['monsters'] = InlineKeyboardMarkup([
+        [InlineKeyboardButton(
+            f"{m['name']} (Ур.{m['level']}) {m['coins_range'][0]}-{m['coins_range'][1]}💰",
+            callback_data=f"monster_{monster_id}"
+        )]
+        for monster_id, m in monsters.items()
+    ])
+    
+    keyboards['classes'] = InlineKeyboardMarkup([
+        [InlineKeyboardButton(c['title'], callback_data=f"class_{class_name}")]
+        for class_name, c in classes.items()
+    ])
+    return keyboards
+
+def get_main_keyboard():
+    """Основная клавиатура"""
+    return KEYBOARDS['main']
+
+def get_battle_keyboard():
+    """Клавиатура для битвы"""
+    return KEYBOARDS['battle']
 
 def get_monster_selection_keyboard():
     """Клавиатура выбора монстра"""
-    keyboard = [
-        [InlineKeyboardButton("🐗 Кабан (Ур.1) 10-25💰", callback_data="monster_1")],
-        [InlineKeyboardButton("🐺 Волк (Ур.3) 20-45💰", callback_data="monster_2")],
-        [InlineKeyboardButton("🐻 Медведь (Ур.5) 40-80💰", callback_data="monster_3")],
-        [InlineKeyboardButton("👹 Огр (Ур.8) 80-150💰", callback_data="monster_4")],
-        [InlineKeyboardButton("🐉 Дракон (Ур.12) 200-500💰", callback_data="monster_5")],
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return KEYBOARDS['monsters']
 
 def get_class_selection_keyboard():
     """Клавиатура выбора класса"""
-    keyboard = [
-        [InlineKeyboardButton("⚔️ Воин", callback_data="class_воин")],
-        [InlineKeyboardButton("🏹 Лучник", callback_data="class_лучник")],
-        [InlineKeyboardButton("🔮 Маг", callback_data="class_маг")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return KEYBOARDS['classes']
+
+KEYBOARDS = build_keyboards(MONSTERS, CLASSES)
+
+def reload_content(path=CONTENT_PATH):
+    """Перечитывает контент и атомарно подменяет монстров, классы и клавиатуры
+
+    Возвращает True, если загружена новая версия. При ContentError или
+    OSError остается прежний контент.
+    """
+    global CONTENT_VERSION, MONSTERS, CLASSES, KEYBOARDS
+    
+    version, monsters, classes = load_content(path)
+    if version == CONTENT_VERSION:
+        return False
+    if version < CONTENT_VERSION:
+        raise ContentError(f"version {version} старше загруженной {CONTENT_VERSION}")
+    keyboards = build_keyboards(monsters, classes)
+    
+    # Без await между присваиваниями: обработчик видит либо старый контент, либо новый
+    CONTENT_VERSION, MONSTERS, CLASSES, KEYBOARDS = version, monsters, classes, keyboards
+    logger.info("Контент v%s: монстров %s, классов %s", version, len(monsters), len(classes))
+    return True
+
+async def watch_content_forever():
+    """Перезагружает контент, когда файл меняется"""
+    def modified():
+        try:
+            return os.stat(CONTENT_PATH).st_mtime_ns
+        except OSError:
+            return None
+    
+    seen = modified()
+    while True:
+        await asyncio.sleep(CONTENT_WATCH_INTERVAL)
+        current = modified()
+        if current == seen:
+            continue
+        seen = current
+        try:
+            reload_content()
+        except (OSError, ContentError) as exc:
+            logger.error("Контент не перезагружен, остается v%s: %s", CONTENT_VERSION, exc)
+
+# ============== ШАБЛОНЫ СООБЩЕНИЙ ==============
+# Тексты готовятся один раз при запуске, обработчики только подставляют значения
+
+def _template(text):
+    return textwrap.dedent(text).strip()
+
+TEMPLATES = {
+    'profile': _template("""
+        👤 ПРОФИЛЬ ИГРОКА
+
+        📛 Имя: {user.first_name}
+        ⚔️ Класс: {user.class_name}
+        🏆 Уровень: {user.level}
+        ✨ Опыт: {current_exp}/{exp_needed}
+
+        ❤️ HP: {user.hp}/{user.max_hp}
+        ⚔️ Атака: {user.attack}
+        🛡 Защита: {user.defense}
+
+        👾 Убито: {user.kills}
+        💀 Смертей: {user.deaths}
+        💰 Баланс: {user.balance} монет
+        💎 Рейтинг: {user.rating}
+    """),
+    'battle_start': _template("""
+        ⚔️ БИТВА С {monster[name]}!
+
+        ❤️ HP врага: {monster[hp]}
+        💰 Награда: {monster[coins_range][0]}-{monster[coins_range][1]} монет
+
+        ❤️ Твое HP: {user.hp}/{user.max_hp}
+        ⚔️ Атака: {user.attack}
+        🛡 Защита: {user.defense}
+
+        🎮 Твой ход!
+    """),
+    'battle_turn': _template("""
+        ⚔️ ТВОЯ АТАКА!
+
+        Ты нанес {result[player_damage]} урона!
+        HP врага: {result[monster_hp_left]}/{monster[hp]}
+
+        {crit_text}
+        Получено урона: {result[monster_damage]}
+        Твое HP: {user.hp}/{user.max_hp}
+    """),
+    'victory': _template("""
+        🏆 ПОБЕДА!
+
+        💰 Монеты: +{reward[coins]}
+        ✨ Опыт: +{reward[exp]}
+        📊 Модификатор: {reward[modifier]:.1f}x
+        {drop_text}{level_text}
+    """),
+    'status': _template("""
+        📊 СТАТУС БОТА
+
+        🖥️ Хостинг: Koyeb
+        🐍 Python: {python_version}
+        👥 Пользователей: {users_count}
+        ⚔️ Активных боев: {active_battles}
+        📦 Контент: v{content_version}
+
+        💰 ПУЛ НАГРАД:
+        • Всего: {pool[total_pool]:,} монет
+        • Сегодня: {pool[distributed_today]:,}/{pool[max_daily_pool]:,}
+        • Осталось: {pool[remaining_today]:,} монет
+        • Использовано: {pool[percent_used]:.1f}%
+        • Статус: {enabled_text}
+
+        💹 ЭКОНОМИКА:
+        • Монет у игроков: {economy[coins]:,}
+        • Медиана / p90 / p99: {economy[median]:,} / {economy[p90]:,} / {economy[p99]:,}
+        • Джини: {economy[gini]:.2f}, у топ-1%: {economy[top_share]:.0%}
+    """),
+    'pool': _template("""
+        💰 ПУЛ НАГРАД
+
+        • Всего: {pool[total_pool]:,} монет
+        • Сегодня: {pool[distributed_today]:,}/{pool[max_daily_pool]:,}
+        • Статус: {enabled_text}
+        • Расход: {pool[rate_per_second]:.1f} монет/с, потолок: {max_rate_text}
+        • Сброс лимита: {pool[next_reset]}
+        📈 {sparkline}
+
+        🗓 Расписание:
+        {schedule}
+
+        /pool refill|cap|rate число, /pool pause|resume
+        /pool schedule ЧЧ:ММ действие [число], /pool unschedule номер
+    """),
+}
+
+def render(name, **values):
+    """Подставляет значения в подготовленный шаблон"""
+    return TEMPLATES[name].format_map(values)
+
+# ============== СЛУЧАЙНОСТЬ ==============
+
+class GameRandom:
+    """Воспроизводимый генератор случайностей для игровой логики
+
+    Числа берутся из заранее вытянутого блока, поэтому ход боя - это
+    чтение нескольких ячеек массива, а не серия вызовов random. При одном
+    и том же seed результаты боя повторяются - это нужно для тестов и разбора
+    спорных боев. У каждого боя свой генератор со своим seed.
+    """
+
+    __slots__ = ('seed', '_random', '_block', '_pos')
+
+    BLOCK_SIZE = 64
+
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = random.getrandbits(63)
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._block = array('d')
+        self._pos = 0
+
+    def _refill(self):
+        draw = self._random.random
+        self._block = array('d', [draw() for _ in range(self.BLOCK_SIZE)])
+        self._pos = 0
+
+    def random(self):
+        if self._pos >= len(self._block):
+            self._refill()
+        value = self._block[self._pos]
+        self._pos += 1
+        return value
+
+    def randint(self, low, high):
+        return low + int(self.random() * (high - low + 1))
+
+    def uniform(self, low, high):
+        return low + (high - low) * self.random()
+
+    def battle_turn(self):
+        """Все случайности одного хода: (разброс атаки игрока, разброс атаки монстра, крит)"""
+        if self._pos + 3 > len(self._block):
+            self._refill()
+        block = self._block
+        pos = self._pos
+        self._pos = pos + 3
+        return (
+            -3 + int(block[pos] * 9),
+            -2 + int(block[pos + 1] * 6),
+            block[pos + 2] < 0.1,
+        )
+
+# Общий генератор для всего, что не привязано к конкретному бою
+game_random = GameRandom(RNG_SEED)
 
 # ============== ИГРОВАЯ ЛОГИКА ==============
 
 class GameLogic:
+    # Таблица уровней: LEVEL_THRESHOLDS[i] - суммарный опыт для уровня i+1,
+    # LEVEL_COSTS[i] - сколько опыта нужно с уровня i+1 до следующего.
+    # Стоимость растет в 1.5 раза, так что таблица короткая и достраивается лениво.
+    LEVEL_THRESHOLDS = [0]
+    LEVEL_COSTS = [100]
+
+    @staticmethod
+    def _extend_level_table(exp):
+        thresholds = GameLogic.LEVEL_THRESHOLDS
+        costs = GameLogic.LEVEL_COSTS
+        while exp >= thresholds[-1] + costs[-1]:
+            thresholds.append(thresholds[-1] + costs[-1])
+            costs.append(int(costs[-1] * 1.5))
+
     @staticmethod
     def calculate_level(exp):
-        level = 1
-        exp_needed = 100
-        total_exp = 0
-        
-        while exp >= total_exp + exp_needed:
-            total_exp += exp_needed
-            level += 1
-            exp_needed = int(exp_needed * 1.5)
+        thresholds = GameLogic.LEVEL_THRESHOLDS
+        if exp >= thresholds[-1] + GameLogic.LEVEL_COSTS[-1]:
+            GameLogic._extend_level_table(exp)
         
-        return level, exp_needed, exp - total_exp
+        index = bisect.bisect_right(thresholds, exp) - 1
+        return index + 1, GameLogic.LEVEL_COSTS[index], exp - thresholds[index]
 
     @staticmethod
-    def calculate_battle(player, monster):
-        player_attack = player.attack + random.randint(-3, 5)
-        monster_attack = monster['attack'] + random.randint(-2, 3)
+    def calculate_battle(player, monster, monster_hp, rng=None):
+        player_roll, monster_roll, crit = (rng or game_random).battle_turn()
+        player_attack = player.attack + player_roll
+        monster_attack = monster['attack'] + monster_roll
         
-        crit = random.random() < 0.1
         if crit:
             player_attack *= 2
         
@@ -219,14 +1915,15 @@ class GameLogic:
             'player_damage': player_damage,
             'monster_damage': monster_damage,
             'crit': crit,
-            'player_hp_left': player.battle_hp - monster_damage,
-            'monster_hp_left': monster['hp'] - player_damage
+            'player_hp_left': player.hp - monster_damage,
+            'monster_hp_left': monster_hp - player_damage
         }
 
     @staticmethod
-    def calculate_reward(monster, player_level):
+    def calculate_reward(monster, player_level, rng=None):
+        rng = rng or game_random
         min_coins, max_coins = monster['coins_range']
-        base_coins = random.randint(min_coins, max_coins)
+        base_coins = rng.randint(min_coins, max_coins)
         base_exp = monster['exp']
         
         level_diff = player_level - monster['level']
@@ -235,13 +1932,13 @@ class GameLogic:
         else:
             level_modifier = min(1.5, 1.0 + abs(level_diff) * 0.15)
         
-        random_modifier = random.uniform(0.9, 1.1)
+        random_modifier = rng.uniform(0.9, 1.1)
         final_modifier = level_modifier * random_modifier
         
         coins_gained = int(base_coins * final_modifier)
         exp_gained = int(base_exp * final_modifier)
         
-        drop_chance = random.random()
+        drop_chance = rng.random()
         extra_drop = None
         if drop_chance < monster['drop_chance']:
             extra_drop = monster['drop']
@@ -253,19 +1950,80 @@ class GameLogic:
             'modifier': final_modifier
         }
 
+# Заранее строим таблицу на первые ~50 уровней
+GameLogic._extend_level_table(10 ** 10)
+
 # ============== СИСТЕМА ПУЛА ==============
+# Дневной лимит сбрасывается задачей pool_reset_forever в POOL_RESET_TIME,
+# а не проверкой при каждом списании. Админ меняет пул командой /pool или
+# через /admin/pool: пополнение, дневной лимит, потолок монет в секунду,
+# пауза и отложенные действия по расписанию.
+
+class SpendRate:
+    """Расход пула по секундам за последние window секунд
+
+    Кольцевой буфер: ячейка обнуляется, когда до нее снова доходит время,
+    поэтому запись - O(1) и память не растет. Считает только этот процесс.
+    """
+
+    SPARKS = '▁▂▃▄▅▆▇█'
+
+    def __init__(self, window=POOL_RATE_WINDOW):
+        self.window = window
+        self._buckets = [0] * window
+        self._second = int(time.time())
+
+    def _advance(self, now):
+        second = int(now if now is not None else time.time())
+        if second > self._second:
+            for past in range(self._second + 1, min(second, self._second + self.window) + 1):
+                self._buckets[past % self.window] = 0
+            self._second = second
+        return self._second
+
+    def add(self, amount, now=None):
+        self._buckets[self._advance(now) % self.window] += amount
+
+    def current(self, now=None):
+        """Потрачено за текущую секунду"""
+        return self._buckets[self._advance(now) % self.window]
+
+    def series(self, seconds=60, now=None):
+        """Расход по секундам от старых к новым, последняя - текущая секунда"""
+        second = self._advance(now)
+        seconds = min(seconds, self.window)
+        return [self._buckets[past % self.window] for past in range(second - seconds + 1, second + 1)]
+
+    def rate(self, seconds=60, now=None):
+        """Средний расход в секунду за последние seconds законченных секунд"""
+        completed = self.series(seconds + 1, now)[:-1]
+        return sum(completed) / len(completed) if completed else 0.0
+
+    def sparkline(self, seconds=60, now=None):
+        """Ряд расхода строкой из блоков ▁..█ для сообщения в Telegram"""
+        series = self.series(seconds, now)
+        top = max(series)
+        if not top:
+            return self.SPARKS[0] * len(series)
+        return ''.join(self.SPARKS[value * (len(self.SPARKS) - 1) // top] for value in series)
 
 class RewardSystem:
+    # Реализация пула (InMemoryRewardPool или SqlRewardPool), задается в run_bot()
+    backend = None
+    # Расход пула этим процессом - по нему работает потолок reward_pool['max_rate']
+    spending = SpendRate()
+    # Расход пула всеми процессами для /pool и /admin/pool. В одном процессе это
+    # тот же ряд, при общей БД его заполняет sample_pool_spend_forever
+    observed = spending
+    # На сколько процессов делится потолок: каждый воркер обслуживает свою долю игроков
+    shards = 1
+
+    ACTIONS = ('refill', 'cap', 'rate', 'pause', 'resume')
+
     @staticmethod
     def get_pool_status():
         global reward_pool
         
-        # Проверяем сброс дня
-        today = datetime.datetime.now().date()
-        if reward_pool['last_reset'] != today:
-            reward_pool['distributed_today'] = 0
-            reward_pool['last_reset'] = today
-        
         return {
             'total_pool': reward_pool['total_pool'],
             'distributed_today': reward_pool['distributed_today'],
@@ -273,7 +2031,10 @@ class RewardSystem:
             'remaining_today': reward_pool['max_daily_pool'] - reward_pool['distributed_today'],
             'remaining_total': reward_pool['total_pool'],
             'enabled': reward_pool['enabled'],
-            'percent_used': (reward_pool['distributed_today'] / reward_pool['max_daily_pool'] * 100) if reward_pool['max_daily_pool'] > 0 else 0
+            'percent_used': (reward_pool['distributed_today'] / reward_pool['max_daily_pool'] * 100) if reward_pool['max_daily_pool'] > 0 else 0,
+            'rate_per_second': RewardSystem.observed.rate(),
+            'max_rate': reward_pool['max_rate'],
+            'next_reset': next_pool_reset().isoformat(timespec='minutes'),
         }
 
     @staticmethod
@@ -293,25 +2054,773 @@ class RewardSystem:
         return True, "✅ Можно заработать"
 
     @staticmethod
-    def add_earnings(amount):
-        global reward_pool
-        can_earn, message = RewardSystem.can_earn(amount)
+    def throttled(amount):
+        # Мягкий потолок: при SqlRewardPool параллельные списания могут чуть его превысить
+        max_rate = reward_pool['max_rate']
+        return bool(max_rate) and RewardSystem.spending.current() + amount > max_rate / RewardSystem.shards
+
+    @staticmethod
+    async def reserve(amount):
+        """Атомарно проверяет лимиты и списывает amount из пула"""
+        if RewardSystem.throttled(amount):
+            POOL_REJECTED.inc()
+            return False, "⏳ Сейчас раздается слишком много наград, попробуй чуть позже"
+        
+        success, message = await RewardSystem.backend.reserve(amount)
+        if success:
+            POOL_DEBITED.inc(amount)
+            RewardSystem.spending.add(amount)
+        else:
+            POOL_REJECTED.inc()
+        return success, message
+
+    @staticmethod
+    async def reset_day():
+        """Сбрасывает дневной лимит, если день пула сменился"""
+        return await RewardSystem.backend.reset_day(pool_day())
+
+    @staticmethod
+    def check_action(action, value):
+        """ValueError - неизвестное действие или неверное значение"""
+        if action not in RewardSystem.ACTIONS:
+            raise ValueError(f"Неизвестное действие: {action}")
+        if action in ('refill', 'cap', 'rate') and (value is None or value < 0):
+            raise ValueError("Нужно неотрицательное число")
+
+    @staticmethod
+    async def apply(action, value=None):
+        """Админское действие с пулом, возвращает текст для ответа"""
+        RewardSystem.check_action(action, value)
         
+        if action == 'refill':
+            await RewardSystem.backend.refill(value)
+            return f"💰 Пул пополнен на {value:,}: всего {reward_pool['total_pool']:,} монет"
+        if action == 'cap':
+            await RewardSystem.backend.configure(max_daily_pool=value)
+            return f"📏 Дневной лимит: {value:,} монет"
+        if action == 'rate':
+            await RewardSystem.backend.configure(max_rate=value)
+            return f"🚦 Потолок: {value:,} монет/с" if value else "🚦 Потолок монет в секунду снят"
+        if action == 'pause':
+            await RewardSystem.backend.configure(enabled=False)
+            return "⏸ Раздача наград остановлена"
+        await RewardSystem.backend.configure(enabled=True)
+        return "▶️ Раздача наград включена"
+
+class InMemoryRewardPool:
+    """Пул в памяти процесса
+
+    Проверка и списание идут подряд без await, поэтому в одном цикле событий
+    они атомарны без всяких блокировок. Сохраняется через буфер PlayerRepository.
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+
+    async def reserve(self, amount):
+        can_earn, message = RewardSystem.can_earn(amount)
         if not can_earn:
             return False, message
         
         reward_pool['total_pool'] -= amount
         reward_pool['distributed_today'] += amount
+        self.repository.mark_pool_dirty()
         
         return True, f"✨ +{amount} монет!"
 
+    async def reset_day(self, today):
+        if reward_pool['last_reset'] >= today:
+            return False
+        reward_pool['distributed_today'] = 0
+        reward_pool['last_reset'] = today
+        self.repository.mark_pool_dirty()
+        return True
+
+    async def refill(self, amount):
+        reward_pool['total_pool'] += amount
+        self.repository.mark_pool_dirty()
+
+    async def configure(self, **values):
+        reward_pool.update(values)
+        self.repository.mark_pool_dirty()
+
+class SqlRewardPool:
+    """Пул в БД: проверка и списание одним условным UPDATE
+
+    Безопасен при нескольких воркерах и инстансах. Словарь reward_pool
+    остается локальной копией для отображения и обновляется из RETURNING.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def reserve(self, amount):
+        success, pool = await self.storage.reserve_pool(amount)
+        if pool is not None:
+            reward_pool.update(pool)
+        if success:
+            return True, f"✨ +{amount} монет!"
+        
+        can_earn, message = RewardSystem.can_earn(amount)
+        return False, message if not can_earn else "⚠️ Пул наград пуст!"
+
+    async def reset_day(self, today):
+        # Сброс делает первый успевший процесс, остальным UPDATE ничего не находит
+        pool = await self.storage.reset_pool_day(today)
+        if pool is None:
+            return False
+        reward_pool.update(pool)
+        return True
+
+    async def refill(self, amount):
+        reward_pool.update(await self.storage.refill_pool(amount))
+
+    async def configure(self, **values):
+        reward_pool.update(await self.storage.configure_pool(values))
+
+async def pool_reset_forever():
+    """Сбрасывает дневной лимит в POOL_RESET_TIME, при старте - сразу, если сброс пропущен"""
+    while True:
+        try:
+            if await RewardSystem.reset_day():
+                logger.info("Дневной лимит пула сброшен")
+        except Exception:
+            logger.exception("Ошибка сброса дневного лимита пула")
+        # Не спим дольше часа: переживаем перевод часов и сон машины
+        delay = (next_pool_reset() - datetime.datetime.now()).total_seconds()
+        await asyncio.sleep(min(delay, 3600))
+
+async def sample_pool_spend_forever(interval=1.0):
+    """Ряд расхода всех процессов по приросту distributed_today в общей БД"""
+    previous = None
+    while True:
+        try:
+            pool = await players.storage.load_pool()
+            reward_pool.update(pool)
+            spent = pool['distributed_today']
+            if previous is not None:
+                # После сброса дня счетчик начинается с нуля
+                RewardSystem.observed.add(spent - previous if spent >= previous else spent)
+            previous = spent
+        except Exception:
+            logger.exception("Ошибка чтения расхода пула")
+        await asyncio.sleep(interval)
+
+class PoolSchedule:
+    """Отложенные действия с пулом: пополнение, лимит, пауза в заданное время
+
+    Список лежит в JSON-файле и переживает рестарт. Действие удаляется из
+    файла до выполнения, поэтому после сбоя оно не повторится.
+    """
+
+    def __init__(self, path=POOL_SCHEDULE_PATH):
+        self.path = path
+        self.entries = []
+        self._changed = asyncio.Event()
+
+    def load(self, path=POOL_SCHEDULE_PATH):
+        self.path = path
+        try:
+            with open(path, encoding='utf-8') as file:
+                self.entries = json.load(file)
+        except FileNotFoundError:
+            self.entries = []
+        self.entries.sort(key=lambda entry: entry['at'])
+
+    def _save(self):
+        path = self.path + '.tmp'
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.entries, file)
+        os.replace(path, self.path)
+        self._changed.set()
+
+    def add(self, at, action, value=None):
+        RewardSystem.check_action(action, value)
+        
+        self.entries.append({'at': at.timestamp(), 'action': action, 'value': value})
+        self.entries.sort(key=lambda entry: entry['at'])
+        self._save()
+
+    def remove(self, number):
+        """Удаляет действие по номеру из describe() (с единицы)"""
+        if not 1 <= number <= len(self.entries):
+            raise ValueError(f"Нет действия №{number}")
+        self.entries.pop(number - 1)
+        self._save()
+
+    def describe(self):
+        lines = []
+        for number, entry in enumerate(self.entries, 1):
+            at = datetime.datetime.fromtimestamp(entry['at']).strftime('%d.%m %H:%M')
+            value = f" {entry['value']:,}" if entry['value'] is not None else ''
+            lines.append(f"{number}. {at} {entry['action']}{value}")
+        return '\n'.join(lines) or "пусто"
+
+    async def run_forever(self):
+        while True:
+            self._changed.clear()
+            now = time.time()
+            while self.entries and self.entries[0]['at'] <= now:
+                entry = self.entries.pop(0)
+                self._save()
+                try:
+                    message = await RewardSystem.apply(entry['action'], entry['value'])
+                    logger.info("Пул по расписанию: %s", message)
+                except Exception:
+                    logger.exception("Ошибка действия с пулом по расписанию: %s", entry)
+            
+            timeout = self.entries[0]['at'] - now if self.entries else None
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+pool_schedule = PoolSchedule()
+
+def parse_amount(text):
+    if not text.isdigit():
+        raise ValueError(f"Нужно целое число, а не {text}")
+    return int(text)
+
+def parse_schedule_time(text, now=None):
+    """ЧЧ:ММ (ближайшее такое время) или ГГГГ-ММ-ДДTЧЧ:ММ"""
+    now = now or datetime.datetime.now()
+    if 'T' in text or '-' in text:
+        return datetime.datetime.fromisoformat(text)
+    at = datetime.datetime.combine(now.date(), datetime.time.fromisoformat(text))
+    if at <= now:
+        at += datetime.timedelta(days=1)
+    return at
+
+# ============== АКТИВНЫЕ БОИ ==============
+
+class BattleSession:
+    """Состояние одного боя"""
+
+    __slots__ = ('user_id', 'monster_id', 'monster_hp', 'expires_at', 'rng')
+
+    def __init__(self, user_id, monster_id, monster_hp, expires_at, rng):
+        self.user_id = user_id
+        self.monster_id = monster_id
+        self.monster_hp = monster_hp
+        self.expires_at = expires_at
+        self.rng = rng
+
+class BattleStore:
+    """Хранилище только активных боев
+
+    Бои живут в памяти и не пишутся в БД, поэтому рестарт не оставляет
+    игроков навсегда "в битве". Брошенный бой истекает через ttl секунд
+    после последнего хода: куча по времени истечения держит по одной записи
+    на бой, продленный бой просто перекладывается в куче при очистке.
+    """
+
+    def __init__(self, ttl=BATTLE_TTL):
+        self.ttl = ttl
+        self._sessions = {}
+        self._expiry = []
+        self._sequence = itertools.count()
+        self.started = 0
+        self.finished = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def start(self, user_id, monster_id, monster_hp, seed=None):
+        """Начинает бой; seed позволяет переиграть бой ход в ход"""
+        rng = GameRandom(seed)
+        session = BattleSession(user_id, monster_id, monster_hp, time.monotonic() + self.ttl, rng)
+        logger.debug("Бой %s с монстром %s, seed=%s", user_id, monster_id, rng.seed)
+        self._sessions[user_id] = session
+        heapq.heappush(self._expiry, (session.expires_at, next(self._sequence), session))
+        self.started += 1
+        return session
+
+    def get(self, user_id):
+        session = self._sessions.get(user_id)
+        if session is not None and session.expires_at <= time.monotonic():
+            self._drop(session)
+            return None
+        return session
+
+    def touch(self, session):
+        session.expires_at = time.monotonic() + self.ttl
+
+    def finish(self, user_id):
+        if self._sessions.pop(user_id, None) is not None:
+            self.finished += 1
+
+    def _drop(self, session):
+        if self._sessions.get(session.user_id) is session:
+            del self._sessions[session.user_id]
+            self.expired += 1
+
+    def expire(self):
+        """Удаляет истекшие бои, возвращает сколько удалено"""
+        now = time.monotonic()
+        before = self.expired
+        while self._expiry and self._expiry[0][0] <= now:
+            _, _, session = heapq.heappop(self._expiry)
+            if self._sessions.get(session.user_id) is not session:
+                continue  # бой уже закончен или заменен новым
+            if session.expires_at > now:
+                heapq.heappush(self._expiry, (session.expires_at, next(self._sequence), session))
+                continue
+            self._drop(session)
+        return self.expired - before
+
+    async def sweep_forever(self, interval=BATTLE_SWEEP_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            expired = self.expire()
+            if expired:
+                logger.info("Истекло брошенных боев: %s", expired)
+
+    def stats(self):
+        return {
+            'active': len(self._sessions),
+            'started': self.started,
+            'finished': self.finished,
+            'expired': self.expired,
+        }
+
+battles = BattleStore()
+
+# ============== МЕТРИКИ ==============
+# Prometheus-метрики для /metrics. Замер обработчика - два вызова perf_counter
+# и запись в гистограмму, поэтому метрики включены всегда.
+# При WORKERS > 1 задайте PROMETHEUS_MULTIPROC_DIR (пустой каталог): воркеры
+# пишут туда свои метрики, а /metrics главного процесса собирает их вместе.
+
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+METRICS_SAMPLE_INTERVAL = float(os.getenv('METRICS_SAMPLE_INTERVAL', 5))
+
+# Границы корзин гистограмм в секундах
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HANDLER_LATENCY = Histogram(
+    'rucoy_handler_seconds', 'Время работы обработчика',
+    ['handler', 'action'], buckets=LATENCY_BUCKETS,
+)
+TELEGRAM_LATENCY = Histogram(
+    'rucoy_telegram_request_seconds', 'Время запроса к Bot API (без ожидания лимитов)',
+    ['method'], buckets=LATENCY_BUCKETS,
+)
+TELEGRAM_ERRORS = Counter('rucoy_telegram_errors', 'Ошибки запросов к Bot API', ['method', 'error'])
+POOL_DEBITED = Counter('rucoy_pool_debited_coins', 'Монет списано из пула')
+POOL_REJECTED = Counter('rucoy_pool_rejected', 'Отказов в списании из пула')
+JOB_DURATION = Histogram('rucoy_job_duration_seconds', 'Время задач в пуле процессов', ['job'], buckets=LATENCY_BUCKETS + (30, 60, 120))
+POOL_SPEND_RATE = Gauge('rucoy_pool_spend_rate', 'Расход пула, монет/с за последнюю минуту', multiprocess_mode='livesum')
+UPDATE_QUEUE = Gauge('rucoy_update_queue_size', 'Обновлений ждут обработки', ['queue'], multiprocess_mode='livesum')
+ACTIVE_BATTLES = Gauge('rucoy_active_battles', 'Активных боев', multiprocess_mode='livesum')
+PROCESS_RSS = Gauge('rucoy_process_rss_bytes', 'Память процесса (RSS)', multiprocess_mode='liveall')
+PROCESS_CPU = Gauge('rucoy_process_cpu_seconds', 'Процессорное время процесса (user + system)', multiprocess_mode='liveall')
+
+# Действия кнопок для метки action (остальное попадает в other)
+CALLBACK_ACTIONS = ('class', 'monster', 'battle_attack', 'battle_defend', 'battle_flee')
+
+_process = psutil.Process()
+
+def callback_action(update):
+    data = update.callback_query.data or ''
+    for action in CALLBACK_ACTIONS:
+        if data == action or data.startswith(action + '_'):
+            return action
+    return 'other'
+
+def timed(name, action=None):
+    """Пишет время работы обработчика в HANDLER_LATENCY"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            label = action(update) if action is not None else ''
+            run = watchdog.enter(f'{name}:{label}' if label else name)
+            started = time.perf_counter()
+            try:
+                return await handler(update, context)
+            finally:
+                elapsed = time.perf_counter() - started
+                HANDLER_LATENCY.labels(name, label).observe(elapsed)
+                watchdog.leave(run, elapsed)
+        return wrapper
+    return decorator
+
+def sample_gauges():
+    """Обновляет метрики-снимки: очереди, бои, память и CPU процесса"""
+    if application is not None:
+        UPDATE_QUEUE.labels('application').set(application.update_queue.qsize())
+    for index, queue in enumerate(worker_queues):
+        UPDATE_QUEUE.labels(f'worker-{index}').set(queue.qsize())
+    ACTIVE_BATTLES.set(len(battles))
+    # Только свой расход: livesum сложит воркеры, а ряд из БД посчитал бы их второй раз
+    POOL_SPEND_RATE.set(RewardSystem.spending.rate())
+    
+    cpu = _process.cpu_times()
+    PROCESS_RSS.set(_process.memory_info().rss)
+    PROCESS_CPU.set(cpu.user + cpu.system)
+
+async def sample_gauges_forever():
+    """В воркерах некому опрашивать метрики при запросе, обновляем их сами"""
+    while True:
+        await asyncio.sleep(METRICS_SAMPLE_INTERVAL)
+        sample_gauges()
+
+# ============== ПРОФИЛИРОВАНИЕ ==============
+# Включается на ходу командой /profiler или GET /admin/profile, без перезапуска.
+# Отдельный поток раз в PROFILER_INTERVAL снимает стек потока цикла событий,
+# а отладочный режим asyncio на время замера сообщает о медленных колбэках.
+# При WORKERS > 1 команда профилирует воркер, который ее обработал,
+# а HTTP маршрут - главный процесс с вебхуком.
+
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL', 0.005))
+PROFILER_SLOW_CALLBACK = float(os.getenv('PROFILER_SLOW_CALLBACK', 0.05))
+PROFILER_MAX_SECONDS = int(os.getenv('PROFILER_MAX_SECONDS', 120))
+
+class SlowCallbackLog(logging.Handler):
+    """Собирает предупреждения asyncio о медленных колбэках"""
+
+    LIMIT = 50
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+        self.total = 0
+
+    def emit(self, record):
+        message = record.getMessage()
+        if not message.startswith('Executing'):
+            return
+        self.total += 1
+        if len(self.messages) < self.LIMIT:
+            self.messages.append(message[:300])
+
+class ProfileResult:
+    """Итог замера: счетчики стеков и медленные колбэки"""
+
+    def __init__(self, seconds, stacks, slow_callbacks, slow_total):
+        self.seconds = seconds
+        self.stacks = stacks
+        self.slow_callbacks = slow_callbacks
+        self.slow_total = slow_total
+        self.samples = sum(stacks.values())
+
+    @staticmethod
+    def _frame_name(code):
+        return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    @staticmethod
+    def _is_idle(stack):
+        # Цикл ждет событий в selector.select - значит, ничем не занят
+        leaf = stack[-1]
+        return leaf.co_name in ('select', 'poll') and leaf.co_filename.endswith('selectors.py')
+
+    def collapsed(self):
+        """Стеки в формате flamegraph.pl / speedscope: 'a;b;c количество'"""
+        lines = [
+            ';'.join(self._frame_name(code) for code in stack) + f' {count}'
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1])
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def top(self, limit=15):
+        """Текстовая сводка: самые затратные функции (исключая простой цикла)"""
+        own = {}
+        total = {}
+        idle = 0
+        for stack, count in self.stacks.items():
+            if self._is_idle(stack):
+                idle += count
+                continue
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            for code in set(stack):
+                total[code] = total.get(code, 0) + count
+        
+        busy = self.samples - idle
+        lines = [
+            f"🔬 ПРОФИЛЬ за {self.seconds} с: {self.samples} сэмплов",
+            f"💤 Цикл простаивал: {idle / self.samples:.0%}" if self.samples else "💤 Сэмплов нет",
+        ]
+        for title, counts in (("🔥 Собственное время:", own), ("📚 Вместе с вызовами:", total)):
+            lines.append('')
+            lines.append(title)
+            for code, count in sorted(counts.items(), key=lambda item: -item[1])[:limit]:
+                lines.append(f"{count / busy:>6.1%}  {self._frame_name(code)}")
+        
+        lines.append('')
+        lines.append(f"🐢 Медленных колбэков (> {PROFILER_SLOW_CALLBACK * 1000:.0f} мс): {self.slow_total}")
+        lines.extend(self.slow_callbacks[:10])
+        return '\n'.join(lines)
+
+class LoopProfiler:
+    """Сэмплирующий профилировщик цикла событий, один замер за раз"""
+
+    def __init__(self, interval=PROFILER_INTERVAL, slow_callback=PROFILER_SLOW_CALLBACK):
+        self.interval = interval
+        self.slow_callback = slow_callback
+        self.running = False
+
+    def _sample(self, thread_id, stop, stacks):
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            if stack:
+                key = tuple(reversed(stack))
+                stacks[key] = stacks.get(key, 0) + 1
+
+    async def run(self, seconds):
+        """Снимает профиль текущего цикла событий за seconds секунд"""
+        if self.running:
+            raise RuntimeError("Профилирование уже идет")
+        seconds = max(1, min(int(seconds), PROFILER_MAX_SECONDS))
+        self.running = True
+        
+        loop = asyncio.get_running_loop()
+        debug, slow_callback_duration = loop.get_debug(), loop.slow_callback_duration
+        slow_log = SlowCallbackLog()
+        asyncio_logger = logging.getLogger('asyncio')
+        
+        stacks = {}
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample, args=(threading.get_ident(), stop, stacks),
+            name='loop-profiler', daemon=True,
+        )
+        
+        asyncio_logger.addHandler(slow_log)
+        loop.slow_callback_duration = self.slow_callback
+        loop.set_debug(True)
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            await loop.run_in_executor(None, sampler.join)
+            loop.set_debug(debug)
+            loop.slow_callback_duration = slow_callback_duration
+            asyncio_logger.removeHandler(slow_log)
+            self.running = False
+        
+        return ProfileResult(seconds, stacks, slow_log.messages, slow_log.total)
+
+profiler = LoopProfiler()
+
+# ============== СТОРОЖ ЦИКЛА СОБЫТИЙ ==============
+# Все обработчики делят один цикл событий, и синхронный вызов в любом из них
+# тормозит всех игроков. Сторож постоянно меряет задержку цикла, пишет в лог
+# стек того, кто держит цикл или выходит за HANDLER_BUDGET, а /health
+# отвечает 503, пока цикл перегружен, чтобы Koyeb перезапустил инстанс.
+
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.5))
+LOOP_LAG_LIMIT = float(os.getenv('LOOP_LAG_LIMIT', 1.0))
+# Сколько последних замеров усреднять для /health
+LOOP_LAG_WINDOW = int(os.getenv('LOOP_LAG_WINDOW', 20))
+HANDLER_BUDGET = float(os.getenv('HANDLER_BUDGET', 2.0))
+
+LOOP_LAG = Gauge('rucoy_loop_lag_seconds', 'Задержка цикла событий', multiprocess_mode='liveall')
+LOOP_STALLS = Counter('rucoy_loop_stalls', 'Цикл событий был занят дольше LOOP_LAG_LIMIT')
+SLOW_HANDLERS = Counter('rucoy_slow_handlers', 'Обработчиков дольше HANDLER_BUDGET', ['handler'])
+
+class HandlerRun:
+    """Выполняющийся сейчас обработчик"""
+
+    __slots__ = ('name', 'task', 'started', 'reported')
+
+    def __init__(self, name, task, started):
+        self.name = name
+        self.task = task
+        self.started = started
+        self.reported = False
+
+class LoopWatchdog:
+    """Задержка цикла событий и обработчики, вышедшие за бюджет
+
+    - корутина раз в interval засыпает и смотрит, насколько позже проснулась;
+    - поток-сторож, если цикл не отзывается дольше limit, пишет стек потока
+      цикла - это и есть блокирующий вызов;
+    - обработчик дольше budget попадает в лог со стеком своей корутины.
+    """
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL, limit=LOOP_LAG_LIMIT,
+                 window=LOOP_LAG_WINDOW, budget=HANDLER_BUDGET):
+        self.interval = interval
+        self.limit = limit
+        self.budget = budget
+        self.lags = deque(maxlen=window)
+        self.max_lag = 0.0
+        self.beat = time.monotonic()
+        self.stalls = 0
+        self.slow_handlers = 0
+        self._runs = {}
+        self._ids = itertools.count()
+
+    def enter(self, name):
+        run_id = next(self._ids)
+        self._runs[run_id] = HandlerRun(name, asyncio.current_task(), time.monotonic())
+        return run_id
+
+    def leave(self, run_id, elapsed):
+        run = self._runs.pop(run_id, None)
+        if elapsed <= self.budget or run is None:
+            return
+        self.slow_handlers += 1
+        SLOW_HANDLERS.labels(run.name).inc()
+        if not run.reported:
+            # Закончился между проверками - стек уже не снять
+            logger.warning("Обработчик %s работал %.2f с (бюджет %.2f с)", run.name, elapsed, self.budget)
+
+    def _check_handlers(self, now):
+        for run in self._runs.values():
+            if run.reported or now - run.started <= self.budget:
+                continue
+            run.reported = True
+            stack = io.StringIO()
+            if run.task is not None:
+                run.task.print_stack(file=stack)
+            logger.warning(
+                "Обработчик %s идет уже %.2f с (бюджет %.2f с):\n%s",
+                run.name, now - run.started, self.budget, stack.getvalue(),
+            )
+
+    def _watch(self, thread_id, stop):
+        """Поток-сторож: снимает стек, пока цикл событий занят"""
+        reported = None
+        while not stop.wait(self.interval):
+            beat = self.beat
+            busy = time.monotonic() - beat - self.interval
+            if busy < self.limit or reported == beat:
+                continue
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            reported = beat
+            self.stalls += 1
+            LOOP_STALLS.inc()
+            logger.warning(
+                "Цикл событий занят уже %.2f с, текущий стек:\n%s",
+                busy, ''.join(traceback.format_stack(frame)),
+            )
+
+    async def monitor_forever(self):
+        stop = threading.Event()
+        threading.Thread(
+            target=self._watch, args=(threading.get_ident(), stop),
+            name='loop-watchdog', daemon=True,
+        ).start()
+        try:
+            while True:
+                started = time.monotonic()
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                lag = max(0.0, now - started - self.interval)
+                self.beat = now
+                self.lags.append(lag)
+                self.max_lag = max(self.max_lag, lag)
+                LOOP_LAG.set(lag)
+                self._check_handlers(now)
+        finally:
+            stop.set()
+
+    @property
+    def average_lag(self):
+        return sum(self.lags) / len(self.lags) if self.lags else 0.0
+
+    @property
+    def saturated(self):
+        return self.average_lag > self.limit
+
+    def stats(self):
+        return {
+            'lag': self.lags[-1] if self.lags else 0.0,
+            'average_lag': self.average_lag,
+            'max_lag': self.max_lag,
+            'stalls': self.stalls,
+            'slow_handlers': self.slow_handlers,
+            'running_handlers': len(self._runs),
+            'saturated': self.saturated,
+        }
+
+watchdog = LoopWatchdog()
+
+# ============== ОЧЕРЕДЬ ДЕЙСТВИЙ ИГРОКА ==============
+
+class UserActionQueue:
+    """Последовательное выполнение действий одного игрока
+
+    У каждого игрока своя блокировка, поэтому разные игроки обрабатываются
+    параллельно, а действия одного игрока - строго по очереди. Повторное
+    нажатие той же кнопки, пока предыдущее еще ждет или выполняется, отбрасывается.
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._waiters = {}
+        self._pending = set()
+        self.dropped = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id, action=None):
+        key = (user_id, action)
+        if action is not None:
+            if key in self._pending:
+                self.dropped += 1
+                yield False
+                return
+            self._pending.add(key)
+        
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        self._waiters[user_id] = self._waiters.get(user_id, 0) + 1
+        
+        try:
+            async with lock:
+                yield True
+        finally:
+            self._pending.discard(key)
+            self._waiters[user_id] -= 1
+            if not self._waiters[user_id]:
+                # Никто больше не ждет - не держим блокировку в памяти
+                del self._waiters[user_id]
+                del self._locks[user_id]
+
+    @property
+    def active(self):
+        return len(self._locks)
+
+user_actions = UserActionQueue()
+
+def per_user(handler):
+    """Обработчик, меняющий состояние игрока, выполняется в его очереди"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None:
+            return await handler(update, context)
+        
+        query = update.callback_query
+        action = query.data if query is not None else None
+        
+        async with user_actions.slot(user.id, action) as accepted:
+            if not accepted:
+                await query.answer("⏳ Уже выполняется...")
+                return None
+            return await handler(update, context)
+    
+    return wrapper
+
 # ============== ОБРАБОТЧИКИ КОМАНД ==============
 
+@timed('start')
+@per_user
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
-    if user.id not in users_db:
-        users_db[user.id] = TempUser(user.id, user.username, user.first_name)
+    if await players.get(user.id) is None:
+        await players.create(user.id, user.username, user.first_name)
         
         welcome_text = f"""
 🌟 ДОБРО ПОЖАЛОВАТЬ В RUCOY BATTLE! 🌟
@@ -330,59 +2839,43 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             welcome_text,
             reply_markup=get_class_selection_keyboard()
         )
-        return CHOOSING_CLASS
     else:
         await update.message.reply_text(
             f"С возвращением, {user.first_name}! 👋",
             reply_markup=get_main_keyboard()
         )
-    
-    return ConversationHandler.END
 
+@timed('profile')
 async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
-    if user.id not in users_db:
+    db_user = await players.get(user.id)
+    if db_user is None:
         await update.message.reply_text("Сначала введи /start!")
         return
     
-    db_user = users_db[user.id]
     level, exp_needed, current_exp = GameLogic.calculate_level(db_user.exp)
     
-    profile_text = f"""
-👤 ПРОФИЛЬ ИГРОКА
-
-📛 Имя: {db_user.first_name}
-⚔️ Класс: {db_user.class_name}
-🏆 Уровень: {db_user.level}
-✨ Опыт: {current_exp}/{exp_needed}
-
-❤️ HP: {db_user.hp}/{db_user.max_hp}
-⚔️ Атака: {db_user.attack}
-🛡 Защита: {db_user.defense}
-
-👾 Убито: {db_user.kills}
-💀 Смертей: {db_user.deaths}
-💰 Баланс: {db_user.balance} монет
-💎 Рейтинг: {db_user.rating}
-    """
+    profile_text = render('profile', user=db_user, current_exp=current_exp, exp_needed=exp_needed)
     
     await update.message.reply_text(profile_text, reply_markup=get_main_keyboard())
 
+@timed('battle')
+@per_user
 async def battle(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
-    if user.id not in users_db:
+    db_user = await players.get(user.id)
+    if db_user is None:
         await update.message.reply_text("Сначала введи /start!")
         return
     
-    db_user = users_db[user.id]
     
     if db_user.hp <= 0:
-        await update.message.reply_text("💀 Ты мертв! Воскресни за 50 монет командой /revive")
+        await update.message.reply_text(f"💀 Ты мертв! Воскресни за {REVIVE_COST} монет командой /revive")
         return
     
-    if db_user.in_battle:
+    if battles.get(user.id) is not None:
         await update.message.reply_text("Ты уже в битве!")
         return
     
@@ -391,14 +2884,15 @@ async def battle(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_monster_selection_keyboard()
     )
 
+@timed('balance')
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
-    if user.id not in users_db:
+    db_user = await players.get(user.id)
+    if db_user is None:
         await update.message.reply_text("Сначала введи /start!")
         return
     
-    db_user = users_db[user.id]
     pool_status = RewardSystem.get_pool_status()
     
     balance_text = f"""
@@ -414,36 +2908,36 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(balance_text)
 
+@timed('rating_command')
 async def rating_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
-    if user.id not in users_db:
+    if await players.get(user.id) is None:
         await update.message.reply_text("Сначала введи /start!")
         return
     
-    # Сортируем игроков по рейтингу
-    sorted_users = sorted(users_db.values(), key=lambda x: x.rating, reverse=True)
-    
+    # Берем топ из индекса рейтинга, без сортировки всех игроков
     top_text = "🏆 ТОП 5 ИГРОКОВ\n\n"
     
-    for i, u in enumerate(sorted_users[:5], 1):
+    for i, (_, first_name, level, rating, balance) in enumerate(await players.top_ratings(5), 1):
         medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-        top_text += f"{medal} {u.first_name} | Ур.{u.level} | {u.rating}⭐ | {u.balance}💰\n"
+        top_text += f"{medal} {first_name} | Ур.{level} | {rating}⭐ | {balance}💰\n"
     
-    # Находим место текущего игрока
-    user_rank = next((i for i, u in enumerate(sorted_users, 1) if u.user_id == user.id), len(sorted_users) + 1)
+    # Место текущего игрока
+    user_rank = await players.rank(user.id) or await players.count() + 1
     top_text += f"\n📊 Твое место: #{user_rank}"
     
     await update.message.reply_text(top_text)
 
+@timed('inventory')
 async def inventory(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
-    if user.id not in users_db:
+    db_user = await players.get(user.id)
+    if db_user is None:
         await update.message.reply_text("Сначала введи /start!")
         return
     
-    db_user = users_db[user.id]
     
     inv_text = "🎒 ИНВЕНТАРЬ\n\n"
     
@@ -455,14 +2949,16 @@ async def inventory(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(inv_text)
 
+@timed('daily')
+@per_user
 async def daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
-    if user.id not in users_db:
+    db_user = await players.get(user.id)
+    if db_user is None:
         await update.message.reply_text("Сначала введи /start!")
         return
     
-    db_user = users_db[user.id]
     today = datetime.datetime.now().date()
     
     if db_user.last_daily and db_user.last_daily.date() == today:
@@ -478,22 +2974,21 @@ async def daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
     base_coins = 50
     base_exp = 30
     streak_bonus = min(db_user.daily_streak * 0.1, 1.0)
-    random_mult = random.uniform(0.8, 1.2)
+    random_mult = game_random.uniform(0.8, 1.2)
     
     coins_bonus = int(base_coins * (1 + streak_bonus) * random_mult)
     exp_bonus = int(base_exp * (1 + streak_bonus) * random_mult)
     
-    # Проверяем пул
-    can_earn, message = RewardSystem.can_earn(coins_bonus)
+    # Списываем из пула одной атомарной операцией
+    success, message = await RewardSystem.reserve(coins_bonus)
     
-    if can_earn:
-        success, _ = RewardSystem.add_earnings(coins_bonus)
-        if success:
-            db_user.balance += coins_bonus
-            db_user.exp += exp_bonus
-            db_user.last_daily = datetime.datetime.now()
-            
-            daily_text = f"""
+    if success:
+        db_user.balance += coins_bonus
+        db_user.exp += exp_bonus
+        db_user.last_daily = datetime.datetime.now()
+        await players.save(db_user)
+        
+        daily_text = f"""
 📅 ЕЖЕДНЕВНЫЙ БОНУС
 
 День {db_user.daily_streak} подряд!
@@ -502,14 +2997,13 @@ async def daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ✨ Опыт: +{exp_bonus}
 
 🔥 Стрик: {db_user.daily_streak} дней
-            """
-        else:
-            daily_text = "⚠️ Пул наград пуст!"
+        """
     else:
         daily_text = f"⚠️ {message}"
     
     await update.message.reply_text(daily_text)
 
+@timed('help_command')
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     help_text = """
 📚 КОМАНДЫ:
@@ -525,28 +3019,32 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(help_text)
 
+@timed('revive')
+@per_user
 async def revive(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
-    if user.id not in users_db:
+    db_user = await players.get(user.id)
+    if db_user is None:
         await update.message.reply_text("Сначала введи /start!")
         return
     
-    db_user = users_db[user.id]
     
     if db_user.hp > 0:
         await update.message.reply_text("Ты еще жив!")
         return
     
-    if db_user.balance < 50:
-        await update.message.reply_text("❌ Недостаточно монет! Нужно 50.")
+    if db_user.balance < REVIVE_COST:
+        await update.message.reply_text(f"❌ Недостаточно монет! Нужно {REVIVE_COST}.")
         return
     
-    db_user.balance -= 50
+    db_user.balance -= REVIVE_COST
     db_user.hp = db_user.max_hp // 2
+    await players.save(db_user)
     
     await update.message.reply_text(f"✨ Ты воскрес! HP: {db_user.hp}")
 
+@timed('status')
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Проверка статуса бота"""
     user = update.effective_user
@@ -557,57 +3055,253 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     pool_status = RewardSystem.get_pool_status()
+    users_count = await players.count()
+    # Отчет считается в пуле процессов и не тормозит игроков
+    economy = await jobs.run(economy_report, await players.player_columns())
+    
+    status_text = render(
+        'status',
+        python_version=platform.python_version(),
+        users_count=users_count,
+        active_battles=len(battles),
+        content_version=CONTENT_VERSION,
+        pool=pool_status,
+        enabled_text='✅ Вкл' if pool_status['enabled'] else '❌ Выкл',
+        economy=economy,
+    )
     
-    status_text = f"""
-📊 СТАТУС БОТА
+    await update.message.reply_text(status_text)
 
-🖥️ Хостинг: Koyeb
-🐍 Python: {platform.python_version()}
-👥 Пользователей: {len(users_db)}
+def is_admin(user_id):
+    return user_id in ADMIN_IDS or user_id == OWNER_ID
 
-💰 ПУЛ НАГРАД:
-• Всего: {pool_status['total_pool']:,} монет
-• Сегодня: {pool_status['distributed_today']:,}/{pool_status['max_daily_pool']:,}
-• Осталось: {pool_status['remaining_today']:,} монет
-• Использовано: {pool_status['percent_used']:.1f}%
-• Статус: {'✅ Вкл' if pool_status['enabled'] else '❌ Выкл'}
-    """
+def broadcast_home(update):
+    """Команды рассылки получают все воркеры, автору отвечает воркер его шарда"""
+    index, count = broadcast_shard
+    return update.effective_user.id % count == index
+
+def broadcast_reply(update):
+    if broadcast_home(update):
+        return update.message.reply_text
     
-    await update.message.reply_text(status_text)
+    async def silent(*args, **kwargs):
+        pass
+    return silent
+
+@timed('broadcast_command')
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/broadcast текст - сообщение всем игрокам"""
+    global broadcast
+    user = update.effective_user
+    reply = broadcast_reply(update)
+    
+    if not is_admin(user.id):
+        await reply("⛔ Доступ запрещен")
+        return
+    
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await reply(
+            "Использование: /broadcast текст\n"
+            "Управление: /broadcast_status, /broadcast_pause, /broadcast_resume, /broadcast_cancel"
+        )
+        return
+    if len(parts[1]) > 4096:
+        await reply("❌ Текст длиннее 4096 символов")
+        return
+    if broadcast is not None and broadcast.active:
+        await reply("⏳ Уже идет рассылка\n\n" + broadcast.report())
+        return
+    
+    broadcast = Broadcast(parts[1], update.effective_chat.id, broadcast_state_path, broadcast_shard, broadcast_peer_paths)
+    # Одно и то же обновление у всех воркеров - его id связывает шарды рассылки
+    broadcast.id = update.update_id
+    broadcast.home = broadcast_home(update)
+    broadcast.start(context.bot)
+    await reply(f"📣 Рассылка запущена: {await players.count():,} игроков")
+
+@timed('broadcast_control')
+async def broadcast_control(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/broadcast_status, /broadcast_pause, /broadcast_resume, /broadcast_cancel"""
+    user = update.effective_user
+    reply = broadcast_reply(update)
+    
+    if not is_admin(user.id):
+        await reply("⛔ Доступ запрещен")
+        return
+    if broadcast is None:
+        await reply("Рассылок еще не было")
+        return
+    
+    action = update.message.text.split()[0].split('@')[0].removeprefix('/broadcast_')
+    if action != 'status' and not broadcast.active:
+        await reply(broadcast.report())
+        return
+    
+    if action == 'pause':
+        broadcast.pause()
+    elif action == 'resume':
+        broadcast.resume(context.bot)
+    elif action == 'cancel':
+        broadcast.cancel()
+    await reply(broadcast.report())
+
+@timed('pool_command')
+async def pool_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/pool - состояние пула, /pool действие [число] - управление"""
+    user = update.effective_user
+    
+    if not is_admin(user.id):
+        await update.message.reply_text("⛔ Доступ запрещен")
+        return
+    
+    args = context.args or []
+    try:
+        if not args:
+            message = None
+        elif args[0] == 'schedule' and len(args) in (3, 4):
+            at = parse_schedule_time(args[1])
+            value = parse_amount(args[3]) if len(args) == 4 else None
+            pool_schedule.add(at, args[2], value)
+            message = f"🗓 {at:%d.%m %H:%M}: {args[2]}"
+        elif args[0] == 'unschedule' and len(args) == 2:
+            pool_schedule.remove(parse_amount(args[1]))
+            message = "🗓 Действие удалено"
+        elif len(args) <= 2:
+            message = await RewardSystem.apply(args[0], parse_amount(args[1]) if len(args) == 2 else None)
+        else:
+            raise ValueError("Слишком много аргументов")
+    except ValueError as exc:
+        await update.message.reply_text(f"❌ {exc}")
+        return
+    
+    if players.shared:
+        # Пул меняют воркеры - читаем актуальное состояние из БД
+        reward_pool.update(await players.storage.load_pool())
+    pool_status = RewardSystem.get_pool_status()
+    pool_text = render(
+        'pool',
+        pool=pool_status,
+        enabled_text='✅ Вкл' if pool_status['enabled'] else '❌ Выкл',
+        max_rate_text=f"{pool_status['max_rate']:,} монет/с" if pool_status['max_rate'] else 'нет',
+        sparkline=RewardSystem.observed.sparkline(),
+        schedule=pool_schedule.describe(),
+    )
+    await update.message.reply_text(f"{message}\n\n{pool_text}" if message else pool_text)
+
+@timed('export_command')
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выгрузка полного рейтинга в CSV"""
+    user = update.effective_user
+    
+    # Только для владельца
+    if user.id != OWNER_ID:
+        await update.message.reply_text("⛔ Доступ запрещен")
+        return
+    
+    data = await jobs.run(export_ranking, await players.player_columns())
+    await update.message.reply_document(
+        document=data,
+        filename=f"rating-{int(time.time())}.csv.gz",
+        caption=f"🏆 Рейтинг: {await players.count():,} игроков",
+    )
+
+@timed('reload_command')
+async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Перечитывает монстров и классы из CONTENT_PATH"""
+    user = update.effective_user
+    
+    # Только для владельца
+    if user.id != OWNER_ID:
+        await update.message.reply_text("⛔ Доступ запрещен")
+        return
+    
+    try:
+        changed = reload_content()
+    except (OSError, ContentError) as exc:
+        await update.message.reply_text(f"❌ Контент не загружен, остается v{CONTENT_VERSION}:\n{exc}")
+        return
+    
+    if changed:
+        await update.message.reply_text(
+            f"✅ Контент v{CONTENT_VERSION}: монстров {len(MONSTERS)}, классов {len(CLASSES)}"
+        )
+    else:
+        await update.message.reply_text(f"Контент v{CONTENT_VERSION} уже загружен (увеличь version)")
+
+@timed('profiler_command')
+async def profiler_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Профилирование на ходу: /profiler [секунд] [top|collapsed]"""
+    user = update.effective_user
+    
+    # Только для владельца
+    if user.id != OWNER_ID:
+        await update.message.reply_text("⛔ Доступ запрещен")
+        return
+    
+    args = context.args or []
+    seconds = int(args[0]) if args and args[0].isdigit() else 10
+    output = args[1] if len(args) > 1 else 'top'
+    if output not in ('top', 'collapsed'):
+        await update.message.reply_text("Использование: /profiler [секунд] [top|collapsed]")
+        return
+    
+    if profiler.running:
+        await update.message.reply_text("⏳ Профилирование уже идет")
+        return
+    
+    await update.message.reply_text(f"🔬 Профилирую {min(seconds, PROFILER_MAX_SECONDS)} с...")
+    # Замер идет в фоне: обработчик не висит seconds секунд и не попадает
+    # в медленные у LoopWatchdog
+    context.application.create_task(reply_profile(update, seconds, output), update=update)
+
+async def reply_profile(update, seconds, output):
+    """Снимает профиль и отправляет его владельцу"""
+    try:
+        result = await profiler.run(seconds)
+    except RuntimeError:
+        # Другая команда успела запустить замер раньше
+        await update.message.reply_text("⏳ Профилирование уже идет")
+        return
+    
+    if output == 'collapsed':
+        await update.message.reply_document(
+            document=result.collapsed().encode(),
+            filename=f"rucoy-{int(time.time())}.collapsed",
+            caption=f"🔬 {result.samples} сэмплов за {result.seconds} с, медленных колбэков: {result.slow_total}",
+        )
+    else:
+        # Ограничение Telegram на длину сообщения
+        await update.message.reply_text(result.top()[:4096])
 
 # ============== ОБРАБОТЧИК КНОПОК ==============
 
+@timed('button_callback', callback_action)
+@per_user
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     user = update.effective_user
     
-    if user.id not in users_db:
-        users_db[user.id] = TempUser(user.id, user.username, user.first_name)
-    
-    db_user = users_db[user.id]
+    db_user = await players.get(user.id)
+    if db_user is None:
+        db_user = await players.create(user.id, user.username, user.first_name)
     
     # Выбор класса
     if query.data.startswith('class_'):
         class_name = query.data.replace('class_', '')
-        db_user.class_name = class_name
+        player_class = CLASSES.get(class_name)
+        if player_class is None:
+            await query.edit_message_text("❌ Такого класса больше нет!", reply_markup=get_class_selection_keyboard())
+            return
         
-        if class_name == 'воин':
-            db_user.max_hp += 20
-            db_user.hp = db_user.max_hp
-            db_user.attack += 5
-            db_user.defense += 10
-        elif class_name == 'лучник':
-            db_user.max_hp += 10
-            db_user.hp = db_user.max_hp
-            db_user.attack += 10
-            db_user.defense += 5
-        elif class_name == 'маг':
-            db_user.max_hp += 5
-            db_user.hp = db_user.max_hp
-            db_user.attack += 15
-            db_user.defense += 5
+        db_user.class_name = class_name
+        db_user.max_hp += player_class['hp_bonus']
+        db_user.hp = db_user.max_hp
+        db_user.attack += player_class['attack_bonus']
+        db_user.defense += player_class['defense_bonus']
+        await players.save(db_user)
         
         await query.edit_message_text(
             f"✅ Ты выбрал класс {class_name.upper()}!\n\n"
@@ -621,7 +3315,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Выбор монстра
     elif query.data.startswith('monster_'):
         monster_id = int(query.data.replace('monster_', ''))
-        monster = MONSTERS[monster_id]
+        monster = MONSTERS.get(monster_id)
+        if monster is None:
+            await query.edit_message_text("❌ Этого монстра больше нет!", reply_markup=get_monster_selection_keyboard())
+            return
         
         if db_user.level < monster['level'] - 2:
             await query.edit_message_text(
@@ -630,119 +3327,111 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        db_user.in_battle = True
-        db_user.battle_with = monster_id
-        db_user.battle_hp = monster['hp']
+        battles.start(db_user.user_id, monster_id, monster['hp'])
         
-        battle_text = f"""
-⚔️ БИТВА С {monster['name']}!
-
-❤️ HP врага: {monster['hp']}
-💰 Награда: {monster['coins_range'][0]}-{monster['coins_range'][1]} монет
-
-❤️ Твое HP: {db_user.hp}/{db_user.max_hp}
-⚔️ Атака: {db_user.attack}
-🛡 Защита: {db_user.defense}
-
-🎮 Твой ход!
-        """
+        battle_text = render('battle_start', monster=monster, user=db_user)
         
         await query.edit_message_text(battle_text, reply_markup=get_battle_keyboard())
     
     # Действия в битве
     elif query.data == 'battle_attack':
-        if not db_user.in_battle:
+        session = battles.get(db_user.user_id)
+        if session is None:
             await query.edit_message_text("❌ Битва не найдена!")
             return
         
-        monster_id = db_user.battle_with
-        monster = MONSTERS[monster_id]
+        monster = MONSTERS.get(session.monster_id)
+        if monster is None:
+            # Монстра убрали из контента посреди боя
+            battles.finish(db_user.user_id)
+            await query.edit_message_text("❌ Монстр исчез!", reply_markup=get_main_keyboard())
+            return
         
-        result = GameLogic.calculate_battle(db_user, monster)
+        result = GameLogic.calculate_battle(db_user, monster, session.monster_hp, session.rng)
         
-        db_user.battle_hp = result['monster_hp_left']
+        battles.touch(session)
+        session.monster_hp = result['monster_hp_left']
         db_user.hp = result['player_hp_left']
         
         # Проверка смерти игрока
         if db_user.hp <= 0:
             db_user.deaths += 1
-            db_user.in_battle = False
+            battles.finish(db_user.user_id)
             db_user.hp = 0
+            await players.save(db_user)
             
             await query.edit_message_text(
-                f"💀 Ты погиб! Воскресни за 50 монет.",
+                f"💀 Ты погиб! Воскресни за {REVIVE_COST} монет.",
                 reply_markup=get_main_keyboard()
             )
             return
         
         # Проверка победы
         if result['monster_hp_left'] <= 0:
-            reward = GameLogic.calculate_reward(monster, db_user.level)
+            reward = GameLogic.calculate_reward(monster, db_user.level, session.rng)
             
-            # Проверяем пул
-            can_earn, message = RewardSystem.can_earn(reward['coins'])
+            # Списываем из пула одной атомарной операцией
+            success, message = await RewardSystem.reserve(reward['coins'])
             
-            if can_earn:
-                success, _ = RewardSystem.add_earnings(reward['coins'])
+            if success:
+                db_user.balance += reward['coins']
+                db_user.exp += reward['exp']
+                db_user.kills += 1
+                db_user.rating += 10
                 
-                if success:
-                    db_user.balance += reward['coins']
-                    db_user.exp += reward['exp']
-                    db_user.kills += 1
-                    db_user.rating += 10
-                    
-                    if reward['drop']:
-                        db_user.inventory[reward['drop']] = db_user.inventory.get(reward['drop'], 0) + 1
-                    
-                    # Проверка уровня
-                    new_level, _, _ = GameLogic.calculate_level(db_user.exp)
-                    if new_level > db_user.level:
-                        old_level = db_user.level
-                        while db_user.level < new_level:
-                            db_user.level += 1
-                            db_user.max_hp += 20
-                            db_user.hp = db_user.max_hp
-                            db_user.attack += 3
-                            db_user.defense += 2
-                        
-                        level_text = f"\n\n✨ НОВЫЙ УРОВЕНЬ! {db_user.level}!"
-                    else:
-                        level_text = ""
+                if reward['drop']:
+                    db_user.add_item(reward['drop'])
+                
+                # Проверка уровня
+                new_level, _, _ = GameLogic.calculate_level(db_user.exp)
+                if new_level > db_user.level:
+                    while db_user.level < new_level:
+                        db_user.level += 1
+                        db_user.max_hp += HP_PER_LEVEL
+                        db_user.hp = db_user.max_hp
+                        db_user.attack += ATTACK_PER_LEVEL
+                        db_user.defense += DEFENSE_PER_LEVEL
                     
-                    victory_text = f"""
-🏆 ПОБЕДА!
-
-💰 Монеты: +{reward['coins']}
-✨ Опыт: +{reward['exp']}
-📊 Модификатор: {reward['modifier']:.1f}x
-{('📦 Дроп: ' + reward['drop']) if reward['drop'] else ''}{level_text}
-                    """
+                    level_text = f"\n\n✨ НОВЫЙ УРОВЕНЬ! {db_user.level}!"
                 else:
-                    victory_text = "⚠️ Ошибка начисления награды"
+                    level_text = ""
+                
+                victory_text = render(
+                    'victory',
+                    reward=reward,
+                    drop_text=('📦 Дроп: ' + reward['drop']) if reward['drop'] else '',
+                    level_text=level_text,
+                )
             else:
                 victory_text = f"⚠️ {message}\nНаграда не начислена."
             
-            db_user.in_battle = False
+            battles.finish(db_user.user_id)
+            await players.save(db_user)
             await query.edit_message_text(victory_text, reply_markup=get_main_keyboard())
             return
         
         # Продолжение боя
-        result_text = f"""
-⚔️ ТВОЯ АТАКА!
-
-Ты нанес {result['player_damage']} урона!
-HP врага: {result['monster_hp_left']}/{monster['hp']}
-
-{'✅ КРИТ!' if result['crit'] else ''}
-Получено урона: {result['monster_damage']}
-Твое HP: {db_user.hp}/{db_user.max_hp}
-        """
+        await players.save(db_user)
+        result_text = render(
+            'battle_turn',
+            result=result,
+            monster=monster,
+            user=db_user,
+            crit_text='✅ КРИТ!' if result['crit'] else '',
+        )
         
         await query.edit_message_text(result_text, reply_markup=get_battle_keyboard())
     
     elif query.data == 'battle_defend':
+        session = battles.get(db_user.user_id)
+        if session is None:
+            await query.edit_message_text("❌ Битва не найдена!")
+            return
+        
+        battles.touch(session)
         heal = int(db_user.max_hp * 0.1)
         db_user.hp = min(db_user.max_hp, db_user.hp + heal)
+        await players.save(db_user)
         await query.edit_message_text(
             f"🛡 Защита! Восстановлено +{heal} HP\n"
             f"Текущее HP: {db_user.hp}/{db_user.max_hp}",
@@ -750,7 +3439,7 @@ HP врага: {result['monster_hp_left']}/{monster['hp']}
         )
     
     elif query.data == 'battle_flee':
-        db_user.in_battle = False
+        battles.finish(db_user.user_id)
         await query.edit_message_text(
             "🏃 Ты сбежал!",
             reply_markup=get_main_keyboard()
@@ -758,6 +3447,8 @@ HP врага: {result['monster_hp_left']}/{monster['hp']}
 
 # ============== ОБРАБОТЧИК СООБЩЕНИЙ ==============
 
+# Без @timed: кнопки ведут в обработчики, которые замеряются сами, и
+# handle_message лишь повторял бы их в метриках и в LoopWatchdog
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     
@@ -778,47 +3469,634 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("Используй кнопки меню")
 
-# ============== FLASK APP ДЛЯ HEALTH CHECK ==============
+# ============== ИСХОДЯЩИЕ СООБЩЕНИЯ ==============
 
-app = Flask(__name__)
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
 
-@app.route('/')
-def index():
-    return '🤖 Rucoy Bot is running!'
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
 
-@app.route('/health')
-def health():
-    return 'OK', 200
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
 
-@app.route('/stats')
-def stats():
-    pool_status = RewardSystem.get_pool_status()
-    return {
-        'users': len(users_db),
-        'pool': pool_status,
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now):
+        """Занимает токен (можно в долг), возвращает сколько ждать до отправки"""
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def wait_time(self, now):
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def refund(self):
+        """Возвращает занятый, но не потраченный токен"""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def pause(self, seconds):
+        """После 429 не выдаем токены seconds секунд"""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+class SendScheduler(BaseRateLimiter):
+    """Планировщик исходящих запросов к Bot API
+
+    - ведро токенов на каждый чат и общее ведро на бота, чтобы не ловить 429;
+    - сначала запрос ждет свой чат, затем общую очередь по приоритету,
+      поэтому ходы в бою обгоняют рассылку (PRIORITY_BROADCAST);
+    - если пока правка ждала очереди, пришла новая правка того же сообщения,
+      старая не отправляется вовсе и не тратит токены.
+
+    Обработчики с per_user ждут отправки своей правки, прежде чем игрок
+    сможет вызвать следующую, поэтому правки одного сообщения перекрываются
+    редко: в основном при повторах после 429 и из фоновых задач.
+    """
+
+    # Эти запросы не упираются в лимиты на сообщения
+    UNLIMITED = frozenset({
+        'answerCallbackQuery', 'answerInlineQuery', 'getMe', 'getUpdates',
+        'setWebhook', 'deleteWebhook', 'getWebhookInfo', 'logOut', 'close',
+    })
+
+    def __init__(self, global_rate=TG_GLOBAL_RATE, chat_rate=TG_CHAT_RATE,
+                 chat_burst=TG_CHAT_BURST, group_rate=TG_GROUP_RATE, max_retries=TG_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, max(1, int(global_rate)))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._chats = {}
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._dispatcher = None
+        self._edits = {}
+        self.sent = 0
+        self.merged = 0
+        self.retries = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 50_000:
+                self._forget_idle_chats(now)
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.chat_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _forget_idle_chats(self, now):
+        # Ведро, простоявшее минуту, уже полное - его можно создать заново
+        for chat_id in [c for c, b in self._chats.items() if now - b.updated > 60]:
+            del self._chats[chat_id]
+
+    async def _acquire_global(self, priority):
+        now = time.monotonic()
+        if not self._waiting and self.global_bucket.wait_time(now) == 0:
+            self.global_bucket.take()
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._sequence), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        """Раздает общие токены ожидающим в порядке приоритета"""
+        while self._waiting:
+            delay = self.global_bucket.wait_time(time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiting)
+            if not future.done():
+                self.global_bucket.take()
+                future.set_result(None)
+
+    async def _call(self, callback, args, kwargs, endpoint):
+        """Сам запрос к Bot API с замером времени и ошибок"""
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except TelegramError as exc:
+            TELEGRAM_ERRORS.labels(endpoint, type(exc).__name__).inc()
+            raise
+        finally:
+            TELEGRAM_LATENCY.labels(endpoint).observe(time.perf_counter() - started)
+
+    def _superseded(self, edit_key, sequence):
+        if self._edits.get(edit_key) == sequence:
+            return False
+        # Сообщение уже переписывает более свежая правка
+        self.merged += 1
+        return True
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in self.UNLIMITED:
+            return await self._call(callback, args, kwargs, endpoint)
+        
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        chat_id = data.get('chat_id')
+        
+        edit_key = None
+        if endpoint.startswith('edit'):
+            edit_key = (chat_id, data.get('message_id'), data.get('inline_message_id'))
+            sequence = next(self._sequence)
+            self._edits[edit_key] = sequence
+        
+        try:
+            for attempt in range(self.max_retries + 1):
+                chat_bucket = None
+                if chat_id is not None:
+                    chat_bucket = self._chat_bucket(chat_id, time.monotonic())
+                    if edit_key is None:
+                        delay = chat_bucket.reserve(time.monotonic())
+                        if delay:
+                            await asyncio.sleep(delay)
+                    else:
+                        # Правка не занимает токен в долг: иначе каждая вытесненная
+                        # отодвигала бы отправку той, что в итоге уйдет
+                        delay = chat_bucket.wait_time(time.monotonic())
+                        while delay > 0:
+                            await asyncio.sleep(delay)
+                            if self._superseded(edit_key, sequence):
+                                return True
+                            delay = chat_bucket.wait_time(time.monotonic())
+                        chat_bucket.take()
+                await self._acquire_global(priority)
+                
+                if edit_key is not None and self._superseded(edit_key, sequence):
+                    self.global_bucket.refund()
+                    if chat_bucket is not None:
+                        chat_bucket.refund()
+                    return True
+                
+                try:
+                    result = await self._call(callback, args, kwargs, endpoint)
+                except RetryAfter as exc:
+                    if attempt == self.max_retries:
+                        raise
+                    self.retries += 1
+                    logger.warning("Telegram попросил подождать %s с (%s)", exc.retry_after, endpoint)
+                    self.global_bucket.pause(exc.retry_after)
+                    if chat_bucket is not None:
+                        chat_bucket.pause(exc.retry_after)
+                    continue
+                
+                self.sent += 1
+                return result
+        finally:
+            if edit_key is not None and self._edits.get(edit_key) == sequence:
+                del self._edits[edit_key]
+
+# ============== РАССЫЛКА ==============
+# Получатели читаются из хранилища пачками по user_id, поэтому память не
+# зависит от числа игроков. Сообщения уходят через SendScheduler с
+# PRIORITY_BROADCAST: рассылка идет на пределе общего лимита, но ходы в бою
+# всегда обгоняют ее в очереди. Прогресс сохраняется в BROADCAST_STATE_PATH,
+# и после рестарта рассылка ждет /broadcast_resume с того же места.
+# При WORKERS > 1 команды рассылки получают все воркеры: каждый пишет своему
+# шарду игроков (user_id % WORKERS) со своей долей общего лимита, а отвечает
+# и присылает общий отчет воркер, в шард которого попал автор.
+
+BROADCAST_CHUNK = int(os.getenv('BROADCAST_CHUNK', 500))
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', 8))
+BROADCAST_STATE_PATH = os.getenv('BROADCAST_STATE_PATH', 'broadcast.json')
+BROADCAST_CHECKPOINT_INTERVAL = float(os.getenv('BROADCAST_CHECKPOINT_INTERVAL', 1.0))
+
+BROADCAST_MESSAGES = Counter('rucoy_broadcast_messages', 'Сообщения рассылки', ['result'])
+
+class Broadcast:
+    """Одна рассылка: текст, позиция в списке игроков и счетчики
+
+    Позиция - наибольший user_id, до которого включительно все уже
+    отправлено. После сбоя повторно могут уйти только сообщения, отправленные
+    за последние BROADCAST_CHECKPOINT_INTERVAL секунд. Счетчики сдвигаются
+    вместе с позицией, поэтому повторно отправленные не считаются дважды.
+    """
+
+    STATE_FIELDS = (
+        'text', 'author_id', 'status', 'last_user_id', 'delivered', 'blocked', 'failed', 'started_at',
+        'id', 'home',
+    )
+
+    def __init__(self, text, author_id, state_path=BROADCAST_STATE_PATH, shard=(0, 1), peer_paths=()):
+        self.text = text
+        self.author_id = author_id
+        self.state_path = state_path
+        # Свой шард (номер, всего) и файлы прогресса остальных шардов
+        self.shard = shard
+        self.peer_paths = peer_paths
+        # id общий у всех шардов одной рассылки, home - этот шард отчитывается автору
+        self.id = None
+        self.home = True
+        self.status = 'running'
+        self.last_user_id = 0
+        self.delivered = 0
+        self.blocked = 0
+        self.failed = 0
+        self.started_at = int(time.time())
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+        self._saved_at = 0.0
+        self._task = None
+
+    @classmethod
+    def restore(cls, state_path=BROADCAST_STATE_PATH, shard=(0, 1), peer_paths=()):
+        """Незаконченная рассылка из файла (на паузе) или None"""
+        state = cls._load_state(state_path)
+        if state is None or state['status'] not in ('running', 'paused'):
+            return None
+        
+        broadcast = cls(state['text'], state['author_id'], state_path, shard, peer_paths)
+        for field in cls.STATE_FIELDS:
+            # id и home нет в файлах, сохраненных до шардирования рассылки
+            if field in state:
+                setattr(broadcast, field, state[field])
+        broadcast.pause()
+        return broadcast
+
+    @staticmethod
+    def _load_state(path):
+        try:
+            with open(path, encoding='utf-8') as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def state(self):
+        return {field: getattr(self, field) for field in self.STATE_FIELDS}
+
+    def _save(self):
+        path = self.state_path + '.tmp'
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.state(), file, ensure_ascii=False)
+        os.replace(path, self.state_path)
+        self._saved_at = time.monotonic()
+
+    def _peer_states(self):
+        """Последний сохраненный прогресс других шардов этой же рассылки"""
+        states = [self._load_state(path) for path in self.peer_paths]
+        return [state for state in states if state is not None and state.get('id') == self.id]
+
+    @property
+    def active(self):
+        return self.status in ('running', 'paused')
+
+    @property
+    def processed(self):
+        return self.delivered + self.blocked + self.failed
+
+    def start(self, bot):
+        self._save()
+        self._task = asyncio.create_task(self._run(bot))
+
+    def pause(self):
+        self.status = 'paused'
+        self._resumed.clear()
+        self._save()
+
+    def resume(self, bot):
+        self.status = 'running'
+        self._resumed.set()
+        if self._task is None or self._task.done():
+            self.start(bot)
+        else:
+            self._save()
+
+    def cancel(self):
+        self.status = 'cancelled'
+        self._resumed.set()
+        self._save()
+
+    async def _send(self, bot, user_id):
+        """Отправляет одно сообщение, возвращает имя счетчика результата"""
+        try:
+            await bot.send_message(user_id, self.text, rate_limit_args=PRIORITY_BROADCAST)
+        except Forbidden:
+            # Игрок заблокировал бота или удалил аккаунт
+            result = 'blocked'
+        except TelegramError as exc:
+            result = 'failed'
+            logger.warning("Рассылка: не доставлено %s: %s", user_id, exc)
+        else:
+            result = 'delivered'
+        BROADCAST_MESSAGES.labels(result).inc()
+        return result
+
+    def _count(self, result):
+        setattr(self, result, getattr(self, result) + 1)
+
+    async def _send_chunk(self, bot, chunk):
+        """Отправляет пачку BROADCAST_WORKERS параллельными отправителями"""
+        results = [None] * len(chunk)
+        positions = iter(range(len(chunk)))
+        mark = 0
+        
+        async def sender():
+            nonlocal mark
+            for position in positions:
+                await self._resumed.wait()
+                if self.status == 'cancelled':
+                    return
+                results[position] = await self._send(bot, chunk[position])
+                # Позицию и счетчики сдвигаем только по непрерывно отправленному
+                # началу пачки: в файле они всегда описывают одних и тех же игроков
+                while mark < len(results) and results[mark] is not None:
+                    self._count(results[mark])
+                    mark += 1
+                if mark:
+                    self.last_user_id = chunk[mark - 1]
+                if time.monotonic() - self._saved_at >= BROADCAST_CHECKPOINT_INTERVAL:
+                    self._save()
+        
+        await asyncio.gather(*(sender() for _ in range(BROADCAST_WORKERS)))
+        if self.status == 'cancelled':
+            # Отмененную рассылку не продолжат - ушедшие вне очереди тоже считаем
+            for result in results[mark:]:
+                if result is not None:
+                    self._count(result)
+
+    async def _run(self, bot):
+        index, count = self.shard
+        try:
+            while self.status != 'cancelled':
+                await self._resumed.wait()
+                if self.status == 'cancelled':
+                    break
+                user_ids = await players.storage.user_ids_after(self.last_user_id, BROADCAST_CHUNK)
+                if not user_ids:
+                    self.status = 'done'
+                    break
+                await self._send_chunk(bot, [user_id for user_id in user_ids if user_id % count == index])
+                if self.status != 'cancelled':
+                    # Чужие игроки пачки тоже пройдены: ими занимаются другие шарды
+                    self.last_user_id = user_ids[-1]
+        except Exception:
+            logger.exception("Рассылка остановлена на user_id %s", self.last_user_id)
+            self.pause()
+            return
+        
+        self._save()
+        logger.info("Рассылка завершена (шард %s из %s): %s", index + 1, count, self.report())
+        if not self.home:
+            return
+        # Общий отчет - когда закончат все шарды
+        while True:
+            states = self._peer_states()
+            if len(states) == len(self.peer_paths) and all(state['status'] in ('done', 'cancelled') for state in states):
+                break
+            await asyncio.sleep(1)
+        try:
+            await bot.send_message(self.author_id, self.report())
+        except TelegramError:
+            logger.exception("Не удалось отправить отчет о рассылке")
+
+    def report(self):
+        """Отчет по всем шардам: свой прогресс живой, чужой - на их последний чекпоинт"""
+        titles = {
+            'running': '📣 Идет', 'paused': '⏸ На паузе', 'done': '✅ Завершена', 'cancelled': '🛑 Отменена',
+        }
+        states = [self.state()] + self._peer_states()
+        statuses = {state['status'] for state in states}
+        status = next(status for status in ('running', 'paused', 'cancelled', 'done') if status in statuses)
+        return (
+            f"{titles[status]} рассылка\n"
+            f"✉️ Доставлено: {sum(state['delivered'] for state in states):,}\n"
+            f"🚫 Заблокировали бота: {sum(state['blocked'] for state in states):,}\n"
+            f"⚠️ Ошибок: {sum(state['failed'] for state in states):,}\n"
+            f"📍 Последний user_id: {min(state['last_user_id'] for state in states)}"
+        )
+
+# Текущая рассылка (одна на процесс), файл ее прогресса, шард процесса
+# и файлы прогресса остальных шардов
+broadcast = None
+broadcast_state_path = BROADCAST_STATE_PATH
+broadcast_shard = (0, 1)
+broadcast_peer_paths = ()
+
+def restore_broadcast(state_path=BROADCAST_STATE_PATH, shard=(0, 1), peer_paths=()):
+    """Поднимает прерванную рестартом рассылку, она ждет /broadcast_resume"""
+    global broadcast, broadcast_state_path, broadcast_shard, broadcast_peer_paths
+    
+    broadcast_state_path = state_path
+    broadcast_shard = shard
+    broadcast_peer_paths = peer_paths
+    broadcast = Broadcast.restore(state_path, shard, peer_paths)
+    if broadcast is not None:
+        logger.warning("Рассылка прервана на user_id %s, продолжить: /broadcast_resume", broadcast.last_user_id)
+
+# ============== HTTP СЕРВЕР ==============
+# aiohttp работает в том же цикле событий, что и бот: health check,
+# статистика и вебхук обслуживаются без отдельного потока.
+
+routes = web.RouteTableDef()
+
+# Куда передавать обновления из вебхука, задается режимом запуска
+webhook_sink = None
+
+@routes.get('/')
+async def index(request):
+    return web.Response(text='🤖 Rucoy Bot is running!')
+
+@routes.get('/health')
+async def health(request):
+    if watchdog.saturated:
+        # Koyeb считает инстанс нездоровым и перестает слать ему трафик
+        return web.Response(status=503, text=f'Event loop saturated: lag {watchdog.average_lag:.2f}s')
+    return web.Response(text='OK')
+
+@routes.get('/stats')
+async def stats(request):
+    if players is None:
+        return web.json_response({'status': 'starting'}, status=503)
+    
+    if players.shared:
+        # Пул меняют воркеры - читаем актуальное состояние из БД
+        reward_pool.update(await players.storage.load_pool())
+    
+    data = {
+        'users': await players.count(),
+        'pool': RewardSystem.get_pool_status(),
+        'battles': battles.stats(),
+        'loop': watchdog.stats(),
+        'jobs': jobs.stats(),
         'status': 'active'
     }
+    if worker_queues:
+        data['workers'] = len(worker_queues)
+        data['queued'] = [queue.qsize() for queue in worker_queues]
+    return web.json_response(data)
 
-# ============== ЗАПУСК БОТА ==============
+@routes.get('/metrics')
+async def metrics(request):
+    sample_gauges()
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return web.Response(body=generate_latest(registry), headers={'Content-Type': CONTENT_TYPE_LATEST})
 
-async def run_bot():
-    """Запуск бота"""
-    global application
+def admin_only(handler):
+    """Админский маршрут: 404 без ADMIN_TOKEN, 403 при неверном X-Admin-Token"""
+    @functools.wraps(handler)
+    async def wrapper(request):
+        if not ADMIN_TOKEN:
+            return web.Response(status=404, text='Admin API disabled')
+        token = request.headers.get('X-Admin-Token', '')
+        if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return web.Response(status=403, text='Forbidden')
+        return await handler(request)
+    return wrapper
+
+@routes.get('/admin/profile')
+@admin_only
+async def admin_profile(request):
+    """Профиль процесса HTTP сервера: ?seconds=10&format=top|collapsed"""
+    output = request.query.get('format', 'top')
+    seconds = request.query.get('seconds', '10')
+    if output not in ('top', 'collapsed') or not seconds.isdigit():
+        return web.Response(status=400, text='Bad Request')
+    if profiler.running:
+        return web.Response(status=409, text='Profiling already running')
     
-    # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
-    
-    # ConversationHandler для создания персонажа
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
-        states={
-            CHOOSING_CLASS: [CallbackQueryHandler(button_callback)],
-        },
-        fallbacks=[CommandHandler('start', start)]
+    result = await profiler.run(int(seconds))
+    return web.Response(text=result.collapsed() if output == 'collapsed' else result.top())
+
+@routes.get('/admin/economy')
+@admin_only
+async def admin_economy(request):
+    """Экономический отчет по всем игрокам (считается в пуле процессов)"""
+    return web.json_response(await jobs.run(economy_report, await players.player_columns()))
+
+@routes.get('/admin/pool')
+@admin_only
+async def admin_pool(request):
+    """Состояние пула, ряд расхода по секундам (?seconds=60) и расписание"""
+    seconds = request.query.get('seconds', '60')
+    if not seconds.isdigit():
+        return web.Response(status=400, text='Bad Request')
+    
+    if players.shared:
+        reward_pool.update(await players.storage.load_pool())
+    return web.json_response({
+        'pool': RewardSystem.get_pool_status(),
+        'spend_per_second': RewardSystem.observed.series(int(seconds)),
+        'schedule': pool_schedule.entries,
+    })
+
+@routes.post('/admin/pool')
+@admin_only
+async def admin_pool_action(request):
+    """{"action": "refill|cap|rate|pause|resume", "value": 100, "at": "2024-01-01T18:00"}
+
+    С "at" действие откладывается, {"action": "unschedule", "value": номер} - отменяет.
+    """
+    try:
+        body = await request.json()
+        action, value = body['action'], body.get('value')
+        if value is not None and not isinstance(value, int):
+            raise ValueError("value должно быть целым")
+        if action == 'unschedule':
+            pool_schedule.remove(value or 0)
+            message = "unscheduled"
+        elif body.get('at'):
+            pool_schedule.add(parse_schedule_time(body['at']), action, value)
+            message = "scheduled"
+        else:
+            message = await RewardSystem.apply(action, value)
+    except (ValueError, KeyError, TypeError) as exc:
+        return web.json_response({'error': str(exc)}, status=400)
+    
+    return web.json_response({
+        'message': message,
+        'pool': RewardSystem.get_pool_status(),
+        'schedule': pool_schedule.entries,
+    })
+
+@routes.post(WEBHOOK_PATH)
+async def webhook(request):
+    """Прием обновлений от Telegram"""
+    if webhook_sink is None:
+        return web.Response(status=404, text='Webhook disabled')
+    
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        return web.Response(status=403, text='Forbidden')
+    
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return web.Response(status=400, text='Bad Request')
+    
+    webhook_sink(data)
+    return web.Response(text='OK')
+
+def create_web_app():
+    web_app = web.Application()
+    web_app.add_routes(routes)
+    return web_app
+
+async def start_web_server(port):
+    """Поднимает HTTP сервер в текущем цикле событий"""
+    runner = web.AppRunner(create_web_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    print(f"🌐 HTTP сервер запущен на порту {port}")
+    return runner
+
+def install_stop_signals():
+    """SIGTERM от Koyeb и Ctrl+C завершают работу через bot_stop"""
+    global bot_stop
+    
+    bot_stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, bot_stop.set)
+
+# ============== ЗАПУСК БОТА ==============
+
+def build_application(updater=True):
+    """Создает Application со всеми обработчиками"""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(TG_API_URL)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        # В режиме масштабирования общий лимит делится между воркерами
+        .rate_limiter(SendScheduler(global_rate=TG_GLOBAL_RATE / WORKERS))
     )
+    if not updater:
+        # Обновления приходят из вебхука, long polling не нужен
+        builder = builder.updater(None)
+    application = builder.build()
     
-    # Добавляем обработчики
-    application.add_handler(conv_handler)
+    # Добавляем обработчики. Без ConversationHandler: его состояние не рассчитано
+    # на concurrent_updates, а выбор класса ловит общий button_callback
+    application.add_handler(CommandHandler('start', start))
     application.add_handler(CommandHandler('profile', profile))
     application.add_handler(CommandHandler('balance', balance))
     application.add_handler(CommandHandler('rating', rating_command))
@@ -828,40 +4106,281 @@ async def run_bot():
     application.add_handler(CommandHandler('help', help_command))
     application.add_handler(CommandHandler('revive', revive))
     application.add_handler(CommandHandler('status', status))
+    application.add_handler(CommandHandler('profiler', profiler_command))
+    application.add_handler(CommandHandler('reload', reload_command))
+    application.add_handler(CommandHandler('export', export_command))
+    application.add_handler(CommandHandler('pool', pool_command))
+    application.add_handler(CommandHandler('broadcast', broadcast_command))
+    application.add_handler(CommandHandler(
+        ['broadcast_status', 'broadcast_pause', 'broadcast_resume', 'broadcast_cancel'], broadcast_control
+    ))
     
     application.add_handler(CallbackQueryHandler(button_callback))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
+    return application
+
+async def init_storage(shared=False):
+    """Подключает хранилище и пул наград
+
+    shared=True - состояние делят несколько процессов: пул списывается
+    в БД, а рейтинг и число игроков читаются из БД, а не из памяти.
+    """
+    global players
+    
+    if STORAGE_BACKEND == 'snapshot':
+        if shared or POOL_BACKEND == 'sql':
+            raise RuntimeError("STORAGE_BACKEND=snapshot работает только в одном процессе с POOL_BACKEND=memory")
+        # Запись в журнал дешевая - сохраняем каждое изменение сразу, без буфера
+        players = PlayerRepository(SnapshotStorage(SNAPSHOT_DIR), batch_size=1)
+    else:
+        players = PlayerRepository(Storage(DATABASE_URL), shared=shared)
+    await players.init()
+    
+    if shared or POOL_BACKEND == 'sql':
+        RewardSystem.backend = SqlRewardPool(players.storage)
+        if shared:
+            RewardSystem.observed = SpendRate()
+    else:
+        RewardSystem.backend = InMemoryRewardPool(players)
+
+async def set_webhook(bot=None):
+    """Регистрирует вебхук в Telegram"""
+    if bot is None:
+        async with Bot(BOT_TOKEN, base_url=TG_API_URL) as bot:
+            return await set_webhook(bot)
+    
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+
+def feed_update(data):
+    """Передает обновление из вебхука в очередь Application"""
+    application.update_queue.put_nowait(Update.de_json(data, application.bot))
+
+async def start_receiving_updates():
+    """Включает вебхук, а если он не настроен или недоступен - long polling"""
+    global webhook_sink
+    
+    if UPDATE_MODE == 'webhook':
+        if not WEBHOOK_URL:
+            logger.warning("UPDATE_MODE=webhook без WEBHOOK_URL, используем polling")
+        else:
+            try:
+                await set_webhook(application.bot)
+            except TelegramError:
+                logger.exception("Не удалось установить вебхук, используем polling")
+            else:
+                webhook_sink = feed_update
+                print(f"🔗 Вебхук: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+                return
+    
+    # start_polling сам снимает вебхук
+    await application.updater.start_polling()
+
+async def run_bot(port):
+    """Запуск бота и HTTP сервера в одном цикле событий"""
+    global application, webhook_sink
+    
+    install_stop_signals()
+    
+    # Подключаем хранилище
+    await init_storage()
+    
+    # Создаем приложение
+    application = build_application()
+    
     # Запускаем бота
     print(f"🤖 Бот запущен! Владелец ID: {OWNER_ID}")
     print(f"💰 Пул наград: {DEFAULT_TOTAL_POOL:,} монет")
     
     await application.initialize()
     await application.start()
+    runner = await start_web_server(port)
+    sweeper = asyncio.create_task(battles.sweep_forever())
+    monitor = asyncio.create_task(watchdog.monitor_forever())
+    content_watcher = asyncio.create_task(watch_content_forever())
+    pool_resetter = asyncio.create_task(pool_reset_forever())
+    pool_schedule.load()
+    pool_scheduler = asyncio.create_task(pool_schedule.run_forever())
+    restore_broadcast()
     
-    # Используем polling
-    await application.updater.start_polling()
+    await start_receiving_updates()
     
-    # Держим бота запущенным
-    while True:
-        await asyncio.sleep(1)
+    # Держим бота запущенным до сигнала остановки
+    try:
+        await bot_stop.wait()
+    finally:
+        webhook_sink = None
+        sweeper.cancel()
+        monitor.cancel()
+        content_watcher.cancel()
+        pool_resetter.cancel()
+        pool_scheduler.cancel()
+        if broadcast is not None and broadcast.active:
+            broadcast.pause()
+        await runner.cleanup()
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        # Сбрасываем буфер несохраненных изменений
+        await players.close()
+        await jobs.close()
+        print("💾 Данные игроков сохранены")
 
-def main():
-    """Главная функция"""
-    import asyncio
-    import threading
+# ============== РЕЖИМ МАСШТАБИРОВАНИЯ ==============
+# Главный процесс принимает вебхук и раскладывает обновления по воркерам
+# по user_id: все действия одного игрока попадают в один процесс и
+# выполняются по порядку, разные игроки обрабатываются параллельно.
+# Общее состояние (игроки, пул, рейтинг) живет в БД.
+
+worker_queues = []
+
+def update_user_id(data):
+    """Достает id пользователя из сырого обновления Telegram"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        sender = value.get('from') or value.get('user')
+        if sender:
+            return sender['id']
+        chat = value.get('chat')
+        if chat:
+            return chat['id']
+    return 0
+
+def is_broadcast_command(data):
+    text = (data.get('message') or {}).get('text') or ''
+    return text.startswith('/broadcast')
+
+def dispatch_to_worker(data):
+    if is_broadcast_command(data):
+        # Рассылку ведут все воркеры, каждый по своему шарду игроков
+        for queue in worker_queues:
+            queue.put(data)
+        return
+    shard = update_user_id(data) % len(worker_queues)
+    worker_queues[shard].put(data)
+
+async def worker_loop(index, queue):
+    """Цикл воркера: берет обновления своего шарда и отдает их Application"""
+    global application
+    
+    await init_storage(shared=True)
+    RewardSystem.shards = WORKERS
+    application = build_application(updater=False)
+    await application.initialize()
+    await application.start()
+    sweeper = asyncio.create_task(battles.sweep_forever())
+    sampler = asyncio.create_task(sample_gauges_forever())
+    monitor = asyncio.create_task(watchdog.monitor_forever())
+    content_watcher = asyncio.create_task(watch_content_forever())
+    pool_resetter = asyncio.create_task(pool_reset_forever())
+    pool_spend_sampler = asyncio.create_task(sample_pool_spend_forever())
+    # Команды админа всегда попадают в один шард, но у каждого воркера свои файлы
+    pool_schedule.load(f"{POOL_SCHEDULE_PATH}.worker{index}")
+    pool_scheduler = asyncio.create_task(pool_schedule.run_forever())
+    restore_broadcast(
+        f"{BROADCAST_STATE_PATH}.worker{index}",
+        shard=(index, WORKERS),
+        peer_paths=tuple(f"{BROADCAST_STATE_PATH}.worker{peer}" for peer in range(WORKERS) if peer != index),
+    )
+    logger.info("Воркер %s запущен", index)
+    
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            # Шард гарантирует один процесс на игрока, per_user - порядок внутри процесса
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        sweeper.cancel()
+        sampler.cancel()
+        monitor.cancel()
+        content_watcher.cancel()
+        pool_resetter.cancel()
+        pool_spend_sampler.cancel()
+        pool_scheduler.cancel()
+        if broadcast is not None and broadcast.active:
+            broadcast.pause()
+        await application.stop()
+        await application.shutdown()
+        await players.close()
+        await jobs.close()
+        logger.info("Воркер %s остановлен", index)
+
+def run_worker(index, queue):
+    """Точка входа процесса-воркера"""
+    # Останавливается по None в очереди от главного процесса
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(worker_loop(index, queue))
+
+async def run_scaled(port):
+    """Запуск в режиме нескольких процессов-воркеров"""
+    global webhook_sink
+    
+    if not WEBHOOK_URL:
+        raise RuntimeError("Для WORKERS > 1 нужен WEBHOOK_URL")
+    
+    install_stop_signals()
     
-    # Запускаем бота в отдельном потоке
-    def start_bot():
-        asyncio.run(run_bot())
+    context = multiprocessing.get_context('spawn')
+    for _ in range(WORKERS):
+        worker_queues.append(context.Queue())
     
-    bot_thread = threading.Thread(target=start_bot, daemon=True)
-    bot_thread.start()
+    processes = [
+        context.Process(target=run_worker, args=(index, queue), name=f'worker-{index}')
+        for index, queue in enumerate(worker_queues)
+    ]
+    for process in processes:
+        process.start()
+    
+    # Главному процессу хранилище нужно для /stats и /admin/pool
+    await init_storage(shared=True)
+    runner = await start_web_server(port)
+    monitor = asyncio.create_task(watchdog.monitor_forever())
+    # Сброс дня делают воркеры, здесь - только действия, отложенные через HTTP
+    pool_schedule.load()
+    pool_scheduler = asyncio.create_task(pool_schedule.run_forever())
+    pool_spend_sampler = asyncio.create_task(sample_pool_spend_forever())
     
-    # Запускаем Flask для health checks
+    await set_webhook()
+    webhook_sink = dispatch_to_worker
+    print(f"🤖 Бот запущен в режиме масштабирования: {WORKERS} воркеров")
+    
+    try:
+        await bot_stop.wait()
+    finally:
+        webhook_sink = None
+        monitor.cancel()
+        pool_scheduler.cancel()
+        pool_spend_sampler.cancel()
+        await runner.cleanup()
+        for queue in worker_queues:
+            queue.put(None)
+        loop = asyncio.get_running_loop()
+        for process in processes:
+            await loop.run_in_executor(None, process.join, 30)
+            if PROMETHEUS_MULTIPROC_DIR:
+                multiprocess.mark_process_dead(process.pid)
+        await players.close()
+        await jobs.close()
+
+def main():
+    """Главная функция"""
     port = int(os.environ.get('PORT', 8000))
-    print(f"🌐 Flask сервер запущен на порту {port}")
-    app.run(host='0.0.0.0', port=port)
+    
+    if WORKERS > 1:
+        asyncio.run(run_scaled(port))
+    else:
+        asyncio.run(run_bot(port))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,364 @@
+"""Выгрузка и загрузка игроков и пула наград
+
+Потоково переносит игроков (TempUser) и пул наград между хранилищем бота
+и файлами NDJSON (.ndjson, .jsonl) или CSV (.csv), в том числе сжатыми
+(.gz). В памяти держится только одна пачка записей, поэтому миллионы
+игроков переносятся за минуты, а память не растет.
+
+При загрузке каждая запись проверяется, игроки пишутся пачками по --batch:
+новые добавляются, существующие перезаписываются, так что прерванную
+загрузку можно просто запустить заново. В хранилище-снимок записи копятся
+в журнале и переносятся в снимок каждые JOURNAL_MAX_BYTES, поэтому память
+ограничена этим пределом, а не числом игроков.
+
+Хранилище берется из тех же переменных, что и у бота (DATABASE_URL,
+STORAGE_BACKEND, SNAPSHOT_DIR), или из --database-url / --snapshot-dir.
+Бота на время переноса лучше остановить.
+
+    python migrate.py export --players players.ndjson.gz --pool pool.ndjson
+    python migrate.py import --players players.ndjson.gz --pool pool.ndjson
+    python migrate.py import --players players.csv --batch 10000 --skip-invalid
+    python migrate.py export --players players.csv --database-url sqlite:///old.db
+    python migrate.py import --players players.csv --snapshot-dir data
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import gzip
+import json
+import time
+
+import psutil
+
+from main import (
+    TempUser, Storage, SnapshotStorage, players_table, jobs,
+    PLAYER_FIELDS, POOL_FIELDS, POOL_MAX_RATE, DATABASE_URL, STORAGE_BACKEND, SNAPSHOT_DIR,
+)
+
+# Как поля игрока и пула выглядят в файлах
+INT_FIELDS = (
+    'user_id', 'level', 'exp', 'hp', 'max_hp', 'attack', 'defense', 'balance',
+    'kills', 'deaths', 'rating', 'daily_streak',
+)
+TIME_FIELDS = ('last_daily', 'created_at', 'last_active')
+# Длины текстовых полей берем из схемы таблицы
+TEXT_LIMITS = {
+    name: players_table.c[name].type.length for name in ('username', 'first_name', 'class_name')
+}
+OPTIONAL_FIELDS = ('username', 'first_name', 'last_daily')
+
+class InvalidRecord(ValueError):
+    """Запись из файла не проходит проверку"""
+
+def open_text(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+def file_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    if name.endswith('.csv'):
+        return 'csv'
+    raise SystemExit(f"{path}: неизвестный формат, нужен .ndjson, .jsonl или .csv (можно .gz)")
+
+# ---------- запись в файл ----------
+
+def player_to_record(user):
+    record = {field: getattr(user, field) for field in PLAYER_FIELDS}
+    for field in TIME_FIELDS:
+        if record[field] is not None:
+            record[field] = record[field].isoformat()
+    return record
+
+def pool_to_record(pool):
+    return dict(pool, last_reset=pool['last_reset'].isoformat())
+
+class RecordWriter:
+    """Пишет записи в NDJSON или CSV по одной"""
+
+    def __init__(self, path, fields):
+        self.file = open_text(path, 'w')
+        self.csv = None
+        if file_format(path) == 'csv':
+            self.csv = csv.DictWriter(self.file, fields)
+            self.csv.writeheader()
+
+    def write(self, record):
+        if self.csv is None:
+            self.file.write(json.dumps(record, ensure_ascii=False))
+            self.file.write('\n')
+            return
+        if 'inventory' in record:
+            record['inventory'] = json.dumps(record['inventory'], ensure_ascii=False)
+        self.csv.writerow(record)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+# ---------- чтение из файла ----------
+
+def read_records(path):
+    """(номер строки, запись) по одной; значения CSV приводятся к типам NDJSON"""
+    with open_text(path, 'r') as file:
+        if file_format(path) == 'ndjson':
+            for line_number, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield line_number, json.loads(line)
+                except json.JSONDecodeError as exc:
+                    yield line_number, InvalidRecord(f"не JSON: {exc}")
+            return
+
+        # Строка 1 - заголовок
+        for line_number, row in enumerate(csv.DictReader(file), 2):
+            try:
+                yield line_number, csv_to_record(row)
+            except ValueError as exc:
+                yield line_number, InvalidRecord(str(exc))
+
+POOL_INT_FIELDS = ('total_pool', 'distributed_today', 'max_daily_pool', 'max_rate')
+
+def csv_to_record(row):
+    record = {}
+    for field, value in row.items():
+        if field is None:
+            raise ValueError("лишние значения в строке")
+        if value is None:
+            raise ValueError(f"нет значения {field}")
+        if value == '' and field in OPTIONAL_FIELDS:
+            record[field] = None
+        elif field in INT_FIELDS or field in POOL_INT_FIELDS:
+            if not value.lstrip('-').isdigit():
+                raise ValueError(f"{field}: ожидается целое число, а не {value}")
+            record[field] = int(value)
+        elif field == 'enabled':
+            if value.lower() not in ('true', 'false', '1', '0'):
+                raise ValueError(f"enabled: ожидается true или false, а не {value}")
+            record[field] = value.lower() in ('true', '1')
+        elif field == 'inventory':
+            record[field] = json.loads(value) if value else {}
+        else:
+            record[field] = value
+    return record
+
+def _check(condition, message):
+    if not condition:
+        raise InvalidRecord(message)
+
+def _parse_time(record, field, parse):
+    value = record[field]
+    if value is None:
+        return None
+    _check(isinstance(value, str), f"{field}: ожидается дата строкой")
+    try:
+        return parse(value)
+    except ValueError:
+        raise InvalidRecord(f"{field}: неверная дата {value}") from None
+
+def record_to_player(record):
+    """Проверяет запись игрока и собирает TempUser"""
+    _check(isinstance(record, dict), "запись должна быть объектом")
+    missing = [field for field in PLAYER_FIELDS if field not in record]
+    _check(not missing, f"нет полей: {', '.join(missing)}")
+
+    for field in INT_FIELDS:
+        value = record[field]
+        _check(isinstance(value, int) and not isinstance(value, bool), f"{field}: ожидается целое число")
+    _check(record['user_id'] > 0, "user_id: должен быть положительным")
+    _check(record['level'] >= 1, "level: должен быть не меньше 1")
+    for field in ('exp', 'max_hp', 'kills', 'deaths', 'daily_streak'):
+        _check(record[field] >= 0, f"{field}: не может быть отрицательным")
+    _check(record['hp'] <= record['max_hp'], "hp: больше max_hp")
+
+    for field, limit in TEXT_LIMITS.items():
+        value = record[field]
+        if value is None and field in OPTIONAL_FIELDS:
+            continue
+        _check(isinstance(value, str), f"{field}: ожидается строка")
+        _check(len(value) <= limit, f"{field}: длиннее {limit} символов")
+
+    inventory = record['inventory']
+    _check(isinstance(inventory, dict), "inventory: ожидается объект")
+    _check(
+        all(isinstance(count, int) and not isinstance(count, bool) and count >= 0 for count in inventory.values()),
+        "inventory: количество предметов должно быть целым неотрицательным",
+    )
+
+    user = TempUser(record['user_id'], record['username'], record['first_name'])
+    for field in INT_FIELDS + ('class_name',):
+        setattr(user, field, record[field])
+    user.inventory = inventory
+    for field in TIME_FIELDS:
+        setattr(user, field, _parse_time(record, field, datetime.datetime.fromisoformat))
+    _check(user.created_at is not None and user.last_active is not None, "created_at и last_active обязательны")
+    return user
+
+def record_to_pool(record):
+    """Проверяет запись пула и возвращает словарь как reward_pool"""
+    _check(isinstance(record, dict), "запись должна быть объектом")
+    # max_rate появился позже остальных полей - в старых выгрузках его нет
+    record.setdefault('max_rate', POOL_MAX_RATE)
+    missing = [field for field in POOL_FIELDS if field not in record]
+    _check(not missing, f"нет полей: {', '.join(missing)}")
+    for field in POOL_INT_FIELDS:
+        value = record[field]
+        _check(isinstance(value, int) and not isinstance(value, bool) and value >= 0,
+               f"{field}: ожидается целое неотрицательное число")
+    _check(isinstance(record['enabled'], bool), "enabled: ожидается true или false")
+    _check(record['last_reset'] is not None, "last_reset обязателен")
+    return {
+        'total_pool': record['total_pool'],
+        'distributed_today': record['distributed_today'],
+        'max_daily_pool': record['max_daily_pool'],
+        'last_reset': _parse_time(record, 'last_reset', datetime.date.fromisoformat),
+        'enabled': record['enabled'],
+        'max_rate': record['max_rate'],
+    }
+
+# ---------- команды ----------
+
+class Progress:
+    """Печатает скорость и память раз в несколько секунд"""
+
+    def __init__(self, title, interval=5.0):
+        self.title = title
+        self.interval = interval
+        self.count = 0
+        self.started = time.perf_counter()
+        self._printed = self.started
+        self._process = psutil.Process()
+        self.peak_rss = self._process.memory_info().rss
+
+    def add(self, count=1):
+        self.count += count
+        now = time.perf_counter()
+        if now - self._printed >= self.interval:
+            self._printed = now
+            self.peak_rss = max(self.peak_rss, self._process.memory_info().rss)
+            print(f"  {self.title}: {self.count:,} ({self.count / (now - self.started):,.0f}/с)", flush=True)
+
+    def finish(self):
+        elapsed = time.perf_counter() - self.started
+        self.peak_rss = max(self.peak_rss, self._process.memory_info().rss)
+        print(
+            f"✅ {self.title}: {self.count:,} за {elapsed:.1f} с "
+            f"({self.count / elapsed if elapsed else 0:,.0f}/с), RSS до {self.peak_rss / 2**20:.0f} МБ"
+        )
+
+def open_storage(args):
+    if args.snapshot_dir or (STORAGE_BACKEND == 'snapshot' and not args.database_url):
+        return SnapshotStorage(args.snapshot_dir or SNAPSHOT_DIR)
+    return Storage(args.database_url or DATABASE_URL)
+
+async def export_players(storage, path):
+    progress = Progress("выгружено игроков")
+    with RecordWriter(path, PLAYER_FIELDS) as writer:
+        async for user in storage.load_players():
+            writer.write(player_to_record(user))
+            progress.add()
+    progress.finish()
+
+async def import_players(storage, path, batch_size, skip_invalid):
+    progress = Progress("загружено игроков")
+    invalid = 0
+    seen = set()
+    batch = []
+    for line_number, record in read_records(path):
+        try:
+            if isinstance(record, InvalidRecord):
+                raise record
+            user = record_to_player(record)
+        except InvalidRecord as exc:
+            if not skip_invalid:
+                raise SystemExit(f"{path}:{line_number}: {exc}")
+            invalid += 1
+            print(f"  ⚠️ {path}:{line_number}: {exc}")
+            continue
+
+        # Повтор user_id внутри одной пачки ломает пакетный upsert
+        if user.user_id in seen:
+            await storage.upsert_players(batch)
+            progress.add(len(batch))
+            batch, seen = [], set()
+        seen.add(user.user_id)
+        batch.append(user)
+        if len(batch) >= batch_size:
+            await storage.upsert_players(batch)
+            progress.add(len(batch))
+            batch, seen = [], set()
+
+    await storage.upsert_players(batch)
+    progress.add(len(batch))
+    progress.finish()
+    if invalid:
+        print(f"⚠️ Пропущено неверных записей: {invalid:,}")
+
+async def export_pool(storage, path):
+    pool = await storage.load_pool()
+    if pool is None:
+        print("⚠️ В хранилище нет пула наград")
+        return
+    with RecordWriter(path, POOL_FIELDS) as writer:
+        writer.write(pool_to_record(pool))
+    print(f"✅ Пул наград выгружен в {path}")
+
+async def import_pool(storage, path):
+    records = [(line_number, record) for line_number, record in read_records(path)]
+    if len(records) != 1:
+        raise SystemExit(f"{path}: ожидается ровно одна запись пула, а не {len(records)}")
+    line_number, record = records[0]
+    try:
+        if isinstance(record, InvalidRecord):
+            raise record
+        pool = record_to_pool(record)
+    except InvalidRecord as exc:
+        raise SystemExit(f"{path}:{line_number}: {exc}")
+    await storage.save_pool(pool)
+    print(f"✅ Пул наград загружен: {pool['total_pool']:,} монет")
+
+async def run(args):
+    for path in (args.players, args.pool):
+        if path:
+            file_format(path)
+
+    storage = open_storage(args)
+    await storage.init()
+    try:
+        if args.command == 'export':
+            if args.players:
+                await export_players(storage, args.players)
+            if args.pool:
+                await export_pool(storage, args.pool)
+        else:
+            if args.pool:
+                await import_pool(storage, args.pool)
+            if args.players:
+                await import_players(storage, args.players, args.batch, args.skip_invalid)
+    finally:
+        await storage.close()
+        await jobs.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка и загрузка игроков и пула наград")
+    parser.add_argument('command', choices=('export', 'import'))
+    parser.add_argument('--players', help="файл игроков: .ndjson, .jsonl или .csv (можно .gz)")
+    parser.add_argument('--pool', help="файл пула наград, те же форматы")
+    parser.add_argument('--batch', type=int, default=5000, help="игроков в одной пачке при загрузке")
+    parser.add_argument('--skip-invalid', action='store_true', help="пропускать неверные записи, а не останавливаться")
+    parser.add_argument('--database-url', help="по умолчанию DATABASE_URL")
+    parser.add_argument('--snapshot-dir', help="хранилище-снимок вместо БД")
+    args = parser.parse_args()
+
+    if not args.players and not args.pool:
+        parser.error("укажи --players и/или --pool")
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
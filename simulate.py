@@ -0,0 +1,217 @@
+"""Симулятор боев и экономики для подбора баланса
+
+Векторно (NumPy) прогоняет те же формулы, что и GameLogic.calculate_battle /
+GameLogic.calculate_reward, сразу на сотнях тысяч боев для каждой комбинации
+класса, уровня и монстра. Игрок всегда атакует и начинает бой с полным HP.
+
+Отчет: доля побед, ходов до победы, монеты и опыт за бой и за час игры,
+и как быстро DEFAULT_DAILY_POOL закончится при заданном числе игроков.
+
+NumPy нужен только симулятору, боту он не нужен:
+    pip install numpy
+    python simulate.py
+    python simulate.py --fights 1000000 --levels 1,5,10,15 --players 5000
+    python simulate.py --hp-scale 1.2 --coins-scale 0.8 --daily-pool 20000
+"""
+import argparse
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    raise SystemExit("Для симулятора нужен NumPy: pip install numpy")
+
+from main import (
+    MONSTERS, CLASSES, START_HP, START_ATTACK, START_DEFENSE,
+    HP_PER_LEVEL, ATTACK_PER_LEVEL, DEFENSE_PER_LEVEL, REVIVE_COST,
+    DEFAULT_DAILY_POOL, DEFAULT_TOTAL_POOL,
+)
+
+# Ход, после которого бой считается затянутым и прерывается
+MAX_TURNS = 500
+
+def player_stats(class_name, level):
+    bonus = CLASSES[class_name]
+    return (
+        START_HP + bonus['hp_bonus'] + HP_PER_LEVEL * (level - 1),
+        START_ATTACK + bonus['attack_bonus'] + ATTACK_PER_LEVEL * (level - 1),
+        START_DEFENSE + bonus['defense_bonus'] + DEFENSE_PER_LEVEL * (level - 1),
+    )
+
+def simulate_fights(rng, fights, hp, attack, defense, monster):
+    """Прогоняет fights боев, возвращает (победа, число ходов) массивами"""
+    player_hp = np.full(fights, hp, dtype=np.int32)
+    monster_hp = np.full(fights, monster['hp'], dtype=np.int32)
+    turns = np.zeros(fights, dtype=np.int32)
+    won = np.zeros(fights, dtype=bool)
+    active = np.arange(fights)
+
+    monster_defense = monster['defense'] // 2
+    player_defense = defense // 2
+
+    for turn in range(1, MAX_TURNS + 1):
+        if active.size == 0:
+            break
+        n = active.size
+
+        # Те же разбросы, что и в GameRandom.battle_turn
+        player_attack = attack + rng.integers(-3, 6, n, dtype=np.int32)
+        monster_attack = monster['attack'] + rng.integers(-2, 4, n, dtype=np.int32)
+        crit = rng.random(n) < 0.1
+        player_attack = np.where(crit, player_attack * 2, player_attack)
+
+        player_damage = np.maximum(1, player_attack - monster_defense)
+        monster_damage = np.maximum(1, monster_attack - player_defense)
+
+        monster_hp[active] -= player_damage
+        player_hp[active] -= monster_damage
+
+        # Как и в обработчике, смерть игрока проверяется раньше победы
+        dead = player_hp[active] <= 0
+        killed = ~dead & (monster_hp[active] <= 0)
+        finished = dead | killed
+
+        won[active[killed]] = True
+        turns[active[finished]] = turn
+        active = active[~finished]
+
+    turns[active] = MAX_TURNS
+    return won, turns
+
+def simulate_rewards(rng, wins, monster, level, coins_scale):
+    """Награды за wins побед: (монеты, опыт, число дропов)"""
+    if wins == 0:
+        return np.zeros(0), np.zeros(0), 0
+
+    min_coins, max_coins = monster['coins_range']
+    base_coins = rng.integers(min_coins, max_coins + 1, wins) * coins_scale
+
+    level_diff = level - monster['level']
+    if level_diff > 0:
+        level_modifier = max(0.5, 1.0 - level_diff * 0.1)
+    else:
+        level_modifier = min(1.5, 1.0 + abs(level_diff) * 0.15)
+    modifier = level_modifier * rng.uniform(0.9, 1.1, wins)
+
+    coins = (base_coins * modifier).astype(np.int64)
+    exp = (monster['exp'] * modifier).astype(np.int64)
+    drops = int((rng.random(wins) < monster['drop_chance']).sum())
+    return coins, exp, drops
+
+def simulate(fights=100_000, levels=(1, 3, 5, 8, 12), classes=None, monsters=None,
+             turn_seconds=1.5, fight_overhead=5.0, hp_scale=1.0, coins_scale=1.0, seed=None):
+    """Возвращает список строк отчета (словарей) по всем комбинациям"""
+    rng = np.random.default_rng(seed)
+    classes = classes or list(CLASSES)
+    monsters = monsters or MONSTERS
+
+    rows = []
+    for class_name in classes:
+        for level in levels:
+            hp, attack, defense = player_stats(class_name, level)
+            for monster_id, monster in monsters.items():
+                # Монстр недоступен, если он сильнее уровня игрока больше чем на 2
+                if level < monster['level'] - 2:
+                    continue
+                monster = dict(monster, hp=int(monster['hp'] * hp_scale))
+
+                won, turns = simulate_fights(rng, fights, hp, attack, defense, monster)
+                wins = int(won.sum())
+                coins, exp, drops = simulate_rewards(rng, wins, monster, level, coins_scale)
+
+                # Время боя: ходы игрока плюс выбор монстра и прочая возня
+                seconds = turns.sum() * turn_seconds + fights * fight_overhead
+                hours = seconds / 3600
+                net_coins = coins.sum() - (fights - wins) * REVIVE_COST
+
+                rows.append({
+                    'class': class_name,
+                    'level': level,
+                    'monster': monster_id,
+                    'win_rate': wins / fights,
+                    'turns_to_kill': float(turns[won].mean()) if wins else float('nan'),
+                    'coins_per_fight': float(coins.sum()) / fights,
+                    'exp_per_fight': float(exp.sum()) / fights,
+                    'drop_rate': drops / fights,
+                    'coins_per_hour': float(coins.sum()) / hours,
+                    'net_coins_per_hour': float(net_coins) / hours,
+                    'exp_per_hour': float(exp.sum()) / hours,
+                })
+    return rows
+
+def pool_drain(rows, players, hours_per_day, daily_pool, total_pool):
+    """Оценка расхода пула, если все игроки фармят самую выгодную цель"""
+    best = {}
+    for row in rows:
+        key = (row['class'], row['level'])
+        if row['coins_per_hour'] > best.get(key, 0):
+            best[key] = row['coins_per_hour']
+
+    coins_per_hour = sum(best.values()) / len(best)
+    demand_per_hour = coins_per_hour * players
+    hours_to_daily_cap = daily_pool / demand_per_hour if demand_per_hour else float('inf')
+    daily_spend = min(daily_pool, demand_per_hour * hours_per_day)
+
+    return {
+        'coins_per_player_hour': coins_per_hour,
+        'demand_per_hour': demand_per_hour,
+        'hours_to_daily_cap': hours_to_daily_cap,
+        'daily_spend': daily_spend,
+        'days_to_empty_total': total_pool / daily_spend if daily_spend else float('inf'),
+    }
+
+def print_report(rows):
+    header = (f"{'класс':<7} {'ур':>3} {'монстр':>6} {'победы':>7} {'ходов':>6} "
+              f"{'💰/бой':>7} {'✨/бой':>7} {'дроп':>5} {'💰/час':>8} {'чистые':>8} {'✨/час':>8}")
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        print(f"{row['class']:<7} {row['level']:>3} {row['monster']:>6} "
+              f"{row['win_rate']:>7.1%} {row['turns_to_kill']:>6.1f} "
+              f"{row['coins_per_fight']:>7.1f} {row['exp_per_fight']:>7.1f} {row['drop_rate']:>5.0%} "
+              f"{row['coins_per_hour']:>8.0f} {row['net_coins_per_hour']:>8.0f} {row['exp_per_hour']:>8.0f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Симулятор боев и экономики")
+    parser.add_argument('--fights', type=int, default=100_000, help="боев на комбинацию")
+    parser.add_argument('--levels', default='1,3,5,8,12', help="уровни игрока через запятую")
+    parser.add_argument('--classes', default=','.join(CLASSES), help="классы через запятую")
+    parser.add_argument('--turn-seconds', type=float, default=1.5, help="секунд на один ход")
+    parser.add_argument('--fight-overhead', type=float, default=5.0, help="секунд на выбор монстра и т.п.")
+    parser.add_argument('--hp-scale', type=float, default=1.0, help="множитель HP монстров")
+    parser.add_argument('--coins-scale', type=float, default=1.0, help="множитель монет за победу")
+    parser.add_argument('--players', type=int, default=1000, help="активных игроков")
+    parser.add_argument('--hours-per-day', type=float, default=1.0, help="часов игры в день на игрока")
+    parser.add_argument('--daily-pool', type=int, default=DEFAULT_DAILY_POOL)
+    parser.add_argument('--total-pool', type=int, default=DEFAULT_TOTAL_POOL)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    rows = simulate(
+        fights=args.fights,
+        levels=[int(level) for level in args.levels.split(',')],
+        classes=args.classes.split(','),
+        turn_seconds=args.turn_seconds,
+        fight_overhead=args.fight_overhead,
+        hp_scale=args.hp_scale,
+        coins_scale=args.coins_scale,
+        seed=args.seed,
+    )
+    elapsed = time.perf_counter() - started
+
+    print_report(rows)
+
+    drain = pool_drain(rows, args.players, args.hours_per_day, args.daily_pool, args.total_pool)
+    print()
+    print(f"📊 ПУЛ при {args.players:,} игроках по {args.hours_per_day:g} ч/день:")
+    print(f"• Игрок зарабатывает: {drain['coins_per_player_hour']:,.0f} монет/час")
+    print(f"• Спрос всех игроков: {drain['demand_per_hour']:,.0f} монет/час")
+    print(f"• Дневной лимит {args.daily_pool:,} кончится через {drain['hours_to_daily_cap'] * 60:.1f} мин игры")
+    print(f"• Общий пул {args.total_pool:,} кончится через {drain['days_to_empty_total']:.0f} дней")
+    print()
+    total_fights = args.fights * len(rows)
+    print(f"⏱ {total_fights:,} боев за {elapsed:.1f} с ({total_fights / elapsed:,.0f} боев/с)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""SnapshotStorage: журнал, восстановление после сбоя и форматы записей"""
+import asyncio
+import datetime
+import os
+import sys
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from main import (
+    SnapshotStorage, TempUser, JOURNAL_HEADER, JOURNAL_PLAYER, JOURNAL_POOL,
+    POOL_RECORD_V1, SNAPSHOT_HEADER, SNAPSHOT_MAGIC, POOL_MAX_RATE, encode_player,
+)
+
+POOL = {
+    'total_pool': 5000,
+    'distributed_today': 70,
+    'max_daily_pool': 900,
+    'last_reset': datetime.date(2024, 3, 1),
+    'enabled': False,
+    'max_rate': 25,
+}
+
+
+def make_user(user_id, balance=100, rating=0):
+    user = TempUser(user_id, f'u{user_id}', f'User{user_id}')
+    user.balance = balance
+    user.rating = rating
+    return user
+
+
+def crash(storage):
+    """Бросает хранилище как при падении процесса: без close и пересборки"""
+    storage._maintenance.cancel()
+    storage._journal.flush()
+    storage._journal.close()
+    if storage._map is not None:
+        storage._map.close()
+
+
+async def reopen(directory):
+    storage = SnapshotStorage(directory, fsync_interval=3600, snapshot_interval=3600)
+    await storage.init()
+    return storage
+
+
+def run(coroutine):
+    try:
+        return asyncio.run(coroutine)
+    finally:
+        # Пересборка идет в пуле процессов, привязанном к циклу событий
+        asyncio.run(main.jobs.close())
+
+
+def test_reopen_after_crash_replays_journal(tmp_path):
+    async def scenario():
+        storage = await reopen(str(tmp_path))
+        await storage.insert_player(make_user(1, balance=10))
+        await storage.save_players([make_user(1, balance=250, rating=7), make_user(2)])
+        await storage.save_pool(POOL)
+        crash(storage)
+
+        storage = await reopen(str(tmp_path))
+        try:
+            assert storage.replayed == 4
+            assert await storage.count_players() == 2
+            player = await storage.load_player(1)
+            assert (player.balance, player.rating) == (250, 7)
+            assert await storage.load_pool() == POOL
+        finally:
+            await storage.close()
+
+        # После close все лежит в снимке, журнал пуст
+        storage = await reopen(str(tmp_path))
+        try:
+            assert storage.replayed == 0
+            assert storage._changed == {}
+            assert (await storage.load_player(1)).balance == 250
+            assert await storage.load_pool() == POOL
+        finally:
+            await storage.close()
+
+    run(scenario())
+
+
+def test_torn_last_record_is_truncated(tmp_path):
+    async def scenario():
+        storage = await reopen(str(tmp_path))
+        await storage.save_players([make_user(1)])
+        size = storage._journal_bytes
+        await storage.save_players([make_user(2)])
+        crash(storage)
+
+        journal_path = os.path.join(str(tmp_path), 'journal.log')
+        with open(journal_path, 'r+b') as file:
+            file.truncate(os.path.getsize(journal_path) - 3)
+
+        storage = await reopen(str(tmp_path))
+        try:
+            assert os.path.getsize(journal_path) == size
+            assert await storage.load_player(1) is not None
+            assert await storage.load_player(2) is None
+            assert await storage.count_players() == 1
+        finally:
+            await storage.close()
+
+    run(scenario())
+
+
+def test_corrupted_record_stops_replay(tmp_path):
+    async def scenario():
+        storage = await reopen(str(tmp_path))
+        await storage.save_players([make_user(1)])
+        size = storage._journal_bytes
+        await storage.save_players([make_user(2), make_user(3)])
+        crash(storage)
+
+        journal_path = os.path.join(str(tmp_path), 'journal.log')
+        with open(journal_path, 'r+b') as file:
+            file.seek(size + JOURNAL_HEADER.size)
+            file.write(b'\xff')
+
+        storage = await reopen(str(tmp_path))
+        try:
+            assert storage.replayed == 1
+            assert await storage.load_player(3) is None
+        finally:
+            await storage.close()
+
+    run(scenario())
+
+
+def test_leftover_rotated_journal_is_compacted(tmp_path):
+    async def scenario():
+        storage = await reopen(str(tmp_path))
+        await storage.save_players([make_user(1, balance=1), make_user(2, balance=2)])
+        crash(storage)
+        # Падение между ротацией журнала и записью снимка
+        os.replace(storage.journal_path, storage.rotated_path)
+        with open(storage.journal_path, 'wb') as file:
+            payload = encode_player(make_user(2, balance=20))
+            file.write(JOURNAL_HEADER.pack(JOURNAL_PLAYER, len(payload), zlib.crc32(payload)) + payload)
+
+        storage = await reopen(str(tmp_path))
+        try:
+            assert not os.path.exists(storage.rotated_path)
+            # Оба журнала проиграны по порядку и перенесены в снимок
+            assert storage._changed == {}
+            assert (await storage.load_player(1)).balance == 1
+            assert (await storage.load_player(2)).balance == 20
+            assert await storage.count_players() == 2
+        finally:
+            await storage.close()
+
+    run(scenario())
+
+
+def test_rotation_appends_to_unfinished_rotated_journal(tmp_path):
+    async def scenario():
+        storage = await reopen(str(tmp_path))
+        await storage.save_players([make_user(1, balance=1)])
+        await storage.sync()
+        with open(storage.rotated_path, 'wb') as file:
+            payload = encode_player(make_user(5, balance=5))
+            file.write(JOURNAL_HEADER.pack(JOURNAL_PLAYER, len(payload), zlib.crc32(payload)) + payload)
+
+        storage._rotate_journal()
+        crash(storage)
+
+        storage = await reopen(str(tmp_path))
+        try:
+            assert (await storage.load_player(1)).balance == 1
+            assert (await storage.load_player(5)).balance == 5
+        finally:
+            await storage.close()
+
+    run(scenario())
+
+
+def test_compact_keeps_changes_made_during_it(tmp_path):
+    async def scenario():
+        storage = await reopen(str(tmp_path))
+        try:
+            await storage.save_players([make_user(1, balance=1), make_user(2, balance=2)])
+            compaction = asyncio.create_task(storage.compact())
+            # Пока снимок пишется, игрок 2 меняется снова
+            while not os.path.exists(storage.rotated_path):
+                await asyncio.sleep(0.001)
+            await storage.save_players([make_user(2, balance=22)])
+            await compaction
+
+            assert list(storage._changed) == [2]
+            assert (await storage.load_player(1)).balance == 1
+            assert (await storage.load_player(2)).balance == 22
+        finally:
+            await storage.close()
+
+        storage = await reopen(str(tmp_path))
+        try:
+            assert (await storage.load_player(2)).balance == 22
+        finally:
+            await storage.close()
+
+    run(scenario())
+
+
+def test_version_1_pool_records(tmp_path):
+    pool_v1 = POOL_RECORD_V1.pack(5000, 70, 900, datetime.date(2024, 3, 1).toordinal(), True)
+    expected = dict(POOL, enabled=True, max_rate=POOL_MAX_RATE)
+
+    async def scenario():
+        # Пустой снимок версии 1: заголовок, пул без max_rate, пустой индекс
+        with open(os.path.join(str(tmp_path), 'players.snap'), 'wb') as file:
+            file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, 1, 0, SNAPSHOT_HEADER.size + len(pool_v1)))
+            file.write(pool_v1)
+        storage = await reopen(str(tmp_path))
+        try:
+            assert await storage.load_pool() == expected
+        finally:
+            crash(storage)
+
+        # Запись пула версии 1 в старом журнале
+        with open(os.path.join(str(tmp_path), 'journal.log'), 'wb') as file:
+            file.write(JOURNAL_HEADER.pack(JOURNAL_POOL, len(pool_v1), zlib.crc32(pool_v1)) + pool_v1)
+        storage = await reopen(str(tmp_path))
+        try:
+            assert await storage.load_pool() == expected
+        finally:
+            await storage.close()
+
+        # После пересборки снимок уже в текущей версии
+        storage = await reopen(str(tmp_path))
+        try:
+            assert await storage.load_pool() == expected
+        finally:
+            await storage.close()
+
+    run(scenario())